@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Асинхронный режим webhook-сервера на aiohttp.
+
+Flask под gunicorn держит по потоку на каждый апдейт в обработке, и поток
+простаивает, пока ждет Telegram и Google Sheets. Здесь соединения
+принимает цикл asyncio: тысячи одновременных апдейтов - это корутины в
+ожидании, а не потоки. Сами хендлеры те же, что в режиме Flask
+(main.handle_webhook_update). Они синхронные (вызовы Sheets,
+register_next_step_handler), поэтому выполняются в пуле потоков
+ASYNC_WEBHOOK_WORKERS. Апдейты одного пользователя обрабатываются строго
+по порядку, разных - параллельно. Больше ASYNC_WEBHOOK_MAX_IN_FLIGHT
+апдейтов одновременно сервер не берет: отвечает 503, и Telegram повторит
+доставку позже.
+
+    python async_server.py          # вместо gunicorn main:app
+"""
+
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import main
+import metrics
+import funnel_stats
+
+logger = logging.getLogger(__name__)
+
+ASYNC_WEBHOOK_WORKERS = int(os.getenv("ASYNC_WEBHOOK_WORKERS", "32"))
+ASYNC_WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("ASYNC_WEBHOOK_MAX_IN_FLIGHT", "5000"))
+PORT = int(os.getenv("PORT", "5000"))
+
+# Поля апдейта, в которых есть отправитель (from)
+_SENDER_FIELDS = ("message", "edited_message", "callback_query", "inline_query", "my_chat_member", "chat_member")
+
+
+def update_owner(json_data):
+    """Пользователь, от которого пришел апдейт (ключ упорядочивания), или сам update_id."""
+    for field in _SENDER_FIELDS:
+        payload = json_data.get(field)
+        if isinstance(payload, dict) and isinstance(payload.get("from"), dict):
+            return payload["from"].get("id")
+    return ("update", json_data.get("update_id"))
+
+
+class UpdateDispatcher:
+    """Передает апдейты в пул потоков; апдейты одного пользователя - по очереди."""
+
+    def __init__(self, workers=ASYNC_WEBHOOK_WORKERS, max_in_flight=ASYNC_WEBHOOK_MAX_IN_FLIGHT):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webhook-handler")
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.rejected = 0
+        # owner -> [asyncio.Lock, число апдейтов владельца в обработке]
+        self._owners = {}
+
+    async def dispatch(self, json_data):
+        if self.in_flight >= self.max_in_flight:
+            self.rejected += 1
+            return "BUSY", 503
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        owner = update_owner(json_data)
+        entry = self._owners.setdefault(owner, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, main.handle_webhook_update, json_data)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                self._owners.pop(owner, None)
+            self.in_flight -= 1
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "peak": self.peak_in_flight, "rejected": self.rejected}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def build_app(dispatcher=None):
+    dispatcher = dispatcher or UpdateDispatcher()
+    metrics.WEBHOOK_IN_FLIGHT.set_function(dispatcher.stats)
+
+    async def webhook(request):
+        try:
+            json_data = await request.json()
+        except Exception as e:
+            logger.error(f"Ошибка webhook: {e}")
+            return web.Response(text="ERROR", status=400)
+        body, status = await dispatcher.dispatch(json_data)
+        return web.Response(text=body, status=status)
+
+    async def ready(request):
+        body, status = main.readiness_report()
+        return web.json_response(body, status=status)
+
+    async def metrics_endpoint(request):
+        return web.Response(body=metrics.REGISTRY.render().encode("utf-8"),
+                            headers={"Content-Type": metrics.CONTENT_TYPE})
+
+    async def funnel_stats_endpoint(request):
+        try:
+            hours = int(request.query.get("hours", 24))
+        except ValueError:
+            hours = 24
+        return web.json_response(funnel_stats.summary(hours))
+
+    async def index(request):
+        return web.Response(text=main.index())
+
+    async def on_cleanup(app):
+        dispatcher.shutdown()
+
+    app = web.Application()
+    app["dispatcher"] = dispatcher
+    app.router.add_post("/telegram-webhook", webhook)
+    app.router.add_get("/ready", ready)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.router.add_get("/funnel-stats", funnel_stats_endpoint)
+    app.router.add_get("/", index)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    print(f"✅ ASYNC: webhook-сервер aiohttp на порту {PORT}, потоков хендлеров {ASYNC_WEBHOOK_WORKERS}")
+    main.start_background()
+    web.run_app(build_app(), host="0.0.0.0", port=PORT)
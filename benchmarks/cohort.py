@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Когортный отчет (cohort_report.py) на синтетическом листе Stats.
+
+Генерирует --rows строк Stats: пользователи приходят за --days дней через
+/start или диплинк /start consult, часть получает кейс и оставляет заявку,
+остальное - шум других действий. Строки читаются из заглушки Sheets
+страницами по --page-rows, как из настоящей таблицы, и по ним строится
+отчет. Показывает время загрузки, разбора в колонки и расчета.
+
+    python -m benchmarks.cohort --rows 1000000
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cohort_report  # noqa: E402
+from fake_sheets import build_bot_spreadsheet  # noqa: E402
+
+NOISE_ACTIONS = ("CHECKLIST_REQUESTED", "CHECKLIST_SENT", "CASE_REQUESTED", "AI_GUIDE_SENT", "AVTOVORONKI_SENT")
+
+
+def build_stats_rows(rows, days, seed=1):
+    """Строки Stats в порядке пользователей (как append_row, но без сортировки по времени)."""
+    rng = random.Random(seed)
+    start = datetime(2026, 1, 1)
+    result = []
+    user_id = 10_000_000
+    fmt = "%Y-%m-%d %H:%M:%S"
+    while len(result) < rows:
+        user_id += 1
+        uid = str(user_id)
+        started = start + timedelta(seconds=rng.randrange(days * 86400))
+        deeplink = rng.random() < 0.1
+        details = "Запуск бота (deeplink: consult)" if deeplink else "Запуск бота"
+        result.append([started.strftime(fmt), uid, "User", "START", details])
+        for _ in range(rng.randrange(8)):
+            moment = started + timedelta(minutes=rng.randrange(4 * 1440))
+            result.append([moment.strftime(fmt), uid, "User", rng.choice(NOISE_ACTIONS), ""])
+        case_at = None
+        if not deeplink and rng.random() < 0.4:
+            case_at = started + timedelta(minutes=rng.expovariate(1 / 600))
+            result.append([case_at.strftime(fmt), uid, "User", "CASE_SENT", "Кейс отправлен"])
+        if rng.random() < (0.5 if deeplink else 0.15 if case_at else 0.03):
+            form_at = (case_at or started) + timedelta(minutes=rng.expovariate(1 / 1440))
+            result.append([form_at.strftime(fmt), uid, "User", "FORM_CONSULTATION", "Заявка на консультацию"])
+    return result[:rows]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарк когортного отчета")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--page-rows", type=int, default=cohort_report.STATS_PAGE_ROWS)
+    parser.add_argument("--output", default="", help="CSV когорт (по умолчанию не пишется)")
+    args = parser.parse_args()
+
+    rows = build_stats_rows(args.rows, args.days)
+    spreadsheet = build_bot_spreadsheet()
+    worksheet = spreadsheet.worksheet("Stats")
+    worksheet._rows.extend(rows)
+
+    t0 = time.perf_counter()
+    fetched = cohort_report.fetch_stats_rows(worksheet, args.page_rows)
+    t1 = time.perf_counter()
+    columns = cohort_report.StatsColumns(fetched)
+    t2 = time.perf_counter()
+    cohorts, distributions = cohort_report.cohort_report(columns)
+    t3 = time.perf_counter()
+    if args.output:
+        cohort_report.write_cohorts_csv(args.output, cohorts)
+
+    starts = int(cohorts["starts"].sum())
+    print(f"Stats: {len(columns)} строк, {columns.n_users} пользователей, {len(cohorts['starts'])} когорт")
+    print(f"  загрузка {args.page_rows}-строчными страницами: {t1 - t0:.2f} с ({spreadsheet.total_calls()} запросов)")
+    print(f"  разбор в колонки: {t2 - t1:.2f} с")
+    print(f"  расчет когорт и распределений: {t3 - t2:.2f} с")
+    print(f"  START {starts} -> CASE_SENT {int(cohorts['case_sent'].sum())} "
+          f"-> FORM_CONSULTATION {int(cohorts['form_consultation'].sum())}")
+
+
+if __name__ == "__main__":
+    main_cli()
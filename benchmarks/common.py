@@ -0,0 +1,151 @@
+"""
+Общие хелперы бенчмарков: загрузка бота с заглушками Telegram и Google Sheets,
+построение синтетических апдейтов и расчет перцентилей.
+"""
+
+import os
+import sys
+import time
+import logging
+import tempfile
+import itertools
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+_callback_ids = itertools.count(1)
+
+
+def percentile(values, p):
+    """Перцентиль p (0..100) методом ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def latency_summary(latencies_s, elapsed_s):
+    count = len(latencies_s)
+    return {
+        "updates": count,
+        "elapsed_s": round(elapsed_s, 4),
+        "updates_per_s": round(count / elapsed_s, 1) if elapsed_s else 0.0,
+        "p50_ms": round(percentile(latencies_s, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies_s, 99) * 1000, 3),
+    }
+
+
+def load_bot(telegram_latency_ms=0, sheets_latency_ms=0, log_level="WARNING"):
+    """Импортирует main с заглушками вместо api.telegram.org и Google Sheets.
+
+    Возвращает (main, fake_api, fake_sheets).
+    """
+    os.environ.setdefault("TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("ADMIN_CHAT_ID", "1")
+    os.environ["GOOGLE_SERVICE_ACCOUNT_JSON"] = "{}"
+    # Один процесс и заглушка таблицы: ждать повторного чтения аренды незачем
+    os.environ.setdefault("DISPATCH_LEASE_SETTLE_SECONDS", "0")
+    # Бенчмарки меряют сам бот, а не лимит Telegram на отправку (outbound.py)
+    os.environ.setdefault("OUTBOUND_RATE_PER_SECOND", "0")
+    # Журнал отправок каждого прогона - с чистого листа
+    os.environ.setdefault("SEND_LEDGER_PATH", os.path.join(tempfile.mkdtemp(prefix="ai2biz-ledger-"), "ledger.sqlite3"))
+    # Счетчики воронки бенчмарка не должны попадать в рабочий снимок
+    os.environ.setdefault("FUNNEL_STATS_PATH", os.path.join(tempfile.mkdtemp(prefix="ai2biz-stats-"), "funnel_stats.sqlite3"))
+
+    from fake_bot_api import FakeBotAPI
+    from fake_sheets import build_bot_spreadsheet
+
+    fake_api = FakeBotAPI(latency_ms=telegram_latency_ms).install()
+
+    import main
+    import metrics
+    import tracing
+
+    logging.getLogger().setLevel(log_level)
+    # Под нагрузкой "медленным" оказывается почти каждый апдейт - не засоряем вывод
+    tracing.TRACE_SLOW_MS = float("inf")
+    # Кэш file_id не должен попадать в рабочий file_cache.json
+    main.FILE_CACHE_PATH = os.path.join(tempfile.mkdtemp(prefix="ai2biz-bench-"), "file_cache.json")
+
+    # Импорт main фоновых потоков не запускает; счетчики воронки бенчмарку не нужны
+    main.start_bootstrap()
+    deadline = time.time() + 30
+    while not main.bootstrap_info["ready"] and time.time() < deadline:
+        time.sleep(0.01)
+
+    fake_sheets = build_bot_spreadsheet(latency_ms=sheets_latency_ms)
+    main.google_sheets = metrics.instrument_spreadsheet(fake_sheets)
+    if main.scheduler:
+        main.scheduler.scheduler.shutdown(wait=False)
+    main.scheduler = make_scheduler(main.bot, main.user_data, main.google_sheets)
+    main.scheduler.recovery_callback = main.recovery_handler
+    return main, fake_api, fake_sheets
+
+
+def make_scheduler(bot, user_data, google_sheets, lease_store=None):
+    """FollowUpScheduler без фонового диспетчера (его вызывает сам бенчмарк)."""
+    from scheduler_manager import FollowUpScheduler
+
+    scheduler = FollowUpScheduler(bot, user_data, google_sheets, lease_store=lease_store)
+    scheduler.cancel_job("sheet_dispatch")
+    return scheduler
+
+
+# ===== СИНТЕТИЧЕСКИЕ АПДЕЙТЫ =====
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}",
+            "username": f"user{user_id}", "language_code": "ru"}
+
+
+def message_update(user_id, text):
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        command_length = len(text.split()[0])
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": command_length}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def callback_update(user_id, data, message_id=1):
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_callback_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 100500, "is_bot": True, "first_name": "AI2BIZ"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+# Полная анкета консультации (диплинк) с одной ошибкой ввода на шаге email
+CONSULTATION_FORM_STEPS = [
+    "/start consult",
+    "Иван",
+    "1-3 года",
+    "@ivan_petrov",
+    "not-an-email",
+    "ivan@example.com",
+    "Онлайн-школа, теряем лиды после первого касания",
+    "300K - 1M",
+    "Я один",
+    "Завтра 12-18",
+]
+# Потолок вызовов Sheets на одну анкету консультации (сейчас 18): больше - регрессия
+CONSULTATION_SHEETS_BUDGET = 18
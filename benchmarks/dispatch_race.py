@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Два диспетчера check_pending.py над одним листом Users: не теряется ли цепочка.
+
+Оба диспетчера читают лист одновременно, то есть работают по одному и тому
+же снимку. Затем проигрываются два пересечения:
+- stale  - первый полностью обрабатывает строки (отправка, следующий шаг
+           в J:K), и только потом второй обрабатывает свой устаревший снимок;
+- racing - второй перепроверяет J:K, но захватывает строки только после
+           того, как первый их отправил и записал следующие шаги.
+
+Проверка: каждый пользователь получил сообщение ровно один раз, и у каждого
+в J:K стоит следующий шаг. Если нет - код выхода 1.
+
+    python -m benchmarks.dispatch_race --users 200
+"""
+
+import os
+import sys
+import tempfile
+import argparse
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("TOKEN", "123456:BENCHMARK")
+os.environ["SEND_LEDGER_PATH"] = os.path.join(tempfile.mkdtemp(prefix="ai2biz-race-"), "ledger.sqlite3")
+os.environ.setdefault("CHECK_PENDING_SEND_RATE", "0")
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from fake_sheets import build_bot_spreadsheet  # noqa: E402
+
+FIRST_USER_ID = 20_000_000
+MOSCOW_TZ = pytz.timezone("Europe/Moscow")
+
+
+def build_due_users(count, run_date):
+    return [
+        [str(user_id), f"user{user_id}", f"User {user_id}", "", "", "", "", "", "",
+         "message_1", run_date, str(user_id), "", "", ""]
+        for user_id in range(FIRST_USER_ID, FIRST_USER_ID + count)
+    ]
+
+
+class InterleavedWorksheet:
+    """Лист второго диспетчера: перед захватом строк (первый batch_update) пропускает вперед первый."""
+
+    def __init__(self, worksheet, before_claim):
+        self._worksheet = worksheet
+        self._before_claim = before_claim
+        self._batch_updates = 0
+
+    def batch_update(self, data, **kwargs):
+        self._batch_updates += 1
+        if self._batch_updates == 1:
+            self._before_claim()
+        return self._worksheet.batch_update(data, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._worksheet, name)
+
+
+def run_scenario(name, users, interleave):
+    import check_pending
+
+    fake_api = FakeBotAPI().install()
+    now = datetime.now(MOSCOW_TZ)
+    run_date = (now - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M:%S")
+    spreadsheet = build_bot_spreadsheet(users_rows=build_due_users(users, run_date))
+    worksheet = spreadsheet.worksheet("Users")
+
+    # Один и тот же снимок у обоих диспетчеров
+    records = worksheet.get_all_records()
+    due_first = check_pending.collect_due_rows(records, now, MOSCOW_TZ)
+    due_second = check_pending.collect_due_rows(records, now, MOSCOW_TZ)
+
+    def first():
+        sent["first"] += check_pending.process_due_rows(worksheet, due_first, now)
+
+    sent = Counter()
+    if interleave:
+        second_sheet = InterleavedWorksheet(worksheet, first)
+    else:
+        first()
+        second_sheet = worksheet
+    sent["second"] += check_pending.process_due_rows(second_sheet, due_second, now)
+
+    fake_api.uninstall()
+    # Одно сообщение воронки - один или несколько вызовов (медиагруппа + кнопки) на чат
+    per_chat = min(fake_api.deliveries.values(), default=0)
+    duplicates = fake_api.duplicate_deliveries(per_chat)
+    lost = [cells[0] for cells in worksheet.get_all_values()[1:] if not (cells + [""] * 15)[9]]
+    total_sent = sent["first"] + sent["second"]
+    ok = total_sent == users and len(fake_api.deliveries) == users and not duplicates and not lost
+    print(f"  {name:<7} отправлено {sent['first']:>5} + {sent['second']:<5} из {users}, дублей {duplicates}, "
+          f"без следующего шага: {len(lost):<5} {'✅' if ok else '❌'}")
+    return ok
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Гонка двух диспетчеров check_pending.py")
+    parser.add_argument("--users", type=int, default=200)
+    args = parser.parse_args()
+
+    import send_ledger
+
+    print(f"Два диспетчера, один снимок листа ({args.users} просроченных строк):")
+    results = []
+    for name, interleave in (("stale", False), ("racing", True)):
+        # Журнал отправок у каждого сценария свой
+        send_ledger._ledger = send_ledger.SendLedger(
+            os.path.join(tempfile.mkdtemp(prefix="ai2biz-race-"), "ledger.sqlite3"))
+        results.append(run_scenario(name, args.users, interleave))
+    if not all(results):
+        print("❌ Цепочки потеряны или сообщения отправлены дважды")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
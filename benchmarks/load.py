@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Синтетическая нагрузка: N одновременных пользователей проходят воронку.
+
+Каждый виртуальный пользователь шлет /start, смотрит кейсы, скачивает
+файлы, часть приходит по диплинку /start consult и заполняет анкету
+консультации (с ошибками ввода). Паузы между действиями масштабируются
+через --time-scale. Прогон повторяется для растущей конкурентности, чтобы
+найти точку насыщения. Затем виртуальные часы планировщика проматываются
+вперед, и диспетчер отправляет запланированные шаги FOLLOW_UP_PLAN.
+
+    python -m benchmarks.load --users 200 --concurrency 1,5,10,25,50 \\
+        --telegram-latency-ms 60 --sheets-latency-ms 150
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import (  # noqa: E402
+    callback_update,
+    latency_summary,
+    load_bot,
+    message_update,
+    percentile,
+)
+
+INVALID_INPUTS = {
+    "name": "1",
+    "contact": "ivan",
+    "email": "ivan@",
+    "business": "🙂🙂",
+}
+
+
+class VirtualClock:
+    """Часы, которые можно проматывать вперед (для FollowUpScheduler.clock)."""
+
+    def __init__(self, start=None):
+        self._now = start or datetime.now(pytz.timezone("Europe/Moscow"))
+        self._lock = threading.Lock()
+
+    def now(self):
+        with self._lock:
+            return self._now
+
+    def advance(self, minutes):
+        with self._lock:
+            self._now += timedelta(minutes=minutes)
+            return self._now
+
+
+def build_session(user_id, rng, invalid_rate):
+    """Сценарий одного пользователя: список (метка, апдейт, пауза перед ним в секундах)."""
+    think = lambda mean: rng.expovariate(1 / mean)  # noqa: E731
+    steps = []
+    if rng.random() < 0.2:
+        # Диплинк из канала сразу в анкету
+        steps.append(("consult_deeplink", message_update(user_id, "/start consult"), 0))
+        answers = [
+            ("name", "Мария"),
+            ("duration", "3-5 лет"),
+            ("contact", "+7 912 345-67-89"),
+            ("email", "maria@example.com"),
+            ("business", "Салон красоты, клиенты не возвращаются повторно"),
+            ("revenue", "1M - 5M"),
+            ("participants", "Я с бизнес партнером"),
+            ("time", "В выходные"),
+        ]
+        for field, value in answers:
+            if field in INVALID_INPUTS and rng.random() < invalid_rate:
+                steps.append((f"form_{field}_invalid", message_update(user_id, INVALID_INPUTS[field]), think(8)))
+            steps.append((f"form_{field}", message_update(user_id, value), think(8)))
+        return steps
+
+    steps.append(("start", message_update(user_id, "/start"), 0))
+    if rng.random() < 0.6:
+        steps.append(("examples", callback_update(user_id, "examples"), think(20)))
+        if rng.random() < 0.4:
+            steps.append(("get_case_file", callback_update(user_id, "get_case_file"), think(15)))
+    if rng.random() < 0.3:
+        steps.append(("download_checklist", callback_update(user_id, "download_checklist"), think(30)))
+    if rng.random() < 0.1:
+        steps.append(("show_file_menu", callback_update(user_id, "show_file_menu"), think(20)))
+        steps.append(("get_ai_file", callback_update(user_id, "get_ai_file"), think(10)))
+    return steps
+
+
+def run_level(main, sessions, concurrency, time_scale):
+    """Прогоняет все сессии при заданной конкурентности."""
+    records = defaultdict(list)
+    records_lock = threading.Lock()
+    local = threading.local()
+
+    def run_session(steps):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = main.app.test_client()
+        for label, update, pause in steps:
+            if pause and time_scale:
+                time.sleep(pause * time_scale)
+            t0 = time.perf_counter()
+            client.post("/telegram-webhook", json=update)
+            elapsed = time.perf_counter() - t0
+            with records_lock:
+                records[label].append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(run_session, sessions))
+    wall = time.perf_counter() - started
+
+    all_latencies = [value for values in records.values() for value in values]
+    summary = latency_summary(all_latencies, wall)
+    summary["concurrency"] = concurrency
+    summary["handlers"] = {
+        label: {
+            "count": len(values),
+            "per_s": round(len(values) / wall, 2),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+        }
+        for label, values in sorted(records.items())
+    }
+    return summary
+
+
+def find_saturation(levels, min_gain=0.1):
+    """Первая конкурентность, после которой пропускная способность растет меньше чем на min_gain."""
+    for previous, current in zip(levels, levels[1:]):
+        if previous["updates_per_s"] and \
+                (current["updates_per_s"] - previous["updates_per_s"]) / previous["updates_per_s"] < min_gain:
+            return previous["concurrency"]
+    return None
+
+
+def replay_follow_ups(main, clock, hours, step_minutes):
+    """Проматывает виртуальные часы и запускает диспетчер на каждом шаге."""
+    import metrics
+
+    sends_before = {key: value for key, value in _funnel_sends(metrics).items()}
+    per_step = []
+    steps = int(hours * 60 / step_minutes)
+    for _ in range(steps):
+        clock.advance(step_minutes)
+        before = sum(_funnel_sends(metrics).values())
+        t0 = time.perf_counter()
+        main.scheduler.dispatch_due_messages_from_sheet()
+        per_step.append({
+            "virtual_time": clock.now().strftime("%Y-%m-%d %H:%M"),
+            "sends": sum(_funnel_sends(metrics).values()) - before,
+            "scan_s": round(time.perf_counter() - t0, 4),
+        })
+    by_key = {
+        key: value - sends_before.get(key, 0)
+        for key, value in _funnel_sends(metrics).items()
+        if value - sends_before.get(key, 0)
+    }
+    peak = max(per_step, key=lambda item: item["sends"]) if per_step else None
+    return {"steps": per_step, "sends_by_message_key": by_key, "peak_step": peak}
+
+
+def _funnel_sends(metrics):
+    return {key[0]: value for key, value in metrics.FUNNEL_SENDS_TOTAL.snapshot().items() if key[1] == "ok"}
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон воронки AI2BIZ")
+    parser.add_argument("--users", type=int, default=200, help="виртуальных пользователей на уровень")
+    parser.add_argument("--concurrency", default="1,5,10,25,50", help="уровни конкурентности")
+    parser.add_argument("--time-scale", type=float, default=0.001, help="множитель пауз между действиями")
+    parser.add_argument("--invalid-rate", type=float, default=0.3, help="вероятность ошибки ввода в анкете")
+    parser.add_argument("--telegram-latency-ms", type=float, default=0)
+    parser.add_argument("--sheets-latency-ms", type=float, default=0)
+    parser.add_argument("--follow-up-hours", type=float, default=96, help="сколько виртуальных часов проматывать")
+    parser.add_argument("--step-minutes", type=float, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    main, fake_api, fake_sheets = load_bot(args.telegram_latency_ms, args.sheets_latency_ms)
+    clock = VirtualClock()
+    main.scheduler.clock = clock.now
+    rng = random.Random(args.seed)
+
+    levels = []
+    next_user_id = 20_000_000
+    for concurrency in [int(c) for c in args.concurrency.split(",") if c.strip()]:
+        sessions = [build_session(next_user_id + i, rng, args.invalid_rate) for i in range(args.users)]
+        next_user_id += args.users
+        result = run_level(main, sessions, concurrency, args.time_scale)
+        levels.append(result)
+        print(f"  конкурентность {concurrency:>4}: {result['updates_per_s']:>8.1f} upd/s  "
+              f"p50 {result['p50_ms']:>8.2f} мс  p99 {result['p99_ms']:>8.2f} мс")
+
+    saturation = find_saturation(levels)
+    print(f"Насыщение: {'конкурентность ' + str(saturation) if saturation else 'не достигнуто'}")
+    busiest = levels[-1]["handlers"] if levels else {}
+    for label, stats in busiest.items():
+        print(f"    {label:<24} {stats['per_s']:>8.2f}/с  p50 {stats['p50_ms']:>8.2f} мс  p99 {stats['p99_ms']:>8.2f} мс")
+
+    print(f"Проматываю {args.follow_up_hours} ч виртуального времени...")
+    follow_ups = replay_follow_ups(main, clock, args.follow_up_hours, args.step_minutes)
+    print(f"  отправлено дожимов: {follow_ups['sends_by_message_key']}")
+    if follow_ups["peak_step"]:
+        peak = follow_ups["peak_step"]
+        print(f"  пик: {peak['sends']} отправок за {args.step_minutes} мин ({peak['virtual_time']})")
+
+    report = {
+        "levels": levels,
+        "saturation_concurrency": saturation,
+        "follow_ups": follow_ups,
+        "api_calls": {"telegram": dict(fake_api.calls), "sheets": dict(fake_sheets.calls)},
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+    main.scheduler.scheduler.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+Сквозной бенчмарк AI2BIZ бота на заглушках Telegram и Google Sheets.
+
+Гоняет main.webhook на синтетических апдейтах (/start, callback-кнопки,
+анкета консультации) и FollowUpScheduler.dispatch_due_messages_from_sheet
+на таблицах в 1k/10k/100k строк. Пишет JSON с результатами и умеет
+сравнивать его с сохраненным baseline.
+
+    python -m benchmarks.run --users 200 --output benchmarks/baseline.json
+    python -m benchmarks.run --compare benchmarks/baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+from datetime import datetime, timedelta
+
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_sheets import CallBudgetExceeded  # noqa: E402
+from benchmarks.common import (  # noqa: E402
+    CONSULTATION_FORM_STEPS,
+    CONSULTATION_SHEETS_BUDGET,
+    callback_update,
+    latency_summary,
+    load_bot,
+    make_scheduler,
+    message_update,
+)
+
+CALLBACKS = ["examples", "get_case_file", "download_checklist", "show_file_menu", "get_ai_file"]
+FIRST_USER_ID = 10_000_000
+
+
+def _api_calls(fake_api, fake_sheets, flows_count):
+    return {
+        "telegram_per_flow": round(fake_api.total_calls() / flows_count, 2),
+        "sheets_per_flow": round(fake_sheets.total_calls() / flows_count, 2),
+        "telegram_by_method": dict(sorted(fake_api.calls.items())),
+        "sheets_by_operation": dict(sorted(fake_sheets.calls.items())),
+    }
+
+
+def _post_updates(client, updates):
+    latencies = []
+    started = time.perf_counter()
+    for update in updates:
+        t0 = time.perf_counter()
+        response = client.post("/telegram-webhook", json=update)
+        latencies.append(time.perf_counter() - t0)
+        if response.status_code != 200:
+            raise RuntimeError(f"webhook вернул {response.status_code}")
+    return latencies, time.perf_counter() - started
+
+
+def _post_user_updates(client, fake_sheets, updates, sheets_budget):
+    if not sheets_budget:
+        return _post_updates(client, updates)
+    with fake_sheets.budget(sheets_budget):
+        return _post_updates(client, updates)
+
+
+def bench_flow(main, fake_api, fake_sheets, name, users, build_updates, setup_updates=None, sheets_budget=0):
+    """Прогоняет сценарий для users пользователей, считая только его апдейты.
+
+    sheets_budget - потолок вызовов Sheets на сценарий одного пользователя
+    (0 - без проверки); превышение - CallBudgetExceeded.
+    """
+    client = main.app.test_client()
+    user_ids = [FIRST_USER_ID + i for i in range(users)]
+    if setup_updates:
+        for user_id in user_ids:
+            _post_updates(client, setup_updates(user_id))
+    fake_api.reset_calls()
+    fake_sheets.reset_calls()
+
+    latencies, elapsed = [], 0.0
+    for user_id in user_ids:
+        user_latencies, user_elapsed = _post_user_updates(client, fake_sheets, build_updates(user_id), sheets_budget)
+        latencies.extend(user_latencies)
+        elapsed += user_elapsed
+    result = latency_summary(latencies, elapsed)
+    result.update(_api_calls(fake_api, fake_sheets, users))
+    print(f"  {name:<20} {result['updates_per_s']:>9.1f} upd/s  p50 {result['p50_ms']:>8.2f} мс  "
+          f"p99 {result['p99_ms']:>8.2f} мс  tg/flow {result['telegram_per_flow']:>6.2f}  "
+          f"sheets/flow {result['sheets_per_flow']:>6.2f}")
+    return result
+
+
+def build_users_rows(rows, due_fraction, tz):
+    """Строки листа Users: due_fraction из них с просроченным Run Date."""
+    now = datetime.now(tz)
+    due_every = max(1, int(round(1 / due_fraction))) if due_fraction > 0 else 0
+    past = (now - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M:%S")
+    future = (now + timedelta(hours=6)).strftime("%Y-%m-%d %H:%M:%S")
+    data = []
+    for i in range(rows):
+        user_id = FIRST_USER_ID + i
+        is_due = due_every and i % due_every == 0
+        data.append([
+            user_id, f"user{user_id}", f"User{user_id}", "2026-01-01 10:00:00",
+            "START_FUNNEL", "initial", "", "", "0",
+            "message_1", past if is_due else future, user_id,
+            "message_0", "2026-01-01 10:00:00", "OK",
+        ])
+    return data
+
+
+def bench_dispatch(main, rows, due_fraction, telegram_latency_ms, sheets_latency_ms):
+    import metrics
+    from fake_sheets import build_bot_spreadsheet
+    from fake_bot_api import FakeBotAPI
+
+    fake_api = FakeBotAPI(latency_ms=telegram_latency_ms).install()
+    tz = pytz.timezone("Europe/Moscow")
+    fake_sheets = build_bot_spreadsheet(latency_ms=sheets_latency_ms,
+                                        users_rows=build_users_rows(rows, due_fraction, tz))
+    scheduler = make_scheduler(main.bot, {}, metrics.instrument_spreadsheet(fake_sheets))
+    try:
+        started = time.perf_counter()
+        scheduler.dispatch_due_messages_from_sheet()
+        elapsed = time.perf_counter() - started
+    finally:
+        scheduler.scheduler.shutdown(wait=False)
+
+    due_rows = fake_api.calls["sendMessage"] + fake_api.calls["sendPhoto"] + fake_api.calls["sendMediaGroup"]
+    result = {
+        "rows": rows,
+        "due_fraction": due_fraction,
+        "elapsed_s": round(elapsed, 4),
+        "rows_per_s": round(rows / elapsed, 1) if elapsed else 0.0,
+        "telegram_calls": fake_api.total_calls(),
+        "sheets_calls": fake_sheets.total_calls(),
+        "telegram_by_method": dict(sorted(fake_api.calls.items())),
+        "sheets_by_operation": dict(sorted(fake_sheets.calls.items())),
+    }
+    print(f"  dispatch {rows:>7} строк  {elapsed:>8.3f} с  {result['rows_per_s']:>10.1f} строк/с  "
+          f"отправок ~{due_rows}  sheets {result['sheets_calls']}")
+    return result
+
+
+def bench_dispatch_instances(main, rows, due_fraction, instances, telegram_latency_ms):
+    """N диспетчеров с общей арендой шардов на одной таблице: время и дубли отправок."""
+    import tempfile
+    import threading
+    import leases
+    from fake_sheets import build_bot_spreadsheet
+    from fake_bot_api import FakeBotAPI
+
+    fake_api = FakeBotAPI(latency_ms=telegram_latency_ms).install()
+    tz = pytz.timezone("Europe/Moscow")
+    fake_sheets = build_bot_spreadsheet(users_rows=build_users_rows(rows, due_fraction, tz))
+    lease_path = os.path.join(tempfile.mkdtemp(prefix="ai2biz-leases-"), "leases.json")
+    schedulers = [
+        make_scheduler(main.bot, {}, fake_sheets, lease_store=leases.FileLeaseStore(lease_path))
+        for _ in range(instances)
+    ]
+    for i, scheduler in enumerate(schedulers):
+        scheduler.lease_owner = f"bench-{i}"
+    threads = [threading.Thread(target=scheduler.dispatch_due_messages_from_sheet) for scheduler in schedulers]
+    try:
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        for scheduler in schedulers:
+            scheduler.scheduler.shutdown(wait=False)
+
+    result = {
+        "rows": rows,
+        "instances": instances,
+        "elapsed_s": round(elapsed, 4),
+        "sent": sum(fake_api.deliveries.values()),
+        "duplicates": fake_api.duplicate_deliveries(),
+    }
+    print(f"  {instances:>2} диспетчер(а)  {elapsed:>8.3f} с  отправлено {result['sent']:>6}  "
+          f"дублей {result['duplicates']}")
+    return result
+
+
+def compare(current, baseline_path):
+    """Печатает изменения относительно baseline (+ хуже, - лучше для задержек)."""
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)
+    print(f"\nСравнение с {baseline_path}:")
+    for name, result in current["flows"].items():
+        old = baseline.get("flows", {}).get(name)
+        if not old:
+            continue
+        for key in ("updates_per_s", "p50_ms", "p99_ms", "telegram_per_flow", "sheets_per_flow"):
+            if old.get(key):
+                delta = (result[key] - old[key]) / old[key] * 100
+                print(f"  {name:<20} {key:<18} {old[key]:>10} -> {result[key]:>10} ({delta:+.1f}%)")
+    for rows, result in current["dispatch"].items():
+        old = baseline.get("dispatch", {}).get(rows)
+        if not old:
+            continue
+        for key in ("elapsed_s", "sheets_calls", "telegram_calls"):
+            if old.get(key):
+                delta = (result[key] - old[key]) / old[key] * 100
+                print(f"  dispatch {rows:<11} {key:<18} {old[key]:>10} -> {result[key]:>10} ({delta:+.1f}%)")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Сквозной бенчмарк AI2BIZ бота")
+    parser.add_argument("--users", type=int, default=200, help="пользователей на сценарий")
+    parser.add_argument("--rows", default="1000,10000,100000", help="размеры листа Users для диспетчера")
+    parser.add_argument("--due-fraction", type=float, default=0.05, help="доля просроченных строк")
+    parser.add_argument("--telegram-latency-ms", type=float, default=0)
+    parser.add_argument("--sheets-latency-ms", type=float, default=0)
+    parser.add_argument("--output", default="", help="куда сохранить JSON с результатами")
+    parser.add_argument("--compare", default="", help="baseline JSON для сравнения")
+    parser.add_argument("--skip-dispatch", action="store_true")
+    parser.add_argument("--instances", default="", help="параллельные диспетчеры с арендой шардов, например 1,2,4")
+    parser.add_argument("--consultation-sheets-budget", type=int, default=CONSULTATION_SHEETS_BUDGET,
+                        help="потолок вызовов Sheets на одну анкету консультации (0 - без проверки)")
+    args = parser.parse_args()
+
+    main, fake_api, fake_sheets = load_bot(args.telegram_latency_ms, args.sheets_latency_ms)
+
+    print(f"Сценарии webhook ({args.users} пользователей):")
+    flows = {
+        "start": bench_flow(
+            main, fake_api, fake_sheets, "start", args.users,
+            lambda uid: [message_update(uid, "/start")],
+        ),
+        "callbacks": bench_flow(
+            main, fake_api, fake_sheets, "callbacks", args.users,
+            lambda uid: [callback_update(uid, data) for data in CALLBACKS],
+            setup_updates=lambda uid: [message_update(uid, "/start")],
+        ),
+    }
+    try:
+        flows["consultation_form"] = bench_flow(
+            main, fake_api, fake_sheets, "consultation_form", args.users,
+            lambda uid: [message_update(uid, text) for text in CONSULTATION_FORM_STEPS],
+            sheets_budget=args.consultation_sheets_budget,
+        )
+    except CallBudgetExceeded as e:
+        print(f"❌ Анкета консультации вышла за бюджет вызовов Sheets: {e}")
+        sys.exit(1)
+    main.scheduler.scheduler.shutdown(wait=False)
+
+    dispatch = {}
+    if not args.skip_dispatch:
+        print("Диспетчер таблицы:")
+        for rows in [int(r) for r in args.rows.split(",") if r.strip()]:
+            dispatch[str(rows)] = bench_dispatch(
+                main, rows, args.due_fraction, args.telegram_latency_ms, args.sheets_latency_ms
+            )
+
+    sharded = {}
+    if args.instances:
+        rows = 2000
+        print(f"Параллельные диспетчеры ({rows} строк, аренда шардов в файле):")
+        for instances in [int(n) for n in args.instances.split(",") if n.strip()]:
+            sharded[str(instances)] = bench_dispatch_instances(
+                main, rows, args.due_fraction, instances, args.telegram_latency_ms
+            )
+
+    report = {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "users": args.users,
+            "telegram_latency_ms": args.telegram_latency_ms,
+            "sheets_latency_ms": args.sheets_latency_ms,
+        },
+        "flows": flows,
+        "dispatch": dispatch,
+        "sharded_dispatch": sharded,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультаты сохранены в {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Симулятор воронки дожимов на виртуальных часах.
+
+FollowUpScheduler работает как в боте (FOLLOW_UP_PLAN, custom_follow_up,
+джиттер и потолок FUNNEL_SENDS_PER_MINUTE), но задачи выполняет
+SimulatedScheduler: он перескакивает к времени ближайшей задачи вместо
+ожидания, а Telegram заменен счетчиком вызовов. Четырехдневная воронка для
+100k пользователей проигрывается примерно за минуту (каждый пользователь;
+--scale N проигрывает выборку 1:N в N раз быстрее, и отчет помечает ее).
+
+Поведение пользователей: старт по посту в канале (экспоненциальный спад
+приходов за --arrival-minutes), скачивание кейса после message_3 и
+чек-листа после message_4 (с долями --case-rate, --file-rate), выход из
+воронки после заполнения анкеты (--stop-rate).
+
+Отчет - запланированные отправки в минуту (пик, p99, по ключам сообщений;
+ответ на /start в них не входит, но есть в вызовах Telegram) для текущего
+плана и для измененного из --plan, чтобы увидеть нагрузку до деплоя. Пик
+выше потолка FUNNEL_SENDS_PER_MINUTE (сдвиг ограничен
+FUNNEL_MAX_SHIFT_MINUTES) отмечается как провал, код выхода 1:
+
+    python -m benchmarks.simulate --users 100000 --plan new_plan.json
+
+new_plan.json переопределяет шаги: {"follow_up_plan": {"message_4":
+["message_5", 720]}, "custom_follow_up": {"message_3_1": ["message_4", 60]}}.
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import argparse
+import itertools
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import percentile  # noqa: E402
+
+MOSCOW_TZ = pytz.timezone("Europe/Moscow")
+
+
+class SimulatedJob:
+    __slots__ = ("id", "func", "args", "kwargs", "next_run_time")
+
+    def __init__(self, job_id, func, args, kwargs, next_run_time):
+        self.id = job_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.next_run_time = next_run_time
+
+
+class SimulatedScheduler:
+    """Подмена BackgroundScheduler: разовые задачи в куче по времени, исполнение в run_until().
+
+    Поддерживает то подмножество API APScheduler, которым пользуется
+    FollowUpScheduler. Часы (now) сдвигаются к времени каждой задачи;
+    skip(job) -> True снимает задачу без выполнения.
+    """
+
+    def __init__(self, start, on_run=None, skip=None):
+        self.current = start
+        self.on_run = on_run
+        self.skip = skip
+        self.running = False
+        self.jobs = {}
+        self.queue = []
+        self._seq = itertools.count()
+        self._ids = itertools.count()
+
+    def now(self):
+        return self.current
+
+    def start(self):
+        self.running = True
+
+    def shutdown(self, wait=True):
+        self.running = False
+
+    def add_listener(self, callback, mask=None):
+        pass
+
+    def add_job(self, func, trigger=None, args=None, kwargs=None, id=None, replace_existing=False,
+                run_date=None, **options):
+        run_date = getattr(trigger, "run_date", None) or run_date
+        if run_date is None:
+            return None  # Периодические задачи (диспетчер листа) в симуляции не нужны
+        job = SimulatedJob(id or f"sim_{next(self._ids)}", func, args or [], kwargs or {}, run_date)
+        self.jobs[job.id] = job
+        heapq.heappush(self.queue, (run_date.timestamp(), next(self._seq), job))
+        return job
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def get_jobs(self):
+        return list(self.jobs.values())
+
+    def remove_job(self, job_id):
+        # Как в APScheduler: KeyError (JobLookupError) для неизвестного id
+        del self.jobs[job_id]
+
+    def run_until(self, until):
+        """Выполняет задачи по порядку времени до until. Возвращает число выполненных."""
+        executed = 0
+        deadline = until.timestamp()
+        while self.queue and self.queue[0][0] <= deadline:
+            _, _, job = heapq.heappop(self.queue)
+            if self.jobs.get(job.id) is not job:
+                continue  # Задачу отменили или заменили
+            del self.jobs[job.id]
+            if self.skip and self.skip(job):
+                continue
+            if job.next_run_time > self.current:
+                self.current = job.next_run_time
+            result = job.func(*job.args, **job.kwargs)
+            executed += 1
+            if self.on_run:
+                self.on_run(job, result)
+        if until > self.current:
+            self.current = until
+        return executed
+
+
+class CountingBot:
+    """Вместо Telegram: считает вызовы отправки по виртуальным минутам."""
+
+    def __init__(self, clock, weight=1):
+        self.clock = clock
+        self.weight = weight
+        self.calls_per_minute = Counter()
+
+    def _call(self, *args, **kwargs):
+        self.calls_per_minute[int(self.clock().timestamp() // 60)] += self.weight
+
+    send_message = send_photo = send_media_group = send_document = _call
+
+
+class FunnelSimulation:
+    """Прогон воронки для users пользователей.
+
+    scale > 1 проигрывает каждого scale-го пользователя с потолком отправок,
+    уменьшенным в scale раз, и умножает счетчики обратно: поток стартов
+    прореживается равномерно, поэтому нагрузка по минутам сохраняется, а
+    прогон идет в scale раз быстрее.
+    """
+
+    def __init__(self, users, seed=42, arrival_minutes=60, case_rate=0.3, file_rate=0.2, stop_rate=0.05,
+                 plan_override=None, scale=1):
+        from scheduler_manager import FollowUpScheduler
+
+        self.users = users
+        self.scale = max(1, int(scale))
+        self.rng = random.Random(seed)
+        self.arrival_minutes = arrival_minutes
+        self.case_rate = case_rate
+        self.file_rate = file_rate
+        self.stop_rate = stop_rate
+        self.start = MOSCOW_TZ.localize(datetime(2030, 1, 7, 12, 0))
+        self.sim = SimulatedScheduler(self.start, on_run=self._on_run, skip=self._is_cancelled)
+        self.bot = CountingBot(self.sim.now, self.scale)
+        self.follow_ups = FollowUpScheduler(self.bot, {}, None, clock=self.sim.now, lease_store=None,
+                                            scheduler=self.sim)
+        self.follow_ups.rng = random.Random(seed)
+        if self.follow_ups.sends_per_minute_limit > 0:
+            self.follow_ups.sends_per_minute_limit = max(1, round(self.follow_ups.sends_per_minute_limit / self.scale))
+        # Потолок в масштабе отчета (счетчики выборки умножаются на scale); 0 - без потолка
+        self.ceiling = max(0, self.follow_ups.sends_per_minute_limit) * self.scale
+        if plan_override:
+            self.follow_ups.follow_up_plan = {
+                **self.follow_ups.follow_up_plan,
+                **{key: tuple(value) for key, value in plan_override.get("follow_up_plan", {}).items()},
+            }
+            self.follow_ups.custom_follow_up = {
+                **self.follow_ups.custom_follow_up,
+                **{key: tuple(value) for key, value in plan_override.get("custom_follow_up", {}).items()},
+            }
+        self.sends_per_minute = Counter()
+        self.sends_by_key = Counter()
+        self.peak_by_key = defaultdict(Counter)
+
+    def _record(self, message_key, scheduled=True):
+        minute = int(self.sim.now().timestamp() // 60)
+        if scheduled:
+            self.sends_per_minute[minute] += self.scale
+        self.sends_by_key[message_key] += self.scale
+        self.peak_by_key[message_key][minute] += self.scale
+
+    def _later(self, minutes, func, *args):
+        self.sim.add_job(func, run_date=self.sim.now() + timedelta(minutes=minutes), args=list(args))
+
+    def _user_start(self, user_id):
+        # Как в обработчике /start: message_0 сразу, дальше по плану
+        self._record("message_0", scheduled=False)
+        self.bot.send_message(user_id, "message_0")
+        self.follow_ups.schedule_next_message(user_id, user_id, "message_0")
+        if self.rng.random() < self.stop_rate:
+            self._later(self.rng.expovariate(1 / (24 * 60)), self._user_stop, user_id)
+
+    def _user_stop(self, user_id):
+        self.follow_ups.user_stop_flags[user_id] = True
+
+    def _is_cancelled(self, job):
+        # stop_funnel снимает все задачи пользователя перебором; здесь то же делается при запуске
+        return not job.id.startswith("sim_") and self.follow_ups.is_stopped(job.args[0])
+
+    def _on_run(self, job, result):
+        if job.id.startswith("sim_") or not result:
+            return
+        user_id, _, message_key = job.args[:3]
+        self._record(message_key)
+        if message_key == "message_3" and self.rng.random() < self.case_rate:
+            self._later(self.rng.expovariate(1 / 15), self.follow_ups.schedule_message_3_followup, user_id, user_id)
+        elif message_key == "message_4" and self.rng.random() < self.file_rate:
+            self._later(self.rng.expovariate(1 / 15), self.follow_ups.schedule_message_4_followup, user_id, user_id)
+
+    def run(self, horizon_hours=120):
+        for i in range(self.users // self.scale):
+            offset = min(self.rng.expovariate(4 / self.arrival_minutes), self.arrival_minutes)
+            self.sim.add_job(self._user_start, run_date=self.start + timedelta(minutes=offset),
+                             args=[10_000_000 + i])
+        import send_ledger
+
+        # Журнал отправок защищает от дублей между процессами; в симуляции его SQLite только тормозит
+        ledger_enabled = send_ledger.SEND_LEDGER_ENABLED
+        send_ledger.SEND_LEDGER_ENABLED = False
+        try:
+            t0 = time.perf_counter()
+            executed = self.sim.run_until(self.start + timedelta(hours=horizon_hours))
+        finally:
+            send_ledger.SEND_LEDGER_ENABLED = ledger_enabled
+        return self.report(time.perf_counter() - t0, executed)
+
+    def report(self, elapsed_s, executed):
+        per_minute = list(self.sends_per_minute.values())
+        calls = list(self.bot.calls_per_minute.values())
+        peak_minute = max(self.sends_per_minute, key=self.sends_per_minute.get) if per_minute else None
+        peak = max(per_minute, default=0)
+        return {
+            "users": self.users,
+            "scale": self.scale,
+            "elapsed_s": round(elapsed_s, 2),
+            "jobs_executed": executed,
+            "sends_total": sum(per_minute),
+            "sends_per_minute": {
+                "peak": peak,
+                "p99": percentile(per_minute, 99),
+                "p50": percentile(per_minute, 50),
+                "active_minutes": len(per_minute),
+                "peak_at": datetime.fromtimestamp(peak_minute * 60, MOSCOW_TZ).strftime("%Y-%m-%d %H:%M")
+                if peak_minute is not None else None,
+            },
+            "ceiling_per_minute": self.ceiling,
+            "within_ceiling": not self.ceiling or peak <= self.ceiling,
+            "telegram_calls_per_minute_peak": max(calls, default=0),
+            "by_message_key": {
+                key: {"sends": self.sends_by_key[key], "peak_per_minute": max(self.peak_by_key[key].values())}
+                for key in sorted(self.sends_by_key)
+            },
+        }
+
+
+def print_report(label, report):
+    spm = report["sends_per_minute"]
+    sample = (f"ВЫБОРКА 1:{report['scale']}, счетчики умножены на {report['scale']}" if report["scale"] > 1
+              else "каждый пользователь")
+    print(f"{label}: {report['users']} пользователей ({sample}) за {report['elapsed_s']} с "
+          f"({report['jobs_executed']} задач, {report['sends_total']} дожимов)")
+    print(f"  дожимов в минуту: пик {spm['peak']} ({spm['peak_at']}), p99 {spm['p99']}, p50 {spm['p50']}; "
+          f"вызовов Telegram в минуту: пик {report['telegram_calls_per_minute_peak']}")
+    if report["ceiling_per_minute"]:
+        verdict = "✅" if report["within_ceiling"] else "❌ пик выше потолка"
+        print(f"  потолок FUNNEL_SENDS_PER_MINUTE: {report['ceiling_per_minute']}/мин {verdict}")
+    for key, stats in report["by_message_key"].items():
+        print(f"    {key:<24} {stats['sends']:>8}  пик {stats['peak_per_minute']:>6}/мин")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Симулятор воронки дожимов на виртуальных часах")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--arrival-minutes", type=float, default=60, help="за сколько минут приходят старты")
+    parser.add_argument("--case-rate", type=float, default=0.3, help="доля скачивающих кейс после message_3")
+    parser.add_argument("--file-rate", type=float, default=0.2, help="доля скачивающих чек-лист после message_4")
+    parser.add_argument("--stop-rate", type=float, default=0.05, help="доля заполнивших анкету")
+    parser.add_argument("--hours", type=float, default=120, help="горизонт симуляции в часах")
+    parser.add_argument("--plan", default="", help="JSON с измененным планом для сравнения")
+    parser.add_argument("--scale", type=int, default=1,
+                        help="проигрывать каждого N-го пользователя (выборка; 0 - чтобы прогнать не больше 10k)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+    scale = args.scale or max(1, args.users // 10_000)
+
+    os.environ.setdefault("TOKEN", "123456:SIMULATION")
+    import logging
+    logging.getLogger().setLevel("WARNING")
+
+    options = dict(seed=args.seed, arrival_minutes=args.arrival_minutes, case_rate=args.case_rate,
+                   file_rate=args.file_rate, stop_rate=args.stop_rate, scale=scale)
+    reports = {"current": FunnelSimulation(args.users, **options).run(args.hours)}
+    print_report("Текущий план", reports["current"])
+    if args.plan:
+        with open(args.plan, "r") as f:
+            override = json.load(f)
+        reports["proposed"] = FunnelSimulation(args.users, plan_override=override, **options).run(args.hours)
+        print_report(f"План {args.plan}", reports["proposed"])
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+    failed = [name for name, report in reports.items() if not report["within_ceiling"]]
+    if failed:
+        print(f"❌ Пик дожимов выше потолка FUNNEL_SENDS_PER_MINUTE: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
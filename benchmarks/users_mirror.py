@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Зеркало листа Users (users_mirror.py) против прямых вызовов Sheets.
+
+Заполняет заглушку таблицы --users пользователями с задержкой --latency-ms
+на вызов и сравнивает поиск пользователя (find) напрямую и через зеркало.
+Затем --writes раз обновляет Last Action и расписание случайным
+пользователям через зеркало и показывает, сколькими вызовами Sheets
+уходят изменения, и как одна синхронизация забирает правку, сделанную в
+таблице руками, с конфликтом по столбцу.
+
+    python -m benchmarks.users_mirror --users 20000 --latency-ms 150
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import users_mirror  # noqa: E402
+from fake_sheets import build_bot_spreadsheet  # noqa: E402
+
+
+def build_users(count):
+    rows = []
+    for i in range(count):
+        user_id = 10_000_000 + i
+        rows.append([str(user_id), f"user{user_id}", f"User {i}", "2026-01-01 10:00:00",
+                     "2026-01-01 10:00:00", "NEW", "", "", "0", "", "", str(user_id), "", "", ""])
+    return rows
+
+
+def timed(function, samples):
+    times = []
+    for arg in samples:
+        started = time.perf_counter()
+        function(arg)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Бенчмарк зеркала листа Users")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--latency-ms", type=float, default=150)
+    parser.add_argument("--lookups", type=int, default=20)
+    parser.add_argument("--writes", type=int, default=2000)
+    args = parser.parse_args()
+
+    spreadsheet = build_bot_spreadsheet(users_rows=build_users(args.users))
+    sheet = spreadsheet.worksheet("Users")
+    path = os.path.join(tempfile.mkdtemp(prefix="ai2biz-mirror-"), "users_mirror.sqlite3")
+    mirror = users_mirror.UsersMirror(path)
+    mirrored = users_mirror.MirroredSpreadsheet(spreadsheet, mirror).worksheet("Users")
+
+    started = time.perf_counter()
+    mirror.sync(sheet)
+    print(f"Первичная синхронизация {args.users} строк: {time.perf_counter() - started:.2f} с")
+
+    rng = random.Random(1)
+    sample = [str(10_000_000 + rng.randrange(args.users)) for _ in range(args.lookups)]
+    spreadsheet.latency_ms = args.latency_ms
+    direct = timed(lambda user_id: sheet.find(user_id, in_column=1), sample)
+    local = timed(lambda user_id: mirrored.find(user_id, in_column=1), sample * 50)
+    print(f"find: напрямую {direct * 1000:.1f} мс, через зеркало {local * 1e6:.1f} мкс")
+
+    spreadsheet.reset_calls()
+    started = time.perf_counter()
+    for i in range(args.writes):
+        row = mirrored.find(str(10_000_000 + rng.randrange(args.users)), in_column=1).row
+        mirrored.update_cell(row, 5, f"2026-01-02 {i % 24:02d}:00:00")
+        mirrored.update(f"J{row}:K{row}", [["message_2", "2026-01-03 10:00:00"]])
+    written = time.perf_counter() - started
+    pushed = mirror.push(sheet)
+    print(f"{args.writes} обновлений через зеркало: {written:.2f} с, отправлено {pushed} строк "
+          f"за {spreadsheet.total_calls()} вызовов Sheets {dict(spreadsheet.calls_by_kind())}")
+
+    # Менеджер правит квалификацию и расписание в таблице, бот в это время - расписание в зеркале
+    user_id = str(10_000_000 + args.users // 2)
+    row = mirrored.find(user_id, in_column=1).row
+    sheet_row = sheet.find(user_id, in_column=1).row
+    sheet.update(f"G{sheet_row}", [["Горячий"]])
+    sheet.update(f"J{sheet_row}", [["message_5"]])
+    mirrored.update(f"J{row}:K{row}", [["message_3", "2026-01-04 10:00:00"]])
+    spreadsheet.latency_ms = 0
+    mirror.sync(sheet)
+    record = mirror.get(user_id)
+    print(f"После синхронизации: Lead Quality={record['Lead Quality']!r} (из таблицы), "
+          f"Next Scheduled Message={record['Next Scheduled Message']!r} (из зеркала), "
+          f"в таблице {sheet.row_values(sheet_row)[9]!r}")
+    print(f"Статистика зеркала: {mirror.stats()}")
+
+
+if __name__ == "__main__":
+    main_cli()
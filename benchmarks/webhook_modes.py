@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Сравнение режимов webhook: Flask (поток на апдейт) и async_server.py (aiohttp).
+
+Оба режима получают одинаковый поток /start от разных пользователей с
+заданной конкурентностью поверх заглушек Telegram и Sheets с задержкой.
+Для Flask конкурентность - это потоки (как воркеры gunicorn --threads),
+для async - одновременные запросы к одному циклу asyncio с пулом
+ASYNC_WEBHOOK_WORKERS потоков под хендлеры. Отчет: updates/s, p50/p99 и
+пиковое число потоков процесса.
+
+    python -m benchmarks.webhook_modes --updates 2000 --concurrency 50,500,2000 \\
+        --telegram-latency-ms 60 --sheets-latency-ms 150
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import latency_summary, load_bot, message_update  # noqa: E402
+
+FIRST_USER_ID = 30_000_000
+
+
+class ThreadSampler:
+    """Пиковое число потоков процесса за прогон."""
+
+    def __init__(self):
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(0.01):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def bench_flask(main, updates, concurrency):
+    local = threading.local()
+
+    def post(update):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = main.app.test_client()
+        t0 = time.perf_counter()
+        response = client.post("/telegram-webhook", json=update)
+        if response.status_code != 200:
+            raise RuntimeError(f"webhook вернул {response.status_code}")
+        return time.perf_counter() - t0
+
+    with ThreadSampler() as sampler:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(post, updates))
+        elapsed = time.perf_counter() - started
+    result = latency_summary(latencies, elapsed)
+    result["peak_threads"] = sampler.peak
+    return result
+
+
+def bench_async(updates, concurrency):
+    from aiohttp.test_utils import TestClient, TestServer
+
+    import async_server
+
+    async def run():
+        dispatcher = async_server.UpdateDispatcher()
+        limit = asyncio.Semaphore(concurrency)
+        async with TestClient(TestServer(async_server.build_app(dispatcher))) as client:
+            async def post(update):
+                async with limit:
+                    t0 = time.perf_counter()
+                    response = await client.post("/telegram-webhook", json=update)
+                    if response.status != 200:
+                        raise RuntimeError(f"webhook вернул {response.status}")
+                    return time.perf_counter() - t0
+
+            started = time.perf_counter()
+            latencies = await asyncio.gather(*(post(update) for update in updates))
+            return latencies, time.perf_counter() - started, dispatcher.stats()
+
+    with ThreadSampler() as sampler:
+        latencies, elapsed, stats = asyncio.run(run())
+    result = latency_summary(latencies, elapsed)
+    result["peak_threads"] = sampler.peak
+    result["peak_in_flight"] = stats["peak"]
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Flask vs async webhook")
+    parser.add_argument("--updates", type=int, default=2000, help="апдейтов на уровень")
+    parser.add_argument("--concurrency", default="50,500,2000", help="уровни конкурентности")
+    parser.add_argument("--telegram-latency-ms", type=float, default=60)
+    parser.add_argument("--sheets-latency-ms", type=float, default=150)
+    parser.add_argument("--modes", default="flask,async")
+    parser.add_argument("--output", default="")
+    args = parser.parse_args()
+
+    main, fake_api, fake_sheets = load_bot(args.telegram_latency_ms, args.sheets_latency_ms)
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    report = {mode: [] for mode in modes}
+    next_user_id = FIRST_USER_ID
+    for concurrency in [int(c) for c in args.concurrency.split(",") if c.strip()]:
+        for mode in modes:
+            updates = [message_update(next_user_id + i, "/start") for i in range(args.updates)]
+            next_user_id += args.updates
+            if mode == "flask":
+                result = bench_flask(main, updates, concurrency)
+            else:
+                result = bench_async(updates, concurrency)
+            result["concurrency"] = concurrency
+            report[mode].append(result)
+            print(f"  {mode:<6} конкурентность {concurrency:>5}: {result['updates_per_s']:>8.1f} upd/s  "
+                  f"p50 {result['p50_ms']:>9.2f} мс  p99 {result['p99_ms']:>9.2f} мс  "
+                  f"потоков {result['peak_threads']:>5}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+    main.scheduler.scheduler.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    main_cli()
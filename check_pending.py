@@ -6,7 +6,13 @@
 import os
 import sys
 import json
+import time
+import random
+import signal
 import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import pytz
 import telebot
@@ -17,10 +23,24 @@ import gspread
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 try:
     from messages import MESSAGES, FOLLOW_UP_PLAN
+    import leases
+    import metrics
+    import dispatch_slo
+    import send_ledger
+    import outbound
+    import token_cache
+    import http_transport
 except ImportError:
     # В Railway корень проекта обычно находится в /app
     sys.path.insert(0, '/app')
     from messages import MESSAGES, FOLLOW_UP_PLAN
+    import leases
+    import metrics
+    import dispatch_slo
+    import send_ledger
+    import outbound
+    import token_cache
+    import http_transport
 
 # Настройка логирования
 logging.basicConfig(
@@ -33,14 +53,50 @@ logger = logging.getLogger("check_pending")
 TOKEN = os.getenv("TOKEN")
 GOOGLE_SERVICE_ACCOUNT_JSON = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
 GOOGLE_SHEETS_ID = os.getenv("GOOGLE_SHEETS_ID")
+GOOGLE_SHEETS_BACKEND = os.getenv("GOOGLE_SHEETS_BACKEND", "gspread")
+# Параллельная отправка: потоки и общий лимит сообщений в секунду (лимит Telegram ~30/с)
+SEND_WORKERS = int(os.getenv("CHECK_PENDING_WORKERS", "8"))
+SEND_RATE_PER_SECOND = float(os.getenv("CHECK_PENDING_SEND_RATE", "25"))
+BATCH_UPDATE_CHUNK = 500
+# Повторы batch_update с экспоненциальной паузой: после захвата строк результат нельзя потерять
+COMMIT_ATTEMPTS = int(os.getenv("CHECK_PENDING_COMMIT_ATTEMPTS", "5"))
+COMMIT_RETRY_SECONDS = float(os.getenv("CHECK_PENDING_COMMIT_RETRY_SECONDS", "1"))
+# Строка в статусе SENDING дольше этого считается брошенной (упавший запуск) и восстанавливается
+STUCK_SENDING_SECONDS = float(os.getenv("CHECK_PENDING_STUCK_SECONDS", "600"))
+# Джиттер следующего шага (как в FollowUpScheduler.spread_run_date)
+FOLLOW_UP_JITTER_FRACTION = float(os.getenv("FOLLOW_UP_JITTER_FRACTION", "0.1"))
+FOLLOW_UP_JITTER_MAX_MINUTES = float(os.getenv("FOLLOW_UP_JITTER_MAX_MINUTES", "30"))
+# Результат send_message_direct, если сообщение уже отправлялось (журнал отправок)
+DUPLICATE = "duplicate"
+# Режим --daemon: границы паузы между циклами и период полного обновления кэша строк
+DAEMON_MIN_INTERVAL = float(os.getenv("DAEMON_MIN_INTERVAL", "5"))
+DAEMON_MAX_INTERVAL = float(os.getenv("DAEMON_MAX_INTERVAL", "60"))
+DAEMON_FULL_REFRESH_SECONDS = float(os.getenv("DAEMON_FULL_REFRESH_SECONDS", "600"))
+# Файл для textfile collector node_exporter: у крона и демона нет своего /metrics
+METRICS_FILE = os.getenv("CHECK_PENDING_METRICS_FILE")
 
 # Инициализация бота
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
 bot = telebot.TeleBot(TOKEN)
+http_transport.install_telegram()
 google_sheets_client = None
+lease_store = None
+LEASE_OWNER = leases.make_owner("check_pending")
 
-def init_google_sheets():
-    """Инициализация подключения к Google Sheets с защитой от ошибок scope."""
+def init_google_sheets(background_refresh=False):
+    """Инициализация подключения к Google Sheets с защитой от ошибок scope.
+
+    background_refresh - обновлять OAuth-токен в фоне (для режима --daemon).
+    """
     global google_sheets_client
+    if GOOGLE_SHEETS_BACKEND == "fake":
+        import fake_sheets
+        google_sheets_client = fake_sheets.from_env()
+        logger.info("🧪 Google Sheets: используется in-memory заглушка")
+        return google_sheets_client
+
     if not GOOGLE_SERVICE_ACCOUNT_JSON:
         logger.error("❌ GOOGLE_SERVICE_ACCOUNT_JSON не найден в переменных окружения")
         return None
@@ -55,8 +111,11 @@ def init_google_sheets():
             
         creds_dict = json.loads(clean_json)
         
-        # Самый надежный метод авторизации: автоматически проставляет нужные Scopes
-        client = gspread.service_account_from_dict(creds_dict)
+        # Самый надежный метод авторизации: автоматически проставляет нужные Scopes.
+        # Токен переиспользуется из кэша на диске, пока не подходит срок истечения
+        client = token_cache.authorize(creds_dict)
+        if background_refresh:
+            token_cache.start_background_refresh(client, creds_dict)
         google_sheets_client = client.open_by_key(GOOGLE_SHEETS_ID)
         logger.info("✅ Google Sheets успешно подключен!")
         return google_sheets_client
@@ -64,12 +123,21 @@ def init_google_sheets():
         logger.error(f"❌ Ошибка подключения к Google Sheets: {e}")
         return None
 
-def send_message_direct(chat_id, message_key, user_id):
-    """Отправка сообщения через Telegram API с поддержкой кнопок."""
+def send_message_direct(chat_id, message_key, user_id, scheduled_at=None):
+    """Отправка сообщения через Telegram API с поддержкой кнопок.
+
+    Возвращает True/False, либо DUPLICATE, если журнал отправок уже знает
+    ключ (user_id, message_key, scheduled_at).
+    """
     msg_data = MESSAGES.get(message_key)
     if not msg_data:
         logger.error(f"❌ Сообщение {message_key} не найдено в messages.py")
         return False
+
+    ledger = send_ledger.get_ledger() if scheduled_at else None
+    if ledger and not ledger.begin(user_id, message_key, scheduled_at):
+        logger.info(f"⏭ Дубль {message_key} для {user_id} (запланировано на {scheduled_at}), пропускаю")
+        return DUPLICATE
     
     text = msg_data.get("text")
     buttons = msg_data.get("buttons")
@@ -123,10 +191,14 @@ def send_message_direct(chat_id, message_key, user_id):
         else:
             bot.send_message(chat_id, text, reply_markup=markup, parse_mode="HTML")
 
+        if ledger:
+            ledger.finish(user_id, message_key, scheduled_at)
         logger.info(f"✅ ОТПРАВЛЕНО {message_key} для {user_id}")
         return True
     except Exception as e:
         logger.error(f"❌ Ошибка отправки пользователю {user_id}: {e}")
+        if ledger:
+            ledger.finish(user_id, message_key, scheduled_at, error=e)
         return False
 
 CUSTOM_FOLLOW_UP = {
@@ -134,82 +206,515 @@ CUSTOM_FOLLOW_UP = {
     "message_3_1": ("message_4", 10),
 }
 
+def follow_up_delay(delay_minutes):
+    """Задержка следующего шага с ограниченным джиттером, чтобы волны отправок не синхронизировались."""
+    max_jitter = min(delay_minutes * FOLLOW_UP_JITTER_FRACTION, FOLLOW_UP_JITTER_MAX_MINUTES) * 60
+    return timedelta(minutes=delay_minutes, seconds=random.uniform(0, max_jitter))
+
 def get_next_plan(message_key):
     if message_key in FOLLOW_UP_PLAN:
         return FOLLOW_UP_PLAN[message_key]
     return CUSTOM_FOLLOW_UP.get(message_key)
 
+class RateLimiter:
+    """Простой ограничитель частоты: не больше rate_per_second вызовов acquire() в секунду.
+
+    Кроме своего темпа берет токен из общего с ботом бюджета Telegram
+    (outbound.LIMITER, полоса funnel), чтобы вместе с воркерами бота не
+    превышать OUTBOUND_RATE_PER_SECOND.
+    """
+
+    def __init__(self, rate_per_second, shared=None):
+        self.interval = 1.0 / rate_per_second if rate_per_second > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+        self.shared = shared
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+        if self.shared is not None:
+            self.shared.acquire("funnel")
+
+
+def record_get(record, *keys):
+    for key in keys:
+        val = record.get(key)
+        if val is not None and str(val).strip() != "":
+            return val
+    return ""
+
+
+def collect_due_rows(all_records, now, moscow_tz):
+    """Находит строки, по которым пора отправлять сообщение."""
+    due = []
+    for idx, record in enumerate(all_records):
+        user_id_val = record.get("User ID")
+        if not user_id_val:
+            continue
+
+        user_id = str(user_id_val)
+        next_msg = str(record_get(record, "Next Scheduled Message", "Next Msg")).strip()
+        run_date_str = str(record_get(record, "Run Date", "Time")).strip()
+        chat_id = record_get(record, "Chat ID") or user_id
+
+        if not next_msg or not run_date_str:
+            continue
+        try:
+            run_date = moscow_tz.localize(datetime.strptime(run_date_str, "%Y-%m-%d %H:%M:%S"))
+        except Exception as e:
+            logger.error(f"❌ Ошибка в строке {idx+2} (User {user_id}): {e}")
+            continue
+
+        if run_date <= now:
+            due.append({
+                "row": idx + 2,  # +2 из-за заголовка и 0-индексации
+                "user_id": user_id,
+                "chat_id": chat_id,
+                "message_key": next_msg,
+                "run_date": run_date,
+            })
+    return due
+
+
+def plan_transition(item, sent, now):
+    """Диапазоны, которые нужно записать в строку после попытки отправки.
+
+    sent=None - отправка не начиналась (истекла аренда шарда): расписание
+    возвращается в J:K, строку заберет следующий проход.
+    """
+    now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+    row = item["row"]
+    if sent == DUPLICATE:
+        # Сообщение уже отправил другой процесс. Его следующий шаг мог быть стерт
+        # нашим захватом (он записал J:K между перепроверкой и захватом), поэтому
+        # цепочку продолжаем сами: в J:K остается один следующий шаг, чей бы он ни был
+        updates = [{"range": f"M{row}:O{row}", "values": [[item["message_key"], now_str, "DUPLICATE"]]}]
+        updates.extend(_next_step(item, now))
+        return updates
+    if sent is None:
+        run_date = item["run_date"].strftime("%Y-%m-%d %H:%M:%S")
+        return [
+            {"range": f"J{row}:K{row}", "values": [[item["message_key"], run_date]]},
+            {"range": f"M{row}:O{row}", "values": [[item["message_key"], now_str, "DEFERRED"]]},
+        ]
+    if not sent:
+        return [{"range": f"M{row}:O{row}", "values": [[item["message_key"], now_str, "ERROR"]]}]
+
+    updates = [{"range": f"M{row}:O{row}", "values": [[item["message_key"], now_str, "OK"]]}]
+    updates.extend(_next_step(item, now))
+    return updates
+
+
+def _next_step(item, now):
+    """Диапазон J:K со следующим шагом цепочки ([] - цепочка закончилась)."""
+    plan = get_next_plan(item["message_key"])
+    if not plan:
+        return []
+    next_key, delay_minutes = plan
+    next_run = (now + follow_up_delay(delay_minutes)).strftime("%Y-%m-%d %H:%M:%S")
+    return [{"range": f"J{item['row']}:K{item['row']}", "values": [[next_key, next_run]]}]
+
+
+def still_due(worksheet, due):
+    """Строки due, у которых J:K в таблице все еще те, что были прочитаны.
+
+    Снимок листа мог устареть: другой диспетчер (бот, другой хост) успел
+    отправить шаг и записать в J:K следующий. Захват такой строки стер бы
+    его. J:K всех строк перечитываются одним batch_get.
+    """
+    if not due:
+        return due
+    current = worksheet.batch_get([f"J{item['row']}:K{item['row']}" for item in due])
+    fresh = []
+    for item, values in zip(due, current):
+        cells = (list(values[0]) if values else []) + ["", ""]
+        expected = [item["message_key"], item["run_date"].strftime("%Y-%m-%d %H:%M:%S")]
+        if [str(cells[0]).strip(), str(cells[1]).strip()] == expected:
+            fresh.append(item)
+    if len(fresh) < len(due):
+        logger.info(f"⏭ {len(due) - len(fresh)} строк уже изменены другим диспетчером, пропускаю")
+    return fresh
+
+
+def commit_updates(worksheet, updates):
+    """Записывает диапазоны пачками batch_update (по BATCH_UPDATE_CHUNK диапазонов).
+
+    Каждая пачка повторяется до COMMIT_ATTEMPTS раз с паузой 1, 2, 4... *
+    COMMIT_RETRY_SECONDS; после последней неудачи ошибка пробрасывается.
+    """
+    for start in range(0, len(updates), BATCH_UPDATE_CHUNK):
+        chunk = updates[start:start + BATCH_UPDATE_CHUNK]
+        for attempt in range(1, COMMIT_ATTEMPTS + 1):
+            try:
+                worksheet.batch_update(chunk)
+                break
+            except Exception as e:
+                if attempt == COMMIT_ATTEMPTS:
+                    raise
+                delay = COMMIT_RETRY_SECONDS * 2 ** (attempt - 1)
+                logger.warning(f"⚠️ batch_update не прошел ({e}), попытка {attempt} из {COMMIT_ATTEMPTS}, "
+                               f"повтор через {delay:g} с")
+                time.sleep(delay)
+
+
+def collect_stuck_rows(all_records, now, moscow_tz):
+    """Строки, захваченные (SENDING) дольше STUCK_SENDING_SECONDS назад, результат по которым не записан."""
+    stuck = []
+    for idx, record in enumerate(all_records):
+        user_id_val = record.get("User ID")
+        if not user_id_val or str(record_get(record, "Last Send Status")).strip() != "SENDING":
+            continue
+        # Новое расписание уже записано (ботом или руками): строка не брошена
+        if str(record_get(record, "Next Scheduled Message", "Next Msg")).strip():
+            continue
+        message_key = str(record_get(record, "Last Sent Message")).strip()
+        try:
+            claimed_at = moscow_tz.localize(datetime.strptime(
+                str(record_get(record, "Last Sent At")).strip(), "%Y-%m-%d %H:%M:%S"))
+        except ValueError:
+            continue
+        if not message_key or (now - claimed_at).total_seconds() < STUCK_SENDING_SECONDS:
+            continue
+        stuck.append({
+            "row": idx + 2,
+            "user_id": str(user_id_val),
+            "chat_id": record_get(record, "Chat ID") or user_id_val,
+            "message_key": message_key,
+            # Плановое время после захвата не хранится; при возврате в очередь Run Date - время захвата
+            "run_date": claimed_at,
+        })
+    return stuck
+
+
+def recover_stuck_rows(worksheet, all_records, now, moscow_tz):
+    """Восстанавливает строки, брошенные в SENDING, по журналу отправок. Возвращает их число.
+
+    Журнал знает, чем кончилась отправка после захвата:
+    - sent            - сообщение дошло: статус OK и следующий шаг цепочки;
+    - unknown/sending - могло дойти: статус ERROR, повторно не отправляем;
+    - записи нет      - отправка не начиналась или точно не дошла: J:K
+                        возвращается, строку заберет следующий проход.
+    Без журнала (SEND_LEDGER_ENABLED=0) итог неизвестен, строки остаются как есть.
+    """
+    stuck = collect_stuck_rows(all_records, now, moscow_tz)
+    if not stuck:
+        return 0
+    ledger = send_ledger.get_ledger()
+    if not ledger:
+        logger.warning(f"⚠️ {len(stuck)} строк зависли в SENDING, журнал отправок отключен - не восстанавливаю")
+        return 0
+    updates = []
+    outcomes = {True: 0, False: 0, None: 0}
+    for item in stuck:
+        status = ledger.last_status(item["user_id"], item["message_key"], item["run_date"].timestamp())
+        sent = None if status is None else status == "sent"
+        outcomes[sent] += 1
+        updates.extend(plan_transition(item, sent, now))
+    commit_updates(worksheet, updates)
+    logger.warning(f"🩹 Восстановлено строк из SENDING: {len(stuck)} (доставлено {outcomes[True]}, "
+                   f"неизвестно {outcomes[False]}, возвращено в очередь {outcomes[None]})")
+    return len(stuck)
+
+
+def earliest_run_date(all_records, moscow_tz):
+    """Ближайший Run Date среди строк с запланированным сообщением (или None)."""
+    earliest = None
+    for record in all_records:
+        if not record.get("User ID") or not str(record_get(record, "Next Scheduled Message", "Next Msg")).strip():
+            continue
+        try:
+            run_date = moscow_tz.localize(datetime.strptime(
+                str(record_get(record, "Run Date", "Time")).strip(), "%Y-%m-%d %H:%M:%S"))
+        except ValueError:
+            continue
+        if earliest is None or run_date < earliest:
+            earliest = run_date
+    return earliest
+
+
+def process_due_rows(worksheet, due, now, pool=None, limiter=None, deadline=None):
+    """Захватывает строки, отправляет сообщения и записывает результаты. Возвращает число отправленных.
+
+    Перед захватом J:K перечитываются (still_due): строки, измененные после
+    снимка листа, не трогаются. Строки захватываются одним batch_update ДО
+    отправки (J:K очищается, в M:O ставится SENDING), поэтому повторный
+    запуск их уже не увидит.
+    Если результаты записать не удалось, строки остаются в SENDING до
+    recover_stuck_rows.
+    После deadline (time.monotonic, граница аренды шардов) новые отправки
+    не начинаются.
+    """
+    moscow_tz = pytz.timezone('Europe/Moscow')
+    now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+    due = still_due(worksheet, due)
+    if not due:
+        return 0
+    claims = []
+    for item in due:
+        row = item["row"]
+        claims.append({"range": f"J{row}:K{row}", "values": [["", ""]]})
+        claims.append({"range": f"M{row}:O{row}", "values": [[item["message_key"], now_str, "SENDING"]]})
+    commit_updates(worksheet, claims)
+
+    limiter = limiter or RateLimiter(SEND_RATE_PER_SECOND, outbound.LIMITER)
+
+    def send(item):
+        limiter.acquire()
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        result = send_message_direct(item["chat_id"], item["message_key"], item["user_id"],
+                                     item["run_date"].strftime("%Y-%m-%d %H:%M:%S"))
+        if result is True:
+            # Опоздание относительно планового Run Date
+            item["lag"] = (datetime.now(moscow_tz) - item["run_date"]).total_seconds()
+            dispatch_slo.record_send(item["message_key"], item["lag"])
+        return result
+
+    if pool is None:
+        with ThreadPoolExecutor(max_workers=SEND_WORKERS) as own_pool:
+            results = list(own_pool.map(send, due))
+    else:
+        results = list(pool.map(send, due))
+
+    sent_at = datetime.now(moscow_tz)
+    transitions = []
+    for item, sent in zip(due, results):
+        transitions.extend(plan_transition(item, sent, sent_at))
+    commit_updates(worksheet, transitions)
+    deferred = sum(1 for sent in results if sent is None)
+    if deferred:
+        logger.warning(f"⏳ Аренда шардов истекла, {deferred} строк возвращены в очередь")
+    lags = sorted(item["lag"] for item in due if "lag" in item)
+    if lags:
+        logger.info(f"⏱ Опоздание отправок: p50 {lags[len(lags) // 2]:.0f} с, "
+                    f"p95 {lags[min(len(lags) - 1, int(len(lags) * 0.95))]:.0f} с, макс {lags[-1]:.0f} с")
+    duplicates = sum(1 for sent in results if sent == DUPLICATE)
+    if duplicates:
+        logger.info(f"⏭ Журнал отправок отсек {duplicates} дублей")
+    return sum(1 for sent in results if sent is True)
+
+
+def get_lease_store():
+    """Хранилище аренды шардов (общее с диспетчером бота), см. leases.py."""
+    global lease_store
+    if lease_store is None:
+        lease_store = leases.from_env(google_sheets_client) or False
+    return lease_store
+
+
+def dispatch_due(worksheet, due, now, snapshot_at, pool=None, limiter=None):
+    """Отправляет просроченные строки; при включенной аренде - только в захваченных шардах."""
+    store = get_lease_store()
+    if not store:
+        return process_due_rows(worksheet, due, now, pool, limiter)
+
+    sent = []
+
+    def process(batch, deadline):
+        sent.append(process_due_rows(worksheet, batch, now, pool, limiter, deadline))
+
+    leases.run_sharded(store, LEASE_OWNER, due, lambda item: item["user_id"], process, snapshot_at)
+    return sum(sent)
+
+
 def check_pending_messages():
-    """Проверка просроченных сообщений в таблице и их отправка."""
+    """Проверка просроченных сообщений в таблице и их отправка.
+
+    1. Одно чтение листа и расчет всех просроченных строк.
+    2. Один batch_update захватывает строки.
+    3. Отправка в Telegram параллельно с ограничением частоты.
+    4. Один batch_update с результатами и следующими шагами цепочки.
+    """
     if not google_sheets_client:
         return
     
     try:
         worksheet = google_sheets_client.worksheet("Users")
+        snapshot_at = time.time()
         all_records = worksheet.get_all_records()
         moscow_tz = pytz.timezone('Europe/Moscow')
         now = datetime.now(moscow_tz)
         
         logger.info(f"🔍 Сканирую таблицу... Сейчас (МСК): {now.strftime('%H:%M:%S')}")
-        
-        processed_count = 0
-        
-        def record_get(record, *keys):
-            for key in keys:
-                val = record.get(key)
-                if val is not None and str(val).strip() != "":
-                    return val
-            return ""
-
-        for idx, record in enumerate(all_records):
-            user_id_val = record.get("User ID")
-            if not user_id_val:
-                continue
-            
-            user_id = str(user_id_val)
-            next_msg = str(record_get(record, "Next Scheduled Message", "Next Msg")).strip()
-            run_date_str = str(record_get(record, "Run Date", "Time")).strip()
-            chat_id = record_get(record, "Chat ID") or user_id
-            
-            if next_msg and run_date_str:
-                try:
-                    # Попытка распарсить дату
-                    run_date = datetime.strptime(run_date_str, "%Y-%m-%d %H:%M:%S")
-                    run_date = moscow_tz.localize(run_date)
-                    
-                    if run_date <= now:
-                        logger.info(f"🔔 Время пришло! User: {user_id}, Сообщение: {next_msg}")
-                        
-                        # 1. Очищаем ячейки СРАЗУ (защита от повторной отправки следующим кроном)
-                        row_num = idx + 2  # +2 из-за заголовка и 0-индексации
-                        worksheet.update(values=[["", ""]], range_name=f'J{row_num}:K{row_num}')
-                        
-                        # 2. Отправляем сообщение
-                        if send_message_direct(chat_id, next_msg, user_id):
-                            processed_count += 1
-                            worksheet.update(values=[[next_msg, now.strftime("%Y-%m-%d %H:%M:%S"), "OK"]], range_name=f'M{row_num}:O{row_num}')
-                            
-                            # 3. Планируем следующее сообщение по цепочке из FOLLOW_UP_PLAN
-                            plan = get_next_plan(next_msg)
-                            if plan:
-                                next_key, delay_minutes = plan
-                                next_run_time = now + timedelta(minutes=delay_minutes)
-                                date_str = next_run_time.strftime("%Y-%m-%d %H:%M:%S")
-                                
-                                worksheet.update(values=[[next_key, date_str]], range_name=f'J{row_num}:K{row_num}')
-                                logger.info(f"📅 Новая задача в цепочке: {next_key} через {delay_minutes} мин")
-                        else:
-                            worksheet.update(values=[[next_msg, now.strftime("%Y-%m-%d %H:%M:%S"), "ERROR"]], range_name=f'M{row_num}:O{row_num}')
-                                
-                except Exception as e:
-                    logger.error(f"❌ Ошибка в строке {idx+2} (User {user_id}): {e}")
-        
-        logger.info(f"📊 Обработка завершена. Отправлено за этот запуск: {processed_count}")
+
+        recover_stuck_rows(worksheet, all_records, now, moscow_tz)
+        due = collect_due_rows(all_records, now, moscow_tz)
+        if not due:
+            logger.info("📊 Просроченных сообщений нет")
+            dispatch_slo.record_cycle("check_pending", len(all_records), 0, 0)
+            return
+        logger.info(f"🔔 Время пришло для {len(due)} сообщений")
+
+        processed_count = dispatch_due(worksheet, due, now, snapshot_at)
+        logger.info(f"📊 Обработка завершена. Отправлено за этот запуск: {processed_count} из {len(due)}")
+        dispatch_slo.record_cycle("check_pending", len(all_records), len(due), processed_count)
         
     except Exception as e:
         logger.error(f"❌ Ошибка при работе с листом 'Users': {e}")
 
+
+class PendingDaemon:
+    """Постоянный процесс вместо крона.
+
+    Клиент Sheets, пул потоков и кэш строк живут между циклами. Каждый цикл
+    читает только столбцы расписания J:L; User ID (столбец A) берется из
+    кэша, который полностью перечитывается раз в DAEMON_FULL_REFRESH_SECONDS,
+    при появлении новых строк или при расхождении Chat ID с кэшем (строки
+    сдвинули вручную). Пауза между циклами - до ближайшего Run Date, но в
+    пределах [DAEMON_MIN_INTERVAL, DAEMON_MAX_INTERVAL]: новые расписания
+    бот пишет в таблицу сам, и их нужно подхватывать.
+    """
+
+    def __init__(self):
+        self.moscow_tz = pytz.timezone('Europe/Moscow')
+        self.stop_event = threading.Event()
+        self.pool = ThreadPoolExecutor(max_workers=SEND_WORKERS)
+        self.limiter = RateLimiter(SEND_RATE_PER_SECOND, outbound.LIMITER)
+        self.worksheet = None
+        self.user_ids = []  # User ID по строкам, начиная со второй
+        self.refreshed_at = 0.0
+        self.cycles = 0
+
+    def stop(self, signum=None, frame=None):
+        logger.info("🛑 Получен сигнал остановки, завершаю после текущего цикла")
+        self.stop_event.set()
+
+    def refresh_user_ids(self):
+        t0 = time.perf_counter()
+        self.user_ids = [row[0] if row else "" for row in self.worksheet.get_values("A2:A")]
+        self.refreshed_at = time.monotonic()
+        logger.info(f"🗂 Кэш строк обновлен: {len(self.user_ids)} строк за {(time.perf_counter() - t0) * 1000:.0f} мс")
+
+    def read_schedule(self):
+        """Строки в формате get_all_records, собранные из J:L и кэша User ID."""
+        # gspread не дополняет пустые столбцы в конце диапазона
+        schedule = [(row + ["", "", ""])[:3] for row in self.worksheet.get_values("J2:L")]
+        stale = (time.monotonic() - self.refreshed_at > DAEMON_FULL_REFRESH_SECONDS
+                 or len(schedule) > len(self.user_ids))
+        if not stale:
+            for idx, (_, _, chat_id) in enumerate(schedule):
+                if chat_id and self.user_ids[idx] and str(chat_id) != str(self.user_ids[idx]):
+                    stale = True
+                    break
+        if stale:
+            self.refresh_user_ids()
+        records = []
+        for idx, (next_msg, run_date, chat_id) in enumerate(schedule):
+            user_id = self.user_ids[idx] if idx < len(self.user_ids) else ""
+            records.append({
+                "User ID": user_id,
+                "Next Scheduled Message": next_msg,
+                "Run Date": run_date,
+                "Chat ID": chat_id,
+            })
+        return records
+
+    def run_cycle(self):
+        """Один проход. Возвращает паузу до следующего в секундах."""
+        t0 = time.perf_counter()
+        snapshot_at = time.time()
+        records = self.read_schedule()
+        read_ms = (time.perf_counter() - t0) * 1000
+        now = datetime.now(self.moscow_tz)
+        due = collect_due_rows(records, now, self.moscow_tz)
+        sent = dispatch_due(self.worksheet, due, now, snapshot_at, self.pool, self.limiter) if due else 0
+        dispatch_slo.record_cycle("check_pending", len(records), len(due), sent)
+
+        # Отправленные строки получили следующий шаг, но в records его нет:
+        # проверим их не позже чем через DAEMON_MIN_INTERVAL
+        earliest = earliest_run_date(records, self.moscow_tz)
+        if due or earliest is None:
+            delay = DAEMON_MIN_INTERVAL if due else DAEMON_MAX_INTERVAL
+        else:
+            delay = (earliest - datetime.now(self.moscow_tz)).total_seconds()
+        delay = min(DAEMON_MAX_INTERVAL, max(DAEMON_MIN_INTERVAL, delay))
+
+        self.cycles += 1
+        logger.info(
+            f"🔁 Цикл {self.cycles}: строк {len(records)}, к отправке {len(due)}, отправлено {sent}, "
+            f"чтение {read_ms:.0f} мс, всего {(time.perf_counter() - t0) * 1000:.0f} мс, "
+            f"следующий через {delay:.0f} с"
+        )
+        return delay
+
+    def run(self):
+        t0 = time.perf_counter()
+        if not google_sheets_client and not init_google_sheets(background_refresh=True):
+            return 1
+        sheets_ms = (time.perf_counter() - t0) * 1000
+        self.worksheet = google_sheets_client.worksheet("Users")
+        self.refresh_user_ids()
+        try:
+            recover_stuck_rows(self.worksheet, self.worksheet.get_all_records(),
+                               datetime.now(self.moscow_tz), self.moscow_tz)
+        except Exception as e:
+            logger.error(f"❌ Ошибка восстановления строк в SENDING: {e}")
+        logger.info(f"🚀 Демон запущен: подключение к Sheets {sheets_ms:.0f} мс, "
+                    f"старт {(time.perf_counter() - t0) * 1000:.0f} мс")
+
+        while not self.stop_event.is_set():
+            try:
+                delay = self.run_cycle()
+            except Exception as e:
+                logger.error(f"❌ Ошибка цикла демона: {e}")
+                delay = DAEMON_MAX_INTERVAL
+            report_fake_sheets_usage()
+            export_metrics()
+            self.stop_event.wait(delay)
+
+        self.pool.shutdown(wait=True)
+        report_ledger_stats()
+        logger.info(f"🏁 Демон остановлен после {self.cycles} циклов")
+        return 0
+
+def report_ledger_stats():
+    ledger = send_ledger.get_ledger()
+    if ledger:
+        stats = ledger.stats()
+        logger.info(f"📒 Журнал отправок: записей {stats['entries']}, проверок {stats['checks']}, "
+                    f"дублей {stats['duplicates']} ({stats['hit_rate']:.1%})")
+
+
+def export_metrics():
+    """Записывает метрики (опоздание отправок, строки за цикл) в CHECK_PENDING_METRICS_FILE."""
+    if not METRICS_FILE:
+        return
+    try:
+        metrics.REGISTRY.write_textfile(METRICS_FILE)
+    except OSError as e:
+        logger.warning(f"⚠️ Не удалось записать метрики в {METRICS_FILE}: {e}")
+
+
+def report_fake_sheets_usage():
+    """Для заглушки: печатает расход вызовов и сохраняет снимок таблицы."""
+    if GOOGLE_SHEETS_BACKEND != "fake" or google_sheets_client is None:
+        return
+    logger.info(f"🧪 Вызовы Sheets: {dict(google_sheets_client.calls)} {google_sheets_client.calls_by_kind()}")
+    path = os.getenv("FAKE_SHEETS_PATH")
+    if path:
+        google_sheets_client.save(path)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отправка просроченных сообщений из листа Users")
+    parser.add_argument("--daemon", action="store_true", help="работать постоянно вместо разового запуска по крону")
+    args = parser.parse_args()
+
+    if args.daemon:
+        daemon = PendingDaemon()
+        signal.signal(signal.SIGTERM, daemon.stop)
+        signal.signal(signal.SIGINT, daemon.stop)
+        sys.exit(daemon.run())
+
     if init_google_sheets():
         check_pending_messages()
+        report_ledger_stats()
+        export_metrics()
+        report_fake_sheets_usage()
     logger.info("🏁 Работа Cron-скрипта завершена.")
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Когортный отчет конверсии воронки по листу Stats.
+
+Для еженедельного разбора: конверсия START -> CASE_SENT -> FORM_CONSULTATION
+по дню когорты (первый START пользователя) и источнику входа (обычный
+/start или диплинк, например /start consult). Stats читается постранично
+(STATS_PAGE_ROWS строк за запрос) в колонки NumPy; действия, пользователи и
+детали кодируются категориями, первые события пользователей, когортные
+матрицы и распределения времени до конверсии считаются векторно, поэтому
+миллион строк обрабатывается за секунды.
+
+    python cohort_report.py --output cohort.csv --since 2026-01-01
+    python cohort_report.py --csv stats_export.csv --output cohort.csv
+
+Пишутся два CSV: когорты (cohort.csv) и распределение времени до
+конверсии по источникам (cohort_time_to_convert.csv).
+"""
+
+import os
+import re
+import csv
+import sys
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+
+logger = logging.getLogger("cohort_report")
+
+GOOGLE_SERVICE_ACCOUNT_JSON = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
+GOOGLE_SHEETS_ID = os.getenv("GOOGLE_SHEETS_ID")
+GOOGLE_SHEETS_BACKEND = os.getenv("GOOGLE_SHEETS_BACKEND", "gspread")
+STATS_PAGE_ROWS = int(os.getenv("COHORT_STATS_PAGE_ROWS", "50000"))
+
+START, CASE_SENT, FORM_CONSULTATION = "START", "CASE_SENT", "FORM_CONSULTATION"
+# Шаги распределения времени до конверсии: (название, от, до)
+CONVERSION_STEPS = (
+    ("start_to_case", START, CASE_SENT),
+    ("case_to_form", CASE_SENT, FORM_CONSULTATION),
+    ("start_to_form", START, FORM_CONSULTATION),
+)
+TIME_BUCKETS_HOURS = (0, 1, 6, 24, 72, 168, np.inf)
+NAT = np.datetime64("NaT", "s")
+# Детали START с диплинком: "Запуск бота (deeplink: consult)"
+DEEPLINK_RE = re.compile(r"deeplink:\s*([\w-]+)")
+
+
+def entry_source(details):
+    match = DEEPLINK_RE.search(details or "")
+    return f"deeplink_{match.group(1)}" if match else "organic"
+
+
+# ===== ЗАГРУЗКА =====
+def fetch_stats_rows(worksheet, page_rows=STATS_PAGE_ROWS):
+    """Строки Stats (без заголовка) страницами по page_rows строк."""
+    rows = []
+    start = 2
+    while True:
+        page = worksheet.get_values(f"A{start}:E{start + page_rows - 1}")
+        rows.extend(page)
+        logger.info(f"📥 Stats: строки {start}-{start + len(page) - 1}")
+        if len(page) < page_rows:
+            return rows
+        start += page_rows
+
+
+def read_csv_rows(path):
+    """Строки выгрузки Stats в CSV (те же колонки A:E, заголовок пропускается)."""
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = list(csv.reader(f))
+    if rows and rows[0] and rows[0][0] == "Timestamp":
+        rows = rows[1:]
+    return rows
+
+
+def _parse_timestamps(values):
+    try:
+        return np.array(values, dtype="datetime64[s]")
+    except ValueError:
+        parsed = np.empty(len(values), dtype="datetime64[s]")
+        for i, value in enumerate(values):
+            try:
+                parsed[i] = np.datetime64(value, "s")
+            except ValueError:
+                parsed[i] = NAT
+        return parsed
+
+
+def _column(rows, index):
+    return [row[index] if len(row) > index else "" for row in rows]
+
+
+def _categorical(values):
+    """(имена категорий в порядке появления, коды). Словарь быстрее np.unique: строки не сортируются."""
+    index = {}
+    codes = np.fromiter((index.setdefault(value, len(index)) for value in values), dtype=np.int64, count=len(values))
+    return np.array(list(index), dtype=str), codes
+
+
+class StatsColumns:
+    """Колонки Stats: время и категориальные коды действия, пользователя и деталей."""
+
+    def __init__(self, rows):
+        self.ts = _parse_timestamps(_column(rows, 0))
+        self.user_names, self.user_codes = _categorical(_column(rows, 1))
+        self.action_names, self.action_codes = _categorical(_column(rows, 3))
+        self.detail_names, self.detail_codes = _categorical(_column(rows, 4))
+
+    def __len__(self):
+        return len(self.ts)
+
+    @property
+    def n_users(self):
+        return len(self.user_names)
+
+    def first_event(self, action, not_before=None):
+        """Первое событие action каждого пользователя (не раньше not_before[user]).
+
+        Возвращает (время, номер строки): NaT и -1 у пользователей без события.
+        """
+        times = np.full(self.n_users, NAT)
+        rows = np.full(self.n_users, -1)
+        found = np.flatnonzero(self.action_names == action)
+        if not found.size:
+            return times, rows
+        mask = (self.action_codes == found[0]) & ~np.isnat(self.ts)
+        if not_before is not None:
+            # Сравнение с NaT дает False: у пользователей без начала шага событий нет
+            mask &= self.ts >= not_before[self.user_codes]
+        idx = np.flatnonzero(mask)
+        order = idx[np.lexsort((self.ts[idx], self.user_codes[idx]))]
+        users, first = np.unique(self.user_codes[order], return_index=True)
+        times[users] = self.ts[order[first]]
+        rows[users] = order[first]
+        return times, rows
+
+
+# ===== ОТЧЕТ =====
+def _group_median(group_idx, values, n_groups):
+    """Медиана values по группам (сортировка по группе и значению)."""
+    order = np.lexsort((values, group_idx))
+    values = values[order]
+    counts = np.bincount(group_idx, minlength=n_groups)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    medians = np.full(n_groups, np.nan)
+    present = counts > 0
+    medians[present] = values[offsets[present] + (counts[present] - 1) // 2]
+    return medians
+
+
+def _hours(later, earlier):
+    return (later - earlier).astype("timedelta64[s]").astype(np.float64) / 3600
+
+
+def cohort_report(columns, since=None, until=None):
+    """Когортная матрица и распределения времени до конверсии."""
+    start_time, start_row = columns.first_event(START)
+    case_time, _ = columns.first_event(CASE_SENT, not_before=start_time)
+    form_time, _ = columns.first_event(FORM_CONSULTATION, not_before=start_time)
+
+    sources = np.array([entry_source(details) for details in columns.detail_names], dtype=str)
+    source_names, source_of_detail = np.unique(sources, return_inverse=True)
+
+    users = np.flatnonzero(start_row >= 0)
+    cohort_day = start_time[users].astype("datetime64[D]")
+    keep = np.ones(users.size, dtype=bool)
+    if since:
+        keep &= cohort_day >= np.datetime64(since, "D")
+    if until:
+        keep &= cohort_day <= np.datetime64(until, "D")
+    users, cohort_day = users[keep], cohort_day[keep]
+    user_source = source_of_detail[columns.detail_codes[start_row[users]]]
+
+    day_offset = (cohort_day - cohort_day.min()).astype(np.int64) if users.size else np.zeros(0, np.int64)
+    keys, group_idx = np.unique(day_offset * max(1, len(source_names)) + user_source, return_inverse=True)
+    n_groups = len(keys)
+    has_case = ~np.isnat(case_time[users])
+    has_form = ~np.isnat(form_time[users])
+    starts = np.bincount(group_idx, minlength=n_groups)
+    cases = np.bincount(group_idx, weights=has_case, minlength=n_groups).astype(np.int64)
+    forms = np.bincount(group_idx, weights=has_form, minlength=n_groups).astype(np.int64)
+    forms_after_case = np.bincount(group_idx, weights=has_case & has_form, minlength=n_groups).astype(np.int64)
+    hours_to_case = _hours(case_time[users], start_time[users])
+    hours_to_form = _hours(form_time[users], start_time[users])
+
+    first_of_group = np.unique(group_idx, return_index=True)[1]
+    cohorts = {
+        "cohort_day": cohort_day[first_of_group].astype(str),
+        "source": source_names[user_source[first_of_group]],
+        "starts": starts,
+        "case_sent": cases,
+        "form_consultation": forms,
+        "start_to_case": np.round(cases / np.maximum(starts, 1), 4),
+        "case_to_form": np.round(forms_after_case / np.maximum(cases, 1), 4),
+        "start_to_form": np.round(forms / np.maximum(starts, 1), 4),
+        "median_hours_to_case": np.round(_group_median(group_idx[has_case], hours_to_case[has_case], n_groups), 2),
+        "median_hours_to_form": np.round(_group_median(group_idx[has_form], hours_to_form[has_form], n_groups), 2),
+    }
+
+    step_times = {START: start_time[users], CASE_SENT: case_time[users], FORM_CONSULTATION: form_time[users]}
+    distributions = []
+    for step, frm, to in CONVERSION_STEPS:
+        converted = ~np.isnat(step_times[frm]) & (step_times[to] >= step_times[frm])
+        hours = _hours(step_times[to][converted], step_times[frm][converted])
+        step_source = user_source[converted]
+        for code, source in enumerate(source_names):
+            counts, _ = np.histogram(hours[step_source == code], bins=TIME_BUCKETS_HOURS)
+            total = counts.sum()
+            for low, high, count in zip(TIME_BUCKETS_HOURS[:-1], TIME_BUCKETS_HOURS[1:], counts):
+                distributions.append({
+                    "step": step,
+                    "source": source,
+                    "hours_from": low,
+                    "hours_to": "" if np.isinf(high) else high,
+                    "users": int(count),
+                    "share": round(count / total, 4) if total else 0.0,
+                })
+    return cohorts, distributions
+
+
+def write_cohorts_csv(path, cohorts):
+    names = list(cohorts)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(names)
+        writer.writerows(zip(*(cohorts[name].tolist() for name in names)))
+
+
+def write_distribution_csv(path, distributions):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=["step", "source", "hours_from", "hours_to", "users", "share"])
+        writer.writeheader()
+        writer.writerows(distributions)
+
+
+# ===== ПОДКЛЮЧЕНИЕ =====
+def open_stats_worksheet():
+    if GOOGLE_SHEETS_BACKEND == "fake":
+        import fake_sheets
+        return fake_sheets.from_env().worksheet("Stats")
+
+    import token_cache
+
+    clean_json = (GOOGLE_SERVICE_ACCOUNT_JSON or "").strip().strip("'").strip('"')
+    if not clean_json:
+        raise SystemExit("❌ GOOGLE_SERVICE_ACCOUNT_JSON не найден в переменных окружения")
+    client = token_cache.authorize(json.loads(clean_json))
+    return client.open_by_key(GOOGLE_SHEETS_ID).worksheet("Stats")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Когортный отчет START -> CASE_SENT -> FORM_CONSULTATION")
+    parser.add_argument("--csv", default="", help="выгрузка Stats в CSV вместо чтения таблицы")
+    parser.add_argument("--output", default="cohort.csv", help="CSV когорт")
+    parser.add_argument("--since", default="", help="первый день когорты (YYYY-MM-DD)")
+    parser.add_argument("--until", default="", help="последний день когорты (YYYY-MM-DD)")
+    parser.add_argument("--page-rows", type=int, default=STATS_PAGE_ROWS, help="строк Stats за один запрос")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    started = time.perf_counter()
+    rows = read_csv_rows(args.csv) if args.csv else fetch_stats_rows(open_stats_worksheet(), args.page_rows)
+    loaded = time.perf_counter()
+    columns = StatsColumns(rows)
+    cohorts, distributions = cohort_report(columns, args.since or None, args.until or None)
+    computed = time.perf_counter()
+
+    write_cohorts_csv(args.output, cohorts)
+    base, ext = os.path.splitext(args.output)
+    distribution_path = f"{base}_time_to_convert{ext or '.csv'}"
+    write_distribution_csv(distribution_path, distributions)
+    logger.info(
+        f"✅ {len(columns)} строк Stats, {columns.n_users} пользователей, {len(cohorts['starts'])} когорт: "
+        f"загрузка {loaded - started:.2f} с, расчет {computed - loaded:.2f} с -> {args.output}, {distribution_path}"
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
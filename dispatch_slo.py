@@ -0,0 +1,83 @@
+"""
+SLO опоздания дожимов и циклов диспетчеров.
+
+Для каждой отправки дожима записывается опоздание относительно планового
+Run Date (гистограмма ai2biz_funnel_send_lag_seconds), для каждого цикла
+диспетчера (FollowUpScheduler, check_pending.py) - сколько строк прочитано,
+просрочено и отправлено (ai2biz_dispatch_cycle_rows).
+
+p95 опоздания считается по последним SEND_LAG_WINDOW отправкам; если он
+выше SEND_LAG_P95_THRESHOLD секунд, в лог пишется предупреждение (не чаще
+раза в SEND_LAG_WARN_INTERVAL секунд).
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SEND_LAG_P95_THRESHOLD_SECONDS = float(os.getenv("SEND_LAG_P95_THRESHOLD", "120"))
+SEND_LAG_WINDOW = int(os.getenv("SEND_LAG_WINDOW", "500"))
+SEND_LAG_WARN_INTERVAL_SECONDS = float(os.getenv("SEND_LAG_WARN_INTERVAL", "300"))
+# Меньше отправок - p95 ничего не говорит
+MIN_SAMPLES = 20
+
+
+class SendLagTracker:
+    def __init__(self, threshold=SEND_LAG_P95_THRESHOLD_SECONDS, window=SEND_LAG_WINDOW,
+                 warn_interval=SEND_LAG_WARN_INTERVAL_SECONDS):
+        self.threshold = threshold
+        self.warn_interval = warn_interval
+        self.lags = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.warned_at = None
+
+    def record(self, message_key, lag):
+        metrics.FUNNEL_SEND_LAG.observe(lag, message_key=message_key)
+        with self.lock:
+            self.lags.append(lag)
+
+    def p95(self):
+        with self.lock:
+            if len(self.lags) < MIN_SAMPLES:
+                return None
+            ordered = sorted(self.lags)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def check(self):
+        """Предупреждает, если p95 опоздания выше порога. Возвращает p95 (или None)."""
+        p95 = self.p95()
+        if p95 is None or p95 <= self.threshold:
+            return p95
+        now = time.monotonic()
+        with self.lock:
+            if self.warned_at is not None and now - self.warned_at < self.warn_interval:
+                return p95
+            self.warned_at = now
+        logger.warning(
+            f"⚠️ p95 опоздания дожимов {p95:.0f} с выше порога {self.threshold:.0f} с "
+            f"(последние {len(self.lags)} отправок)"
+        )
+        return p95
+
+
+tracker = SendLagTracker()
+metrics.SEND_LAG_P95.set_function(lambda: {(): tracker.p95() or 0.0})
+
+
+def record_send(message_key, lag):
+    """Опоздание одной отправки в секундах."""
+    tracker.record(message_key, max(0.0, lag))
+
+
+def record_cycle(dispatcher, scanned, due, sent):
+    """Итог цикла диспетчера; заодно проверяет SLO опоздания."""
+    metrics.DISPATCH_CYCLE_ROWS.observe(scanned, dispatcher=dispatcher, stage="scanned")
+    metrics.DISPATCH_CYCLE_ROWS.observe(due, dispatcher=dispatcher, stage="due")
+    metrics.DISPATCH_CYCLE_ROWS.observe(sent, dispatcher=dispatcher, stage="sent")
+    tracker.check()
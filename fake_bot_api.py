@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+Заглушка Telegram Bot API для бенчмарков и нагрузочных прогонов.
+Отвечает правдоподобными объектами Message без обращения к api.telegram.org.
+
+Два режима подключения:
+- в процессе: FakeBotAPI().install() через apihelper.CUSTOM_REQUEST_SENDER;
+- отдельный HTTP-сервер: python fake_bot_api.py --port 8081, а боту
+  TELEGRAM_API_URL=http://127.0.0.1:8081/bot{0}/{1}.
+
+Задержка задается распределением (fixed/uniform/exp/lognormal), ошибки
+429 с retry_after и 403 "bot was blocked by the user" - долей запросов.
+"""
+
+import sys
+import json
+import math
+import time
+import zlib
+import random
+import logging
+import argparse
+import threading
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger("fake_bot_api")
+
+# Методы, которые шлют что-то в чат (на них действуют 429 и 403)
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument", "editMessageText"}
+
+
+class LatencyModel:
+    """Распределение задержки ответа: fixed:50, uniform:20:200, exp:80, lognormal:80:0.6 (мс)."""
+
+    def __init__(self, spec="fixed:0"):
+        parts = str(spec).split(":")
+        self.kind = parts[0]
+        self.params = [float(p) for p in parts[1:]] or [0.0]
+        if self.kind not in ("fixed", "uniform", "exp", "lognormal"):
+            raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+    def sample_ms(self):
+        if self.kind == "uniform":
+            low, high = (self.params + [self.params[0]])[:2]
+            return random.uniform(low, high)
+        if self.kind == "exp":
+            return random.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+        if self.kind == "lognormal":
+            median = self.params[0]
+            sigma = self.params[1] if len(self.params) > 1 else 0.5
+            return random.lognormvariate(math.log(median), sigma) if median > 0 else 0.0
+        return self.params[0]
+
+
+class FakeResponse:
+    """Минимальный аналог requests.Response, который читает telebot."""
+
+    def __init__(self, payload, status_code=200):
+        self.status_code = status_code
+        self.text = json.dumps(payload, ensure_ascii=False)
+        self._payload = payload
+        self.reason = "OK" if status_code == 200 else "Error"
+
+    def json(self):
+        return self._payload
+
+
+class FakeBotAPI:
+    """Эмулирует методы Bot API, которые использует бот, и считает вызовы."""
+
+    def __init__(self, latency_ms=0, bot_id=100500, latency=None,
+                 rate_limit_rate=0.0, retry_after=5, blocked_rate=0.0):
+        self.latency = LatencyModel(latency) if latency else LatencyModel(f"fixed:{latency_ms}")
+        self.bot_id = bot_id
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.blocked_rate = blocked_rate
+        self.calls = Counter()
+        self.errors = Counter()
+        # Успешные отправки по chat_id (для поиска дублей)
+        self.deliveries = Counter()
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._file_seq = 0
+        # Входящие апдейты для getUpdates (режим polling)
+        self._updates = []
+        self._updates_ready = threading.Condition(self._lock)
+
+    # ===== СЧЕТЧИКИ =====
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+            self.deliveries.clear()
+
+    def duplicate_deliveries(self, per_chat=1):
+        """Сколько отправок сверх per_chat на чат (дубли, если каждый чат ждал per_chat сообщений)."""
+        return sum(n - per_chat for n in self.deliveries.values() if n > per_chat)
+
+    def push_updates(self, updates):
+        """Ставит апдейты (JSON) в очередь, которую отдает getUpdates."""
+        with self._updates_ready:
+            self._updates.extend(updates)
+            self._updates_ready.notify_all()
+
+    def _get_updates(self, params):
+        """Как в Bot API: offset подтверждает все апдейты до него, timeout - ожидание long polling."""
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._updates_ready:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._updates_ready.wait(remaining)
+            return self._updates[:limit]
+
+    def is_blocked(self, chat_id):
+        """Стабильно для chat_id: одни и те же пользователи всегда "заблокировали" бота."""
+        if not self.blocked_rate:
+            return False
+        return zlib.crc32(str(chat_id).encode()) % 10_000 < self.blocked_rate * 10_000
+
+    def _next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _file_id(self, kind):
+        with self._lock:
+            self._file_seq += 1
+            seq = self._file_seq
+        return f"{kind}_{seq:08d}_{random.getrandbits(32):08x}", f"u{seq:08d}"
+
+    # ===== ПОСТРОЕНИЕ ОТВЕТОВ =====
+    def _message(self, params, **extra):
+        chat_id = params.get("chat_id", 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        message = {
+            "message_id": self._next_message_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": self.bot_id, "is_bot": True, "first_name": "AI2BIZ", "username": "ai2biz_bot"},
+        }
+        message.update(extra)
+        return message
+
+    def _photo(self):
+        file_id, unique_id = self._file_id("photo")
+        return [{"file_id": file_id, "file_unique_id": unique_id, "width": 1280, "height": 720, "file_size": 120000}]
+
+    def _document(self, source):
+        if isinstance(source, str) and not source.startswith("http"):
+            file_id, unique_id = source, f"u_{source[-8:]}"
+        else:
+            file_id, unique_id = self._file_id("document")
+        file_name = str(source).rsplit("/", 1)[-1].split("?")[0] or "file.pdf"
+        return {"file_id": file_id, "file_unique_id": unique_id, "file_name": file_name,
+                "mime_type": "application/pdf", "file_size": 250000}
+
+    def result_for(self, method_name, params):
+        """Возвращает поле result ответа Bot API для метода."""
+        params = params or {}
+        if method_name == "sendMessage":
+            return self._message(params, text=params.get("text", ""))
+        if method_name == "sendPhoto":
+            extra = {"photo": self._photo()}
+            if params.get("caption"):
+                extra["caption"] = params["caption"]
+            return self._message(params, **extra)
+        if method_name == "sendDocument":
+            extra = {"document": self._document(params.get("document"))}
+            if params.get("caption"):
+                extra["caption"] = params["caption"]
+            return self._message(params, **extra)
+        if method_name == "sendMediaGroup":
+            media = params.get("media") or "[]"
+            items = json.loads(media) if isinstance(media, str) else media
+            group_id = str(random.getrandbits(48))
+            return [self._message(params, photo=self._photo(), media_group_id=group_id) for _ in items]
+        if method_name == "editMessageText":
+            message = self._message(params, text=params.get("text", ""))
+            if params.get("message_id"):
+                message["message_id"] = int(params["message_id"])
+            return message
+        if method_name == "getMe":
+            return {"id": self.bot_id, "is_bot": True, "first_name": "AI2BIZ", "username": "ai2biz_bot"}
+        if method_name == "getUpdates":
+            return self._get_updates(params)
+        # deleteMessage, answerCallbackQuery, setWebhook и прочие
+        return True
+
+    def _error(self, code, description, **parameters):
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        with self._lock:
+            self.errors[code] += 1
+        return code, body
+
+    def handle(self, method_name, params):
+        """Обрабатывает вызов и возвращает (HTTP статус, тело ответа)."""
+        with self._lock:
+            self.calls[method_name] += 1
+        delay_ms = self.latency.sample_ms()
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+        if method_name in SEND_METHODS:
+            if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+                return self._error(429, f"Too Many Requests: retry after {self.retry_after}",
+                                   retry_after=self.retry_after)
+            if self.is_blocked(params.get("chat_id")):
+                return self._error(403, "Forbidden: bot was blocked by the user")
+            with self._lock:
+                self.deliveries[str(params.get("chat_id"))] += 1
+        return 200, {"ok": True, "result": self.result_for(method_name, params)}
+
+    # ===== ПОДКЛЮЧЕНИЕ К TELEBOT =====
+    def request_sender(self, method, request_url, params=None, files=None, timeout=None, proxies=None):
+        method_name = request_url.rstrip("/").rsplit("/", 1)[-1]
+        status_code, payload = self.handle(method_name, dict(params or {}))
+        return FakeResponse(payload, status_code)
+
+    def install(self):
+        """Направляет все запросы telebot в эту заглушку."""
+        from telebot import apihelper
+        apihelper.CUSTOM_REQUEST_SENDER = self.request_sender
+        return self
+
+    @staticmethod
+    def uninstall():
+        from telebot import apihelper
+        apihelper.CUSTOM_REQUEST_SENDER = None
+
+
+# ===== HTTP-СЕРВЕР =====
+def _parse_multipart(content_type, body):
+    message = BytesParser(policy=HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+    )
+    params = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if not name:
+            continue
+        if part.get_filename():
+            params[name] = part.get_filename()
+        else:
+            params[name] = part.get_content().strip() if part.get_content_maintype() == "text" \
+                else part.get_payload(decode=True).decode("utf-8", "replace")
+    return params
+
+
+def make_handler(api):
+    class BotAPIHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _params(self):
+            url = urlsplit(self.path)
+            params = dict(parse_qsl(url.query, keep_blank_values=True))
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            content_type = self.headers.get("Content-Type", "")
+            if body and content_type.startswith("multipart/form-data"):
+                params.update(_parse_multipart(content_type, body))
+            elif body and content_type.startswith("application/json"):
+                params.update(json.loads(body))
+            elif body:
+                params.update(parse_qsl(body.decode("utf-8"), keep_blank_values=True))
+            return url.path, params
+
+        def _dispatch(self):
+            path, params = self._params()
+            # /bot<token>/<method>
+            parts = path.strip("/").split("/")
+            if len(parts) != 2 or not parts[0].startswith("bot"):
+                status, payload = 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+            else:
+                status, payload = api.handle(parts[1], params)
+            data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = _dispatch
+        do_POST = _dispatch
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return BotAPIHandler
+
+
+def serve(api, host="127.0.0.1", port=8081):
+    """Запускает HTTP-сервер в фоновом потоке и возвращает его."""
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="fake-bot-api", daemon=True)
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальная заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", default="fixed:0", help="fixed:50 | uniform:20:200 | exp:80 | lognormal:80:0.6")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=5)
+    parser.add_argument("--blocked", type=float, default=0.0, help="доля пользователей, заблокировавших бота (403)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    api = FakeBotAPI(latency=args.latency, rate_limit_rate=args.rate_limit,
+                     retry_after=args.retry_after, blocked_rate=args.blocked)
+    server = serve(api, args.host, args.port)
+    logger.info(f"🧪 Fake Bot API: http://{args.host}:{args.port}/bot{{0}}/{{1}}")
+    try:
+        while True:
+            time.sleep(30)
+            logger.info(f"📊 Вызовы: {dict(api.calls)} ошибки: {dict(api.errors)}")
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,372 @@
+"""
+In-memory замена gspread Spreadsheet/Worksheet для бенчмарков и локальных прогонов.
+Поддерживает методы, которые использует бот, считает вызовы по типам,
+добавляет искусственную задержку и эмулирует квоту Sheets API (60 запросов
+на чтение и 60 на запись в минуту) ответами 429.
+
+Подключение: GOOGLE_SHEETS_BACKEND=fake для main.py и check_pending.py,
+либо передать FakeSpreadsheet в FollowUpScheduler(google_sheets=...).
+"""
+
+import os
+import json
+import time
+import random
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from gspread.cell import Cell
+from gspread.exceptions import APIError, WorksheetNotFound
+from gspread.utils import a1_to_rowcol, numericise
+
+# Какие вызовы Sheets API тратят квоту на чтение, а какие - на запись
+READ_OPERATIONS = {"worksheet", "worksheets", "find", "row_values", "get_values", "get_all_values", "get_all_records"}
+WRITE_OPERATIONS = {"add_worksheet", "update_cell", "update", "batch_update", "append_row", "append_rows"}
+
+USERS_HEADERS = [
+    "User ID", "Username", "Name", "Started",
+    "Last Action", "State", "Lead Quality", "Answers", "Messages Sent",
+    "Next Scheduled Message", "Run Date", "Chat ID",
+    "Last Sent Message", "Last Sent At", "Last Send Status"
+]
+
+
+class CallBudgetExceeded(AssertionError):
+    pass
+
+
+class _ErrorResponse:
+    """Ответ с ошибкой в том виде, в котором его разбирает gspread.exceptions.APIError."""
+
+    def __init__(self, code, message, status):
+        self.status_code = code
+        self._payload = {"error": {"code": code, "message": message, "status": status}}
+        self.text = json.dumps(self._payload)
+
+    def json(self):
+        return self._payload
+
+
+class _QuotaResponse(_ErrorResponse):
+    """Ответ 429 при превышении квоты."""
+
+    def __init__(self, kind, limit):
+        super().__init__(
+            429,
+            f"Quota exceeded for quota metric '{kind.title()} requests' "
+            f"and limit '{kind.title()} requests per minute per user' ({limit})",
+            "RESOURCE_EXHAUSTED",
+        )
+
+
+class FakeSpreadsheet:
+    """Таблица в памяти. Все листы делят счетчики вызовов, задержку и квоту."""
+
+    def __init__(self, latency_ms=0, latency_jitter_ms=0, quota_per_minute=None, clock=time.monotonic):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.quota_per_minute = quota_per_minute
+        self.clock = clock
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.lock = threading.RLock()
+        self._worksheets = {}
+        self._windows = {"read": deque(), "write": deque()}
+
+    def _check_quota(self, kind):
+        if not self.quota_per_minute:
+            return True
+        now = self.clock()
+        window = self._windows[kind]
+        while window and now - window[0] >= 60:
+            window.popleft()
+        if len(window) >= self.quota_per_minute:
+            return False
+        window.append(now)
+        return True
+
+    def _call(self, operation):
+        kind = "write" if operation in WRITE_OPERATIONS else "read"
+        with self.lock:
+            self.calls[operation] += 1
+            allowed = self._check_quota(kind)
+            if not allowed:
+                self.throttled[operation] += 1
+        latency = self.latency_ms
+        if self.latency_jitter_ms:
+            latency += random.uniform(0, self.latency_jitter_ms)
+        if latency:
+            time.sleep(latency / 1000)
+        if not allowed:
+            raise APIError(_QuotaResponse(kind, self.quota_per_minute))
+
+    # ===== УЧЕТ ВЫЗОВОВ =====
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def calls_by_kind(self):
+        with self.lock:
+            reads = sum(n for op, n in self.calls.items() if op not in WRITE_OPERATIONS)
+            writes = sum(n for op, n in self.calls.items() if op in WRITE_OPERATIONS)
+        return {"read": reads, "write": writes, "throttled": sum(self.throttled.values())}
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled.clear()
+            for window in self._windows.values():
+                window.clear()
+
+    @contextmanager
+    def budget(self, max_calls, operations=None):
+        """Проверяет, что блок уложился в max_calls вызовов (опционально - только operations)."""
+        def used():
+            return sum(n for op, n in self.calls.items() if operations is None or op in operations)
+
+        before = Counter(self.calls)
+        start = used()
+        yield
+        spent = used() - start
+        if spent > max_calls:
+            delta = {op: n - before.get(op, 0) for op, n in self.calls.items() if n != before.get(op, 0)}
+            raise CallBudgetExceeded(f"Sheets вызовов: {spent} > {max_calls}: {delta}")
+
+    # ===== СНИМОК НА ДИСК =====
+    def save(self, path):
+        with self.lock:
+            data = {title: ws._rows for title, ws in self._worksheets.items()}
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    def load(self, path):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with self.lock:
+            for title, rows in data.items():
+                self.create_worksheet(title, rows=rows)
+        return self
+
+    def worksheet(self, title):
+        self._call("worksheet")
+        try:
+            return self._worksheets[title]
+        except KeyError:
+            raise WorksheetNotFound(title)
+
+    def worksheets(self):
+        self._call("worksheets")
+        return list(self._worksheets.values())
+
+    def add_worksheet(self, title, rows=1000, cols=26, **kwargs):
+        self._call("add_worksheet")
+        with self.lock:
+            if title in self._worksheets:
+                raise APIError(_ErrorResponse(
+                    400, f'Invalid requests[0].addSheet: A sheet with the name "{title}" already exists.',
+                    "INVALID_ARGUMENT",
+                ))
+            return self.create_worksheet(title)
+
+    def create_worksheet(self, title, headers=None, rows=None):
+        """Создает лист без учета вызова (для подготовки данных)."""
+        worksheet = FakeWorksheet(self, title)
+        if headers:
+            worksheet._rows.append([str(h) for h in headers])
+        for row in rows or []:
+            worksheet._rows.append(["" if v is None else str(v) for v in row])
+        worksheet._key_index = None
+        self._worksheets[title] = worksheet
+        return worksheet
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self._rows = []
+        # Индекс первого столбца (User ID) для быстрого find(in_column=1)
+        self._key_index = None
+
+    # ===== ВНУТРЕННИЕ ХЕЛПЕРЫ =====
+    def _key_row(self, query):
+        if self._key_index is None:
+            self._key_index = {}
+            for row_idx, cells in enumerate(self._rows, start=1):
+                if cells:
+                    self._key_index.setdefault(cells[0], row_idx)
+        return self._key_index.get(query)
+
+    def _set(self, row, col, value):
+        if col == 1:
+            self._key_index = None
+        while len(self._rows) < row:
+            self._rows.append([])
+        cells = self._rows[row - 1]
+        while len(cells) < col:
+            cells.append("")
+        cells[col - 1] = "" if value is None else str(value)
+
+    def _write_range(self, range_name, values):
+        start = range_name.split(":")[0]
+        if "!" in start:
+            start = start.split("!")[1]
+        start_row, start_col = a1_to_rowcol(start)
+        for r_offset, row_values in enumerate(values):
+            for c_offset, value in enumerate(row_values):
+                self._set(start_row + r_offset, start_col + c_offset, value)
+
+    @property
+    def row_count(self):
+        return len(self._rows)
+
+    # ===== API gspread =====
+    def find(self, query, in_row=None, in_column=None, case_sensitive=True):
+        self.spreadsheet._call("find")
+        query = str(query)
+        with self.spreadsheet.lock:
+            if in_column == 1 and in_row is None and case_sensitive:
+                row_idx = self._key_row(query)
+                return Cell(row_idx, 1, query) if row_idx else None
+            for row_idx, cells in enumerate(self._rows, start=1):
+                if in_row is not None and row_idx != in_row:
+                    continue
+                for col_idx, value in enumerate(cells, start=1):
+                    if in_column is not None and col_idx != in_column:
+                        continue
+                    if value == query or (not case_sensitive and value.lower() == query.lower()):
+                        return Cell(row_idx, col_idx, value)
+        return None
+
+    def update_cell(self, row, col, value):
+        self.spreadsheet._call("update_cell")
+        with self.spreadsheet.lock:
+            self._set(row, col, value)
+
+    def update(self, range_name=None, values=None, **kwargs):
+        self.spreadsheet._call("update")
+        with self.spreadsheet.lock:
+            self._write_range(range_name, values or [])
+
+    def batch_update(self, data, **kwargs):
+        self.spreadsheet._call("batch_update")
+        with self.spreadsheet.lock:
+            for item in data:
+                self._write_range(item["range"], item["values"])
+
+    def append_row(self, values, **kwargs):
+        self.spreadsheet._call("append_row")
+        with self.spreadsheet.lock:
+            cells = ["" if v is None else str(v) for v in values]
+            self._rows.append(cells)
+            if self._key_index is not None and cells:
+                self._key_index.setdefault(cells[0], len(self._rows))
+
+    def append_rows(self, values, **kwargs):
+        self.spreadsheet._call("append_rows")
+        with self.spreadsheet.lock:
+            first = len(self._rows) + 1
+            for row_values in values:
+                cells = ["" if v is None else str(v) for v in row_values]
+                self._rows.append(cells)
+                if self._key_index is not None and cells:
+                    self._key_index.setdefault(cells[0], len(self._rows))
+            return {"updates": {"updatedRange": f"{self.title}!A{first}:A{len(self._rows)}",
+                                "updatedRows": len(values)}}
+
+    def row_values(self, row, **kwargs):
+        self.spreadsheet._call("row_values")
+        with self.spreadsheet.lock:
+            cells = list(self._rows[row - 1]) if row <= len(self._rows) else []
+        while cells and cells[-1] == "":
+            cells.pop()
+        return cells
+
+    def get_values(self, range_name=None, **kwargs):
+        """Прямоугольный диапазон вида "J2:L" или "A2:A15" (без range_name - весь лист)."""
+        if range_name is None:
+            return self.get_all_values()
+        self.spreadsheet._call("get_values")
+        start, _, end = range_name.split("!")[-1].partition(":")
+        start_row, start_col = a1_to_rowcol(start)
+        end = end or start
+        if any(ch.isdigit() for ch in end):
+            end_row, end_col = a1_to_rowcol(end)
+        else:
+            end_row, end_col = None, a1_to_rowcol(end + "1")[1]
+        with self.spreadsheet.lock:
+            rows = self._rows[start_row - 1:end_row]
+            values = [[cells[c - 1] if c <= len(cells) else "" for c in range(start_col, end_col + 1)]
+                      for cells in rows]
+        while values and not any(values[-1]):
+            values.pop()
+        return values
+
+    def batch_get(self, ranges, **kwargs):
+        """Несколько диапазонов за один вызов (как gspread: список значений на каждый диапазон)."""
+        self.spreadsheet._call("batch_get")
+        values = []
+        for range_name in ranges:
+            start, _, end = range_name.split("!")[-1].partition(":")
+            start_row, start_col = a1_to_rowcol(start)
+            end_row, end_col = a1_to_rowcol(end or start)
+            with self.spreadsheet.lock:
+                rows = self._rows[start_row - 1:end_row]
+                block = [[cells[c - 1] if c <= len(cells) else "" for c in range(start_col, end_col + 1)]
+                         for cells in rows]
+            # Sheets API не возвращает пустые хвосты строк и пустые строки в конце
+            block = [row[:max((i + 1 for i, v in enumerate(row) if v != ""), default=0)] for row in block]
+            while block and not block[-1]:
+                block.pop()
+            values.append(block)
+        return values
+
+    def get_all_values(self, **kwargs):
+        self.spreadsheet._call("get_all_values")
+        with self.spreadsheet.lock:
+            return [list(cells) for cells in self._rows]
+
+    def get_all_records(self, **kwargs):
+        self.spreadsheet._call("get_all_records")
+        with self.spreadsheet.lock:
+            if not self._rows:
+                return []
+            headers = self._rows[0]
+            records = []
+            for cells in self._rows[1:]:
+                record = {}
+                for col_idx, header in enumerate(headers):
+                    value = cells[col_idx] if col_idx < len(cells) else ""
+                    record[header] = numericise(value, default_blank="")
+                records.append(record)
+            return records
+
+
+def build_bot_spreadsheet(latency_ms=0, users_rows=None):
+    """Таблица со всеми листами, которые создает и использует бот."""
+    spreadsheet = FakeSpreadsheet(latency_ms=latency_ms)
+    spreadsheet.create_worksheet("Users", headers=USERS_HEADERS, rows=users_rows)
+    spreadsheet.create_worksheet("Stats", headers=["Timestamp", "User ID", "Name", "Action", "Details"])
+    spreadsheet.create_worksheet("Leads Files")
+    spreadsheet.create_worksheet("Leads Consultation")
+    spreadsheet.create_worksheet("Form Answers")
+    return spreadsheet
+
+
+def from_env():
+    """Таблица для GOOGLE_SHEETS_BACKEND=fake с настройками из окружения.
+
+    FAKE_SHEETS_LATENCY_MS, FAKE_SHEETS_JITTER_MS - задержка каждого вызова;
+    FAKE_SHEETS_QUOTA_PER_MINUTE - квота (0 - без квоты, по умолчанию 60);
+    FAKE_SHEETS_PATH - JSON-снимок, общий для бота и check_pending.py.
+    """
+    quota = int(os.getenv("FAKE_SHEETS_QUOTA_PER_MINUTE", "60"))
+    path = os.getenv("FAKE_SHEETS_PATH", "")
+    if path and os.path.exists(path):
+        spreadsheet = FakeSpreadsheet().load(path)
+    else:
+        spreadsheet = build_bot_spreadsheet()
+    spreadsheet.latency_ms = float(os.getenv("FAKE_SHEETS_LATENCY_MS", "0"))
+    spreadsheet.latency_jitter_ms = float(os.getenv("FAKE_SHEETS_JITTER_MS", "0"))
+    spreadsheet.quota_per_minute = quota or None
+    return spreadsheet
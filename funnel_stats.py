@@ -0,0 +1,192 @@
+"""
+Живые счетчики воронки по часам.
+
+Сейчас воронка видна только по сырым строкам листа Stats, и любой отчет
+выгружает лист целиком. Здесь события считаются в момент, когда
+происходят, в почасовые корзины:
+- action:<ACTION>           - действия log_action (START, CASE_SENT, FORM_CONSULTATION, ...);
+- sent:<message_key>        - отправленные сообщения MESSAGES;
+- form:<форма>:<сегмент>    - заполненные анкеты по сегменту _calc_segment
+                              (диагностика - по качеству лида).
+
+События копятся в памяти процесса и раз в FUNNEL_STATS_FLUSH_SECONDS
+прибавляются к общей таблице SQLite FUNNEL_STATS_PATH (UPSERT по часу и
+событию, как журнал в send_ledger.py). Все воркеры gunicorn пишут в одну
+таблицу, поэтому /stats (админ) и GET /funnel-stats в любом воркере видят
+сумму по всем, и ничего не теряется при рестарте. Корзины старше
+FUNNEL_STATS_RETENTION_HOURS удаляются. Без FUNNEL_STATS_PATH счетчики
+живут только в памяти процесса.
+"""
+
+import os
+import sqlite3
+import logging
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+FUNNEL_STATS_PATH = os.getenv("FUNNEL_STATS_PATH", "funnel_stats.sqlite3")
+FUNNEL_STATS_FLUSH_SECONDS = float(os.getenv("FUNNEL_STATS_FLUSH_SECONDS", "10"))
+FUNNEL_STATS_RETENTION_HOURS = int(os.getenv("FUNNEL_STATS_RETENTION_HOURS", str(24 * 30)))
+HOUR_FORMAT = "%Y-%m-%d %H"
+
+
+class FunnelStats:
+    def __init__(self, path=FUNNEL_STATS_PATH, retention_hours=FUNNEL_STATS_RETENTION_HOURS, clock=datetime.now):
+        self.path = path
+        self.retention_hours = retention_hours
+        self.clock = clock
+        self.lock = threading.Lock()
+        # "YYYY-MM-DD HH" -> Counter событий за час, еще не записанных в SQLite
+        self.buckets = {}
+        self._stop = threading.Event()
+        self.conn = None
+
+    def _connection(self):
+        """Общая таблица; файл открывается при первой записи или чтении, а не при импорте. Под self.lock."""
+        if self.conn is None and self.path:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS funnel_events ("
+                " hour TEXT NOT NULL, event TEXT NOT NULL, count INTEGER NOT NULL,"
+                " PRIMARY KEY (hour, event))"
+            )
+        return self.conn
+
+    def record(self, event, amount=1):
+        hour = self.clock().strftime(HOUR_FORMAT)
+        with self.lock:
+            bucket = self.buckets.get(hour)
+            if bucket is None:
+                bucket = self.buckets[hour] = Counter()
+                if not self.path:
+                    self._prune_locked()
+            bucket[event] += amount
+
+    def _cutoff(self):
+        return (self.clock() - timedelta(hours=self.retention_hours)).strftime(HOUR_FORMAT)
+
+    def _prune_locked(self):
+        cutoff = self._cutoff()
+        for hour in [h for h in self.buckets if h < cutoff]:
+            del self.buckets[hour]
+
+    def summary(self, hours=24):
+        """Итоги и почасовой ряд за последние hours часов (0 - за все хранимое время)."""
+        cutoff = (self.clock() - timedelta(hours=hours - 1)).strftime(HOUR_FORMAT) if hours else ""
+        merged = {}
+        with self.lock:
+            conn = self._connection()
+            if conn is not None:
+                for hour, event, count in conn.execute(
+                    "SELECT hour, event, count FROM funnel_events WHERE hour >= ?", (cutoff,)
+                ):
+                    merged.setdefault(hour, Counter())[event] += count
+            for hour, counts in self.buckets.items():
+                if hour >= cutoff:
+                    merged.setdefault(hour, Counter()).update(counts)
+        totals = Counter()
+        series = {}
+        for hour in sorted(merged):
+            totals.update(merged[hour])
+            series[hour] = dict(merged[hour])
+        return {"hours": hours, "totals": dict(totals), "by_hour": series}
+
+    # ===== ОБЩАЯ ТАБЛИЦА =====
+    def flush(self):
+        """Прибавляет накопленные события к таблице SQLite. Возвращает число записанных пар (час, событие)."""
+        if not self.path:
+            return 0
+        with self.lock:
+            rows = [(hour, event, count) for hour, counts in self.buckets.items() for event, count in counts.items()]
+            if not rows:
+                return 0
+            try:
+                self._connection()
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.conn.executemany(
+                    "INSERT INTO funnel_events VALUES (?, ?, ?) "
+                    "ON CONFLICT (hour, event) DO UPDATE SET count = count + excluded.count",
+                    rows,
+                )
+                self.conn.execute("DELETE FROM funnel_events WHERE hour < ?", (self._cutoff(),))
+                self.conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                if self.conn is not None and self.conn.in_transaction:
+                    self.conn.execute("ROLLBACK")
+                # События остаются в памяти и уйдут со следующей записью
+                logger.warning(f"⚠️ Не удалось записать статистику воронки в {self.path}: {e}")
+                return 0
+            self.buckets.clear()
+            return len(rows)
+
+    def start_flushing(self, interval=FUNNEL_STATS_FLUSH_SECONDS):
+        """Запускает фоновую запись событий в общую таблицу."""
+        def loop():
+            while not self._stop.wait(interval):
+                self.flush()
+
+        thread = threading.Thread(target=loop, name="funnel-stats", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+
+stats = FunnelStats()
+
+
+def record(event, amount=1):
+    stats.record(event, amount)
+
+
+def record_action(action):
+    record(f"action:{action}")
+
+
+def record_sent(message_key):
+    record(f"sent:{message_key}")
+
+
+def record_form(form, segment):
+    record(f"form:{form}:{segment}")
+
+
+def summary(hours=24):
+    return stats.summary(hours)
+
+
+def _grouped(totals, kind):
+    prefix = f"{kind}:"
+    return sorted((event[len(prefix):], count) for event, count in totals.items() if event.startswith(prefix))
+
+
+def format_report(hours=24):
+    """Текст для админской команды /stats."""
+    totals = stats.summary(hours)["totals"]
+    period = f"за {hours} ч" if hours else "за все время"
+    lines = [f"📈 Воронка {period}", ""]
+    actions = dict(_grouped(totals, "action"))
+    lines.append(f"🚀 Старты: {actions.get('START', 0)}")
+    lines.append(f"📞 Заявки на консультацию: {actions.get('FORM_CONSULTATION', 0)}")
+    downloads = [(action, count) for action, count in actions.items() if action.endswith("_SENT")]
+    if downloads:
+        lines.append("")
+        lines.append("📚 Файлы:")
+        lines.extend(f"• {action}: {count}" for action, count in sorted(downloads))
+    sent = _grouped(totals, "sent")
+    if sent:
+        lines.append("")
+        lines.append("✉️ Сообщения воронки:")
+        lines.extend(f"• {key}: {count}" for key, count in sent)
+    forms = _grouped(totals, "form")
+    if forms:
+        lines.append("")
+        lines.append("📝 Анкеты по сегментам:")
+        lines.extend(f"• {key}: {count}" for key, count in forms)
+    return "\n".join(lines)
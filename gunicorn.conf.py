@@ -0,0 +1,12 @@
+"""
+Настройки gunicorn: gunicorn main:app читает этот файл из текущего каталога.
+
+Фоновые потоки бота (bootstrap_subsystems, запись счетчиков воронки)
+запускаются в каждом воркере после fork, а не при импорте main.
+"""
+
+
+def post_worker_init(worker):
+    import main
+
+    main.start_background()
@@ -0,0 +1,163 @@
+"""
+Общий HTTP-транспорт для Telegram Bot API и Google Sheets.
+
+По умолчанию telebot держит отдельную requests.Session на каждый поток, а
+gspread - свою AuthorizedSession, поэтому параллельные хендлеры и задачи
+FollowUpScheduler открывают новые TLS-соединения гораздо чаще, чем нужно.
+Здесь у каждого API одна сессия с keep-alive пулом на HTTP_POOL_SIZE
+соединений (по умолчанию - потоки webhook плюс потоки FollowUpScheduler)
+и свои таймауты.
+
+Каждое новое соединение (TCP + TLS) замеряется. Переиспользованные
+соединения - это запросы минус новые соединения, а сэкономленное на
+рукопожатиях время - переиспользования, умноженные на среднее время
+установки соединения. Все это отдается в метрике ai2biz_http_pool и в /ready.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import Counter
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _default_pool_size():
+    # В API параллельно ходят потоки хендлеров webhook и задачи FollowUpScheduler
+    return int(os.getenv("ASYNC_WEBHOOK_WORKERS", "32")) + int(os.getenv("SCHEDULER_WORKERS", "10"))
+
+
+HTTP_POOL_ENABLED = os.getenv("HTTP_POOL_ENABLED", "1") not in ("0", "false", "False")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "0")) or _default_pool_size()
+TELEGRAM_CONNECT_TIMEOUT = float(os.getenv("TELEGRAM_CONNECT_TIMEOUT", "5"))
+TELEGRAM_READ_TIMEOUT = float(os.getenv("TELEGRAM_READ_TIMEOUT", "30"))
+SHEETS_CONNECT_TIMEOUT = float(os.getenv("SHEETS_CONNECT_TIMEOUT", "5"))
+SHEETS_READ_TIMEOUT = float(os.getenv("SHEETS_READ_TIMEOUT", "60"))
+
+
+class ConnectionStats:
+    """Запросы и новые соединения по API."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.created = Counter()
+        self.connect_seconds = Counter()
+
+    def record_request(self, api):
+        with self.lock:
+            self.requests[api] += 1
+
+    def record_connect(self, api, seconds):
+        metrics.HTTP_CONNECT_LATENCY.observe(seconds, api=api)
+        with self.lock:
+            self.created[api] += 1
+            self.connect_seconds[api] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            result = {}
+            for api in sorted(set(self.requests) | set(self.created)):
+                created = self.created[api]
+                reused = max(0, self.requests[api] - created)
+                connect_avg = self.connect_seconds[api] / created if created else 0.0
+                result[api] = {
+                    "requests": self.requests[api],
+                    "created": created,
+                    "reused": reused,
+                    "connect_ms_avg": round(connect_avg * 1000, 1),
+                    "saved_seconds": round(reused * connect_avg, 3),
+                }
+            return result
+
+    def metric_samples(self):
+        return {(api, stat): value for api, stats in self.snapshot().items() for stat, value in stats.items()}
+
+
+STATS = ConnectionStats()
+metrics.HTTP_POOL.set_function(STATS.metric_samples)
+
+
+def _pool_classes(api):
+    """Классы пулов urllib3, соединения которых замеряют установку (TCP + TLS)."""
+
+    class TimedConnectMixin:
+        def connect(self):
+            started = time.perf_counter()
+            super().connect()
+            STATS.record_connect(api, time.perf_counter() - started)
+
+    class TimedHTTPConnection(TimedConnectMixin, HTTPConnection):
+        pass
+
+    class TimedHTTPSConnection(TimedConnectMixin, HTTPSConnection):
+        pass
+
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    return {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter с keep-alive пулом на pool_size соединений и таймаутом по умолчанию."""
+
+    def __init__(self, api, pool_size=HTTP_POOL_SIZE, timeout=None):
+        self.api = api
+        self.timeout = timeout
+        super().__init__(pool_connections=4, pool_maxsize=pool_size)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = _pool_classes(self.api)
+
+    def send(self, request, timeout=None, **kwargs):
+        STATS.record_request(self.api)
+        return super().send(request, timeout=timeout if timeout is not None else self.timeout, **kwargs)
+
+
+def mount(session, api, pool_size=HTTP_POOL_SIZE, timeout=None):
+    adapter = PooledAdapter(api, pool_size, timeout)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def install_telegram():
+    """Одна сессия с пулом на все потоки telebot вместо сессии на поток."""
+    from telebot import apihelper
+
+    apihelper.CONNECT_TIMEOUT = TELEGRAM_CONNECT_TIMEOUT
+    apihelper.READ_TIMEOUT = TELEGRAM_READ_TIMEOUT
+    if not HTTP_POOL_ENABLED or getattr(apihelper.session, "_ai2biz_pooled", False):
+        return
+    # _get_req_session отдает каждому потоку apihelper.session, если она задана
+    session = mount(requests.Session(), "telegram")
+    session._ai2biz_pooled = True
+    apihelper.session = session
+    logger.info(f"🔌 Telegram: общий пул на {HTTP_POOL_SIZE} соединений")
+
+
+def sheets_session(credentials):
+    """AuthorizedSession для gspread с пулом и таймаутами Sheets (None - сессия gspread по умолчанию)."""
+    if not HTTP_POOL_ENABLED:
+        return None
+    from google.auth.transport.requests import AuthorizedSession
+
+    return mount(AuthorizedSession(credentials), "sheets",
+                 timeout=(SHEETS_CONNECT_TIMEOUT, SHEETS_READ_TIMEOUT))
+
+
+def stats():
+    return STATS.snapshot()
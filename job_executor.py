@@ -0,0 +1,136 @@
+"""
+Ограниченный исполнитель задач FollowUpScheduler.
+
+Стандартный пул APScheduler (10 потоков) принимает задачи в неограниченную
+очередь: при всплеске задачи отправки с блокирующими вызовами Sheets
+копятся в ней, опаздывают дальше misfire_grace_time и молча пропускаются.
+
+Здесь число потоков (SCHEDULER_WORKERS) и длина очереди
+(SCHEDULER_QUEUE_SIZE) ограничены. Разовая задача, не поместившаяся в
+очередь, не теряется: она переносится на SCHEDULER_DEFER_SECONDS секунд
+вперед с тем же id. Выполняющиеся и ждущие задачи и переносы видны в
+статистике исполнителя.
+"""
+
+import os
+import time
+import logging
+import threading
+import concurrent.futures
+from datetime import datetime, timedelta
+
+import pytz
+from apscheduler.executors.base import BaseExecutor, run_job
+from apscheduler.jobstores.base import ConflictingIdError
+from apscheduler.triggers.date import DateTrigger
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "10"))
+SCHEDULER_QUEUE_SIZE = int(os.getenv("SCHEDULER_QUEUE_SIZE", "200"))
+SCHEDULER_DEFER_SECONDS = float(os.getenv("SCHEDULER_DEFER_SECONDS", "30"))
+
+
+class BoundedThreadPoolExecutor(BaseExecutor):
+    """Пул потоков APScheduler с ограниченной очередью и переносом лишних задач.
+
+    on_defer(job) вызывается для каждой перенесенной задачи (для метрик).
+    """
+
+    def __init__(self, max_workers=SCHEDULER_WORKERS, queue_size=SCHEDULER_QUEUE_SIZE,
+                 defer_seconds=SCHEDULER_DEFER_SECONDS, on_defer=None):
+        super().__init__()
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.defer_seconds = defer_seconds
+        self.on_defer = on_defer
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="scheduler-job")
+        self._state_lock = threading.Lock()
+        self._queued = {}   # job_id -> время постановки в очередь
+        self._running = {}  # job_id -> время начала выполнения
+        self.deferred_total = 0
+
+    def submit_job(self, job, run_times):
+        with self._state_lock:
+            full = len(self._queued) >= self.queue_size
+            if not full:
+                self._queued[job.id] = time.monotonic()
+        if full:
+            # Мимо BaseExecutor.submit_job: перенесенная задача не должна числиться запущенной
+            self._defer(job)
+            return
+        try:
+            super().submit_job(job, run_times)
+        except BaseException:
+            with self._state_lock:
+                self._queued.pop(job.id, None)
+            raise
+
+    def _do_submit_job(self, job, run_times):
+        def run():
+            with self._state_lock:
+                self._queued.pop(job.id, None)
+                self._running[job.id] = time.monotonic()
+            try:
+                return run_job(job, job._jobstore_alias, run_times, self._logger.name)
+            finally:
+                with self._state_lock:
+                    self._running.pop(job.id, None)
+
+        def callback(future):
+            exc = future.exception()
+            if exc:
+                self._run_job_error(job.id, exc, exc.__traceback__)
+            else:
+                self._run_job_success(job.id, future.result())
+
+        self._pool.submit(run).add_done_callback(callback)
+
+    def _defer(self, job):
+        """Переносит разовую задачу вперед; у периодической просто пропускается этот запуск."""
+        with self._state_lock:
+            self.deferred_total += 1
+        if self.on_defer:
+            self.on_defer(job)
+        if not isinstance(job.trigger, DateTrigger):
+            logger.warning(f"⚠️ Очередь задач заполнена, запуск {job.id} пропущен")
+            return
+        run_date = datetime.now(pytz.utc) + timedelta(seconds=self.defer_seconds)
+
+        def resubmit():
+            # Планировщик удаляет отработавшую разовую задачу уже после submit_job:
+            # добавляем ее заново из отдельного потока, когда он отпустит хранилище
+            try:
+                self._scheduler.add_job(
+                    job.func, trigger=DateTrigger(run_date=run_date), args=job.args, kwargs=job.kwargs,
+                    id=job.id, misfire_grace_time=job.misfire_grace_time, coalesce=job.coalesce,
+                )
+            except ConflictingIdError:
+                pass  # Задачу уже перепланировали с новым временем
+            except Exception as e:
+                logger.error(f"❌ Не удалось перенести задачу {job.id}: {e}")
+
+        threading.Thread(target=resubmit, name="scheduler-defer", daemon=True).start()
+        logger.warning(f"⚠️ Очередь задач заполнена, {job.id} перенесена на {self.defer_seconds:g} с")
+
+    def stats(self):
+        with self._state_lock:
+            return {
+                "workers": self.max_workers,
+                "running": len(self._running),
+                "queued": len(self._queued),
+                "queue_limit": self.queue_size,
+                "deferred_total": self.deferred_total,
+            }
+
+    def jobs(self):
+        """Идентификаторы выполняющихся и ждущих задач с временем ожидания/выполнения в секундах."""
+        now = time.monotonic()
+        with self._state_lock:
+            return {
+                "running": {job_id: round(now - t, 3) for job_id, t in self._running.items()},
+                "queued": {job_id: round(now - t, 3) for job_id, t in self._queued.items()},
+            }
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait)
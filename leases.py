@@ -0,0 +1,238 @@
+"""
+Аренда шардов для параллельных диспетчеров листа Users.
+
+Строки делятся на DISPATCH_SHARDS шардов по crc32(User ID). Диспетчер
+(FollowUpScheduler в боте, check_pending.py) отправляет сообщения шарда
+только пока держит его аренду: захватывает несколько шардов, обрабатывает
+их, освобождает и берет следующие. Несколько экземпляров делят шарды между
+собой, поэтому пропускная способность растет с их числом.
+
+Хранилища аренды (DISPATCH_LEASES, по умолчанию off - аренды нет):
+- "file" - JSON-файл под fcntl.flock (несколько процессов на одной машине,
+  бенчмарки). Захват атомарный;
+- "sheet" - лист "Dispatch Leases" в той же таблице (общий для бота и
+  крона на разных хостах). Только для распределения нагрузки: сравнения-
+  и-записи в Sheets нет, захват лишь перепроверяется повторным чтением
+  через DISPATCH_LEASE_SETTLE_SECONDS, и два диспетчера все же могут
+  получить один шард. Каждый захват - это чтение, запись, пауза и еще
+  одно чтение листа, а сам лист создается при первом захвате.
+
+Аренда - не защита от повторной отправки, а способ поделить строки. От
+дублей защищает журнал отправок (send_ledger.py) и захват строк в листе
+Users. Аренда лишь сокращает число столкновений:
+- после истечения аренды (минус LEASE_SAFETY_SECONDS) отправка прекращается;
+- шард не выдается, если его освободили (или аренда истекла) позже, чем
+  диспетчер прочитал лист: его снимок мог устареть, шард достанется
+  следующему циклу со свежим чтением.
+"""
+
+import os
+import json
+import time
+import zlib
+import fcntl
+import socket
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+
+import send_ledger
+
+logger = logging.getLogger(__name__)
+
+# off | file | sheet (sheet - без гарантий, см. выше)
+DISPATCH_LEASES = os.getenv("DISPATCH_LEASES", "off")
+DISPATCH_SHARDS = int(os.getenv("DISPATCH_SHARDS", "4"))
+DISPATCH_SHARDS_PER_CLAIM = int(os.getenv("DISPATCH_SHARDS_PER_CLAIM", "2"))
+LEASE_TTL_SECONDS = float(os.getenv("DISPATCH_LEASE_TTL", "120"))
+LEASE_SETTLE_SECONDS = float(os.getenv("DISPATCH_LEASE_SETTLE_SECONDS", "0.5"))
+LEASE_FILE_PATH = os.getenv("DISPATCH_LEASE_FILE", "dispatch_leases.json")
+# Запас до истечения аренды, после которого новые отправки не начинаются
+LEASE_SAFETY_SECONDS = 10
+
+LEASES_SHEET = "Dispatch Leases"
+LEASES_HEADERS = ["Shard", "Owner", "Expires At", "Released At"]
+
+
+def shard_of(user_id, shards=DISPATCH_SHARDS):
+    """Номер шарда пользователя (стабилен между процессами, в отличие от hash())."""
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+def make_owner(role):
+    return f"{socket.gethostname()}:{os.getpid()}:{role}"
+
+
+def _claimable(lease, snapshot_at):
+    """Шард свободен и не менялся после снимка листа.
+
+    Для активной аренды момент последнего изменения - ее истечение (до него
+    владелец мог отправлять), для освобожденной - время освобождения.
+    """
+    if not lease or (not lease.get("owner") and not lease.get("released_at")):
+        return True
+    last_change = lease.get("expires_at", 0.0) if lease.get("owner") else lease.get("released_at", 0.0)
+    return last_change <= snapshot_at
+
+
+class FileLeaseStore:
+    """Аренды в JSON-файле; каждая операция выполняется под эксклюзивным flock."""
+
+    def __init__(self, path=LEASE_FILE_PATH):
+        self.path = path
+
+    @contextmanager
+    def _locked(self):
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, "r") as f:
+                        leases = json.load(f)
+                except (OSError, ValueError):
+                    leases = {}
+                yield leases
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(leases, f)
+                os.replace(tmp_path, self.path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def claim(self, owner, shards, limit, ttl, snapshot_at):
+        now = time.time()
+        claimed = []
+        with self._locked() as leases:
+            for shard in shards:
+                if len(claimed) >= limit:
+                    break
+                if _claimable(leases.get(str(shard)), snapshot_at):
+                    leases[str(shard)] = {"owner": owner, "expires_at": now + ttl, "released_at": 0.0}
+                    claimed.append(shard)
+        return claimed
+
+    def release(self, owner, shards):
+        now = time.time()
+        with self._locked() as leases:
+            for shard in shards:
+                lease = leases.get(str(shard))
+                if lease and lease.get("owner") == owner:
+                    leases[str(shard)] = {"owner": "", "expires_at": 0.0, "released_at": now}
+
+
+class SheetLeaseStore:
+    """Аренды на листе "Dispatch Leases": шард N в строке N + 2.
+
+    Без сравнения-и-записи: захват best-effort, один шард могут получить два диспетчера.
+    """
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self._worksheet = None
+
+    def worksheet(self):
+        if self._worksheet is None:
+            try:
+                self._worksheet = self.spreadsheet.worksheet(LEASES_SHEET)
+            except Exception:
+                try:
+                    worksheet = self.spreadsheet.add_worksheet(LEASES_SHEET, 100, len(LEASES_HEADERS))
+                    worksheet.append_row(LEASES_HEADERS)
+                except Exception:
+                    # Лист одновременно создал другой диспетчер
+                    worksheet = self.spreadsheet.worksheet(LEASES_SHEET)
+                self._worksheet = worksheet
+        return self._worksheet
+
+    def _read(self):
+        leases = {}
+        for row in self.worksheet().get_all_values()[1:]:
+            row = (row + ["", "", "", ""])[:4]
+            try:
+                leases[int(row[0])] = {
+                    "owner": row[1],
+                    "expires_at": float(row[2] or 0),
+                    "released_at": float(row[3] or 0),
+                }
+            except ValueError:
+                continue
+        return leases
+
+    def claim(self, owner, shards, limit, ttl, snapshot_at):
+        leases = self._read()
+        candidates = [s for s in shards if _claimable(leases.get(s), snapshot_at)][:limit]
+        if not candidates:
+            return []
+        expires_at = time.time() + ttl
+        self.worksheet().batch_update([
+            {"range": f"A{shard + 2}:D{shard + 2}", "values": [[shard, owner, f"{expires_at:.3f}", "0"]]}
+            for shard in candidates
+        ])
+        # Параллельный диспетчер мог записать себя в те же строки - побеждает последняя запись
+        if LEASE_SETTLE_SECONDS:
+            time.sleep(LEASE_SETTLE_SECONDS)
+        leases = self._read()
+        return [shard for shard in candidates if leases.get(shard, {}).get("owner") == owner]
+
+    def release(self, owner, shards):
+        # Истекшую аренду мог перехватить другой диспетчер - ее не трогаем
+        leases = self._read()
+        owned = [shard for shard in shards if leases.get(shard, {}).get("owner") == owner]
+        if not owned:
+            return
+        now = f"{time.time():.3f}"
+        self.worksheet().batch_update([
+            {"range": f"A{shard + 2}:D{shard + 2}", "values": [[shard, "", "0", now]]}
+            for shard in owned
+        ])
+
+
+def from_env(spreadsheet=None):
+    """Хранилище аренды по DISPATCH_LEASES (None - аренда отключена)."""
+    if DISPATCH_LEASES == "file":
+        return FileLeaseStore()
+    if DISPATCH_LEASES == "sheet" and spreadsheet is not None:
+        if not send_ledger.SEND_LEDGER_ENABLED:
+            logger.warning("⚠️ DISPATCH_LEASES=sheet без журнала отправок: аренда на листе не исключает "
+                           "двойного захвата шарда, дубли возможны")
+        return SheetLeaseStore(spreadsheet)
+    return None
+
+
+def run_sharded(store, owner, items, user_id_of, process, snapshot_at):
+    """Обрабатывает items по шардам под арендой.
+
+    process(batch, deadline) получает элементы захваченных шардов и должен
+    прекратить отправку, когда time.monotonic() >= deadline. Шарды, которые
+    не удалось захватить, остаются на следующий цикл. Возвращает число
+    обработанных элементов.
+    """
+    by_shard = defaultdict(list)
+    for item in items:
+        by_shard[shard_of(user_id_of(item))].append(item)
+
+    pending = sorted(by_shard)
+    processed = 0
+    while pending:
+        try:
+            claimed = store.claim(owner, pending, DISPATCH_SHARDS_PER_CLAIM, LEASE_TTL_SECONDS, snapshot_at)
+        except Exception as e:
+            logger.error(f"❌ Не удалось захватить шарды: {e}")
+            break
+        if not claimed:
+            break
+        deadline = time.monotonic() + LEASE_TTL_SECONDS - LEASE_SAFETY_SECONDS
+        try:
+            batch = [item for shard in claimed for item in by_shard[shard]]
+            process(batch, deadline)
+            processed += len(batch)
+        finally:
+            try:
+                store.release(owner, claimed)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось освободить шарды {claimed}: {e}")
+        pending = [shard for shard in pending if shard not in claimed]
+
+    if pending:
+        logger.info(f"🔒 Шарды {pending} заняты другим диспетчером, остаются на следующий цикл")
+    return processed
@@ -13,19 +13,34 @@ import os
 import re
 import telebot
 import json
+import time
+import hashlib
 import logging
+import threading
+from collections import deque
 from datetime import datetime, timedelta
-from flask import Flask, request
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.date import DateTrigger
 import pytz
 from messages import MESSAGES, FOLLOW_UP_PLAN
 from scheduler_manager import FollowUpScheduler
+import metrics
+import tracing
+import send_ledger
+import outbound
+import polling
+import update_dedup
+import http_transport
+import funnel_stats
+import users_mirror
+import sheet_writes
 
 # Попытка импортировать gspread (опционально)
 try:
     import gspread
+    import token_cache
     GSPREAD_AVAILABLE = True
 except ImportError:
     GSPREAD_AVAILABLE = False
@@ -46,8 +61,12 @@ GOOGLE_SHEETS_ID = os.getenv(
     "GOOGLE_SHEETS_ID", "1Rmmb8W-1wD4C5I_zPrH_LFaCOnuQ4ny833iba8sAR_I"
 )
 GOOGLE_SERVICE_ACCOUNT_JSON = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON", "{}")
+# gspread - настоящая таблица, fake - in-memory заглушка из fake_sheets.py
+GOOGLE_SHEETS_BACKEND = os.getenv("GOOGLE_SHEETS_BACKEND", "gspread")
 ZOOM_LINK = os.getenv("ZOOM_LINK", "https://zoom.us/YOUR_ZOOM_LINK")
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
+# webhook (Flask / async_server.py) или polling (getUpdates, только python main.py)
+UPDATE_MODE = os.getenv("UPDATE_MODE", "webhook")
 CHANNEL_NAME = "it_ai2biz"
 CHANNEL_ID = int(os.getenv("CHANNEL_ID", "0"))
 
@@ -111,12 +130,14 @@ def save_file_cache():
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения кэша: {e}")
 
+@tracing.traced()
 def send_cached_document(chat_id, file_url, caption=None, parse_mode=None):
     """
     Отправляет документ, используя кэшированный file_id если есть.
     Если нет - отправляет по URL и сохраняет file_id.
     """
     file_id = FILE_CACHE.get(file_url)
+    metrics.FILE_CACHE_TOTAL.inc(result="hit" if file_id else "miss")
     sent_msg = None
     
     # 1. Пробуем отправить по file_id
@@ -147,12 +168,25 @@ def send_cached_document(chat_id, file_url, caption=None, parse_mode=None):
         logger.error(f"❌ Ошибка отправки документа по URL: {e}")
         return None
 
+# Альтернативный адрес Bot API (например, локальная заглушка fake_bot_api.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+
 bot = telebot.TeleBot(TOKEN, threaded=False)
 app = Flask(__name__)
+metrics.instrument_telegram()
+# Очередь по полосам ставится снаружи: латентность Telegram не включает ожидание
+outbound.install()
+http_transport.install_telegram()
 
 # ===== ИНИЦИАЛИЗАЦИЯ GOOGLE SHEETS =====
 def init_google_sheets():
     """Инициализирует подключение к Google Sheets."""
+    if GOOGLE_SHEETS_BACKEND == "fake":
+        import fake_sheets
+        print("🧪 Google Sheets: используется in-memory заглушка (GOOGLE_SHEETS_BACKEND=fake)")
+        return sheet_writes.attach(users_mirror.attach(metrics.instrument_spreadsheet(fake_sheets.from_env())))
     if not GSPREAD_AVAILABLE:
         print("ℹ️ gspread не установлен. Google Sheets функции отключены.")
         return None
@@ -162,8 +196,9 @@ def init_google_sheets():
             return None
         # Парсим JSON с учетными данными сервиса
         creds_dict = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
-        # Авторизуемся через service_account
-        client = gspread.service_account_from_dict(creds_dict)
+        # Авторизуемся через service_account (токен берется из кэша на диске, если еще действует)
+        client = token_cache.authorize(creds_dict)
+        token_cache.start_background_refresh(client, creds_dict)
         # Открываем таблицу по ID
         sheet = client.open_by_key(GOOGLE_SHEETS_ID)
         print("✅ Google Sheets подключена успешно!")
@@ -196,12 +231,14 @@ def init_google_sheets():
             except Exception:
                 pass
         
-        return sheet
+        return sheet_writes.attach(users_mirror.attach(metrics.instrument_spreadsheet(sheet)))
     except Exception as e:
         print(f"❌ Ошибка подключения к Google Sheets: {e}")
         return None
 
-google_sheets = init_google_sheets()
+# Google Sheets и scheduler поднимаются в фоне (см. bootstrap_subsystems),
+# чтобы gunicorn не ждал OAuth и open_by_key перед приемом запросов
+google_sheets = None
 
 # Словари для состояния пользователей (СНАЧАЛА определяем их!)
 user_data = {}
@@ -210,10 +247,8 @@ user_message_history = {}
 welcome_message_ids = {}
 form_answers = {}  # Для формы диагностики
 
-# Инициализация scheduler для дожимов (ПОСЛЕ определения user_data)
-scheduler = FollowUpScheduler(bot, user_data, google_sheets)
-scheduler.start()
-logger.info("✅ Scheduler для дожимов запущен")
+# Scheduler для дожимов создается в bootstrap_subsystems (ПОСЛЕ подключения таблицы)
+scheduler = None
 
 # ===== ВАЛИДАЦИЯ =====
 def is_valid_email(email):
@@ -255,18 +290,26 @@ def is_valid_business(text):
     text = text.strip()
     return len(text) >= 10 and contains_letters(text)
 
+@tracing.traced()
 def safe_send_message(chat_id, text, **kwargs):
-    """Безопасно отправляет сообщение."""
+    """Безопасно отправляет сообщение.
+
+    Повторяет отправку только если сообщение точно не ушло: после таймаута
+    чтения ответа оно могло дойти, и повтор дал бы дубль.
+    """
     try:
         return bot.send_message(chat_id, text, **kwargs)
     except Exception as e:
         logger.error(f"Ошибка отправки сообщения: {e}")
+        if not send_ledger.definitely_not_delivered(e):
+            return None
         try:
             return bot.send_message(chat_id, text, **kwargs)
         except Exception:
             return None
 
 # ===== GOOGLE SHEETS ФУНКЦИИ =====
+@tracing.traced()
 def save_to_google_sheets(sheet_name, row_data):
     """Сохраняет строку в Google Sheets."""
     if not google_sheets:
@@ -285,6 +328,7 @@ def save_to_google_sheets(sheet_name, row_data):
         logger.error(f"❌ Ошибка сохранения: {e}")
         return False
 
+@tracing.traced()
 def create_or_update_user(user_id, username, first_name, action="", state="", chat_id=None):
     """Создает или обновляет запись пользователя в Google Sheets."""
     if not google_sheets:
@@ -336,6 +380,7 @@ def create_or_update_user(user_id, username, first_name, action="", state="", ch
         logger.error(f"❌ Ошибка создания/обновления пользователя: {e}")
         return False
 
+@tracing.traced()
 def update_user_action(user_id, action):
     """Обновляет последнее действие пользователя."""
     if scheduler:
@@ -361,6 +406,7 @@ def log_action(user_id, name, action, details=""):
     """Логирует действие в лист Stats."""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     logger.info(f"[{timestamp}] {action} | {name} ({user_id})")
+    funnel_stats.record_action(action)
     row_data = [timestamp, str(user_id), name, action, details]
     save_to_google_sheets("Stats", row_data)
 
@@ -392,6 +438,7 @@ def save_lead_files(user_id, lead_data):
         segment,
     ]
     save_to_google_sheets("Leads Files", row_data)
+    funnel_stats.record_form("files", segment)
 
 def save_lead_consultation(user_id, lead_data):
     """Сохраняет лид консультации."""
@@ -412,6 +459,7 @@ def save_lead_consultation(user_id, lead_data):
         segment,
     ]
     save_to_google_sheets("Leads Consultation", row_data)
+    funnel_stats.record_form("consultation", segment)
 
 def save_form_answers(user_id, answers):
     """Сохраняет ответы формы диагностики."""
@@ -469,6 +517,38 @@ def get_all_registered_users():
         logger.error(f"❌ Ошибка получения списка пользователей: {e}")
         return []
 
+def run_broadcast(chat_id, message_id, broadcast_text):
+    """Рассылка /broadcast_all всем пользователям из таблицы, итог - админу в chat_id."""
+    users = get_all_registered_users()
+    bot.edit_message_text(f"⏳ Рассылка запущена для {len(users)} пользователей...", chat_id=chat_id, message_id=message_id)
+
+    success_count = 0
+    fail_count = 0
+    skipped_count = 0
+    # Повторное подтверждение той же рассылки в тот же день не дублирует сообщения
+    ledger = send_ledger.get_ledger()
+    broadcast_key = "broadcast_" + hashlib.sha1(broadcast_text.encode("utf-8")).hexdigest()[:12]
+    broadcast_day = datetime.now().strftime("%Y-%m-%d")
+    # Рассылка идет в самой низкой полосе и не задерживает ответы пользователям
+    with outbound.lane("broadcast"):
+        for uid in users:
+            if ledger and not ledger.begin(uid, broadcast_key, broadcast_day):
+                skipped_count += 1
+                continue
+            try:
+                bot.send_message(uid, broadcast_text, parse_mode="HTML")
+                success_count += 1
+                if ledger:
+                    ledger.finish(uid, broadcast_key, broadcast_day)
+            except Exception as e:
+                logger.warning(f"❌ Ошибка отправки пользователю {uid}: {e}")
+                fail_count += 1
+                if ledger:
+                    ledger.finish(uid, broadcast_key, broadcast_day, error=e)
+
+    bot.send_message(chat_id, f"🏁 *Рассылка завершена!*\n\n✅ Успешно: {success_count}\n❌ Ошибок: {fail_count}\n⏭ Уже получили: {skipped_count}", parse_mode="Markdown")
+
+@tracing.traced()
 def notify_admin_consultation(lead_data):
     """Отправляет уведомление администратору."""
     if ADMIN_CHAT_ID == 0:
@@ -521,6 +601,7 @@ def delete_messages_after_welcome(chat_id, user_id):
             pass
     user_message_history[user_id] = [welcome_msg_id]
 
+@tracing.traced()
 def reset_user_state(user_id, resume=True):
     """Очищает состояние пользователя."""
     user_data.pop(user_id, None)
@@ -611,20 +692,163 @@ def build_inline_keyboard(buttons_config):
             markup.add(*keyboard_row)
     return markup
 
+# ===== ФОНОВАЯ ИНИЦИАЛИЗАЦИЯ =====
+BOOT_STARTED_AT = time.perf_counter()
+PENDING_UPDATES_LIMIT = int(os.getenv("PENDING_UPDATES_LIMIT", "1000"))
+
+# Статусы: pending -> ready / disabled / failed
+subsystem_status = {
+    "google_sheets": {"status": "pending", "init_ms": None, "error": None},
+    "scheduler": {"status": "pending", "init_ms": None, "error": None},
+}
+bootstrap_info = {"ready": False, "cold_start_ms": None}
+pending_updates = deque()
+pending_updates_lock = threading.Lock()
+
+def _init_subsystem(name, init_func):
+    """Запускает инициализацию подсистемы и фиксирует ее статус и время."""
+    started = time.perf_counter()
+    try:
+        result = init_func()
+        subsystem_status[name]["status"] = "ready" if result else "disabled"
+        return result
+    except Exception as e:
+        logger.error(f"❌ Ошибка инициализации {name}: {e}")
+        subsystem_status[name]["status"] = "failed"
+        subsystem_status[name]["error"] = str(e)
+        return None
+    finally:
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        subsystem_status[name]["init_ms"] = elapsed_ms
+        logger.info(f"⏱ {name}: {subsystem_status[name]['status']} за {elapsed_ms} мс")
+
+def _start_scheduler():
+    """Создает и запускает FollowUpScheduler поверх уже подключенной таблицы."""
+    follow_up_scheduler = FollowUpScheduler(bot, user_data, google_sheets)
+    follow_up_scheduler.recovery_callback = recovery_handler
+    follow_up_scheduler.start()
+    metrics.SCHEDULER_JOBS.set_function(follow_up_scheduler.job_counts)
+    metrics.SCHEDULER_EXECUTOR.set_function(follow_up_scheduler.executor_stats)
+    metrics.SEND_LEDGER.set_function(send_ledger.stats)
+    logger.info("✅ Scheduler для дожимов запущен")
+    return follow_up_scheduler
+
+def _drain_pending_updates():
+    """Обрабатывает апдейты, принятые до готовности подсистем, и открывает прием."""
+    processed = 0
+    while True:
+        with pending_updates_lock:
+            if not pending_updates:
+                bootstrap_info["ready"] = True
+                break
+            batch = list(pending_updates)
+            pending_updates.clear()
+        try:
+            with outbound.lane("interactive"):
+                bot.process_new_updates(batch)
+        except Exception as e:
+            logger.error(f"Ошибка обработки отложенных апдейтов: {e}")
+        processed += len(batch)
+    if processed:
+        logger.info(f"📨 Обработано отложенных апдейтов: {processed}")
+
+def bootstrap_subsystems():
+    """Подключает Google Sheets и scheduler в фоне, затем разбирает очередь апдейтов."""
+    global google_sheets, scheduler
+    google_sheets = _init_subsystem("google_sheets", init_google_sheets)
+    scheduler = _init_subsystem("scheduler", _start_scheduler)
+    _drain_pending_updates()
+    bootstrap_info["cold_start_ms"] = round((time.perf_counter() - BOOT_STARTED_AT) * 1000, 1)
+    logger.info(f"🚀 Холодный старт завершен за {bootstrap_info['cold_start_ms']} мс")
+
+def start_bootstrap():
+    """Запускает bootstrap_subsystems в фоновом потоке."""
+    thread = threading.Thread(target=bootstrap_subsystems, name="bootstrap", daemon=True)
+    thread.start()
+    return thread
+
 # ===== WEBHOOK =====
 @app.route("/telegram-webhook", methods=["POST"])
 def webhook():
     try:
         json_data = request.get_json()
+    except Exception as e:
+        logger.error(f"Ошибка webhook: {e}")
+        return "ERROR", 400
+    return handle_webhook_update(json_data)
+
+def handle_webhook_update(json_data):
+    """Обработка апдейта. Общая для Flask, async_server.py и polling.py; возвращает (тело, статус)."""
+    update_id = json_data.get("update_id") if isinstance(json_data, dict) else None
+    if update_id is not None and not update_dedup.claim(update_id):
+        # Повторная доставка: апдейт уже обработан или обрабатывается
+        logger.info(f"♻️ Повтор апдейта {update_id} пропущен")
+        return "OK", 200
+    with metrics.WEBHOOK_LATENCY.time(), tracing.start_trace("webhook"):
+        body, status = _process_webhook(json_data)
+    if update_id is not None:
+        if status == 200:
+            update_dedup.finish(update_id)
+        else:
+            update_dedup.release(update_id)
+    return body, status
+
+def _process_webhook(json_data):
+    try:
         if json_data:
             update = telebot.types.Update.de_json(json_data)
-            bot.process_new_updates([update])
+            tracing.set_attribute("update_id", update.update_id)
+            with pending_updates_lock:
+                if not bootstrap_info["ready"]:
+                    # Подсистемы еще поднимаются: откладываем апдейт до готовности
+                    if len(pending_updates) >= PENDING_UPDATES_LIMIT:
+                        logger.warning("⚠️ Очередь отложенных апдейтов переполнена")
+                        return "NOT READY", 503
+                    pending_updates.append(update)
+                    return "OK", 200
+            with outbound.lane("interactive"):
+                bot.process_new_updates([update])
         return "OK", 200
     except Exception as e:
         logger.error(f"Ошибка webhook: {e}")
         return "ERROR", 400
 
+@app.route("/ready")
+def ready():
+    """Отчет о готовности подсистем (200 - готов, 503 - еще поднимается)."""
+    body, status = readiness_report()
+    return jsonify(body), status
+
+def readiness_report():
+    body = {
+        "ready": bootstrap_info["ready"],
+        "cold_start_ms": bootstrap_info["cold_start_ms"],
+        "pending_updates": len(pending_updates),
+        "subsystems": subsystem_status,
+        "http_transport": http_transport.stats(),
+        "sheet_writes": sheet_writes.stats(),
+    }
+    if scheduler:
+        body["scheduler_executor"] = dict(scheduler.executor_stats(), jobs=scheduler.executor_jobs())
+    if getattr(google_sheets, "mirror", None) is not None:
+        body["users_mirror"] = google_sheets.mirror.stats()
+    if GSPREAD_AVAILABLE:
+        body["oauth_token"] = token_cache.last_start
+    return body, 200 if bootstrap_info["ready"] else 503
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus."""
+    return metrics.REGISTRY.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+@app.route("/funnel-stats")
+def funnel_stats_endpoint():
+    """Счетчики воронки по часам (JSON): ?hours=24, 0 - за все хранимое время."""
+    hours = request.args.get("hours", default=24, type=int)
+    return jsonify(funnel_stats.summary(hours))
+
 # ===== ПРИВЕТСТВИЕ (АВТОВОРОНКА) =====
+@tracing.traced()
 def send_welcome_internal(message):
     """Отправляет MESSAGE 0 и запускает воронку."""
     user_id = message.from_user.id
@@ -667,6 +891,7 @@ def send_welcome_internal(message):
             if msg:
                 welcome_message_ids[user_id] = msg.message_id
                 save_message_history(user_id, msg.message_id)
+                funnel_stats.record_sent("message_0")
         except Exception as e:
             logger.error(f"Ошибка отправки welcome: {e}")
 
@@ -716,13 +941,15 @@ def send_welcome(message):
     user_id = message.from_user.id
     user_name = message.from_user.first_name or "Гость"
     logger.info(f"Пользователь {user_id} запустил бота")
-    log_action(user_id, user_name, "START", "Запуск бота")
+    # Параметр диплинка попадает в Stats: по нему cohort_report.py делит когорты по источнику входа
+    text_parts = message.text.split()
+    deep_link = text_parts[1] if len(text_parts) > 1 else ""
+    log_action(user_id, user_name, "START", f"Запуск бота (deeplink: {deep_link})" if deep_link else "Запуск бота")
     bot.clear_step_handler_by_chat_id(message.chat.id)
     reset_user_state(user_id)
     
     # Проверка на deep link
-    text_parts = message.text.split()
-    if len(text_parts) > 1 and text_parts[1] == "consult":
+    if deep_link == "consult":
         start_consultation_direct(message)
         return
 
@@ -865,6 +1092,18 @@ def confirm_broadcast(message, text):
         reply_markup=markup
     )
 
+# ===== /STATS (Admin Only) =====
+@bot.message_handler(commands=["stats"])
+def stats_command(message):
+    """Счетчики воронки из памяти: /stats [часы], 0 - за все хранимое время."""
+    user_id = message.from_user.id
+    if user_id != ADMIN_CHAT_ID:
+        logger.warning(f"🚫 Попытка доступа к статистике от пользователя {user_id}")
+        return
+    text_parts = message.text.split()
+    hours = int(text_parts[1]) if len(text_parts) > 1 and text_parts[1].isdigit() else 24
+    bot.send_message(message.chat.id, funnel_stats.format_report(hours))
+
 # ===== CALLBACK HANDLERS =====
 @bot.callback_query_handler(func=lambda call: True)
 def handle_callback(call):
@@ -944,24 +1183,16 @@ def handle_callback(call):
                 bot.send_message(chat_id, "❌ Ошибка: текст рассылки не найден.")
                 return
             
-            # Начинаем рассылку
-            users = get_all_registered_users()
-            bot.edit_message_text(f"⏳ Рассылка запущена для {len(users)} пользователей...", chat_id=chat_id, message_id=call.message.message_id)
-            
-            success_count = 0
-            fail_count = 0
-            for uid in users:
-                try:
-                    bot.send_message(uid, broadcast_text, parse_mode="HTML")
-                    success_count += 1
-                except Exception as e:
-                    logger.warning(f"❌ Ошибка отправки пользователю {uid}: {e}")
-                    fail_count += 1
-            
-            bot.send_message(chat_id, f"🏁 *Рассылка завершена!*\n\n✅ Успешно: {success_count}\n❌ Ошибок: {fail_count}", parse_mode="Markdown")
             # Очищаем временные данные
             if user_id in user_data:
                 user_data[user_id].pop("broadcast_text", None)
+            # Рассылка идет в своем потоке и не занимает воркер webhook до конца рассылки
+            threading.Thread(
+                target=run_broadcast,
+                args=(chat_id, call.message.message_id, broadcast_text),
+                name="broadcast",
+                daemon=True,
+            ).start()
 
         elif callback_data == "cancel_broadcast":
             bot.answer_callback_query(call.id, "Отменено")
@@ -1060,6 +1291,7 @@ def finish_diagnostic_form(chat_id, user_id, message_id):
     # Сохраняем ответы
     lead_quality = save_form_answers(user_id, answers)
     update_user_action(user_id, "completed_form")
+    funnel_stats.record_form("diagnostic", lead_quality)
     
     # Отправляем финальное сообщение
     final_message = MESSAGE_AFTER_FORM or (
@@ -1527,6 +1759,7 @@ def ask_consultation_participants(message, user_id):
             scheduler.schedule_consultation_followup(user_id, chat_id, "consult_followup_time")
     user_state[user_id] = "consultation_time"
 
+@tracing.traced()
 def finish_form_consultation(message, user_id):
     if check_for_commands(message):
         return
@@ -1586,18 +1819,33 @@ def index():
     )
 
 
+def start_background():
+    """Запускает фоновые потоки процесса: запись счетчиков воронки и bootstrap_subsystems.
+
+    При импорте main они не стартуют (main импортируют бенчмарки и утилиты):
+    под gunicorn их запускает хук post_worker_init из gunicorn.conf.py,
+    локально и в async_server.py - блок __main__.
+    """
+    funnel_stats.stats.start_flushing()
+    return start_bootstrap()
+
+
 # ===== ИНИЦИАЛИЗАЦИЯ (Работает и при импорте в Gunicorn) =====
 print("✅ STARTUP: AI2BIZ Bot v8.1 (Gunicorn Fix) Инициализация...")
 load_file_cache()
+metrics.instrument_handlers(bot)
 
 # ===== ЗАПУСК (Только локально) =====
 if __name__ == "__main__":
     print("✅ LOCAL: AI2BIZ Bot v8.1 запушен локально.")
     if not GSPREAD_AVAILABLE:
         print("⚠️ gspread не установлен. Добавьте в requirements.txt и выполните redeploy.")
-    if scheduler:
-        print("✅ Scheduler для дожимов активен")
-        scheduler.recovery_callback = recovery_handler
-    else:
-        print("⚠️ Scheduler не инициализирован")
+    print("⏳ Google Sheets и Scheduler инициализируются в фоне, статус: /ready")
+    start_background()
+    if UPDATE_MODE == "polling":
+        # Апдейты забираются через getUpdates; Flask остается для /ready и /metrics
+        poller = polling.PollingRunner(TOKEN, handle_webhook_update, ready=lambda: bootstrap_info["ready"])
+        metrics.POLLING.set_function(poller.stats)
+        poller.start()
+        print(f"✅ LOCAL: режим polling, пачки до {poller.batch_size} апдейтов")
     app.run(host="0.0.0.0", port=5000, debug=False)
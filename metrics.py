@@ -0,0 +1,423 @@
+"""
+Метрики в формате Prometheus для AI2BIZ бота.
+Счетчики и гистограммы хранятся в памяти процесса и отдаются по /metrics.
+Каждая серия защищена своим коротким локом, поэтому инструментирование
+можно держать включенным в продакшене.
+"""
+
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+import tracing
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _child(self, labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return key, child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, label_values, extra, value in self.samples():
+            labels = _format_labels(self.label_names, label_values, extra)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1, **labels):
+        _, child = self._child(labels)
+        with child.lock:
+            child.value += amount
+
+    def get(self, **labels):
+        _, child = self._child(labels)
+        return child.value
+
+    def snapshot(self):
+        """{значения меток: значение} по всем сериям."""
+        return {key: child.value for key, child in list(self._children.items())}
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            yield "", key, None, child.value
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._function = None
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value, **labels):
+        _, child = self._child(labels)
+        child.value = value
+
+    def set_function(self, function):
+        """Задает функцию, которая при сборе метрик возвращает {значения меток: значение}."""
+        self._function = function
+
+    def samples(self):
+        if self._function is not None:
+            try:
+                values = self._function() or {}
+            except Exception:
+                values = {}
+            for key, value in values.items():
+                key = key if isinstance(key, tuple) else (key,)
+                yield "", key, None, value
+            return
+        for key, child in list(self._children.items()):
+            yield "", key, None, child.value
+
+
+class _HistogramValue:
+    __slots__ = ("counts", "total", "count", "lock")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def _new_child(self):
+        return _HistogramValue(len(self.buckets))
+
+    def observe(self, value, **labels):
+        _, child = self._child(labels)
+        index = bisect_left(self.buckets, value)
+        with child.lock:
+            child.counts[index] += 1
+            child.total += value
+            child.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока в секундах."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def get_count(self, **labels):
+        _, child = self._child(labels)
+        return child.count
+
+    def samples(self):
+        for key, child in list(self._children.items()):
+            with child.lock:
+                counts = list(child.counts)
+                total, count = child.total, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield "_bucket", key, ("le", _format_value(bound)), cumulative
+            yield "_sum", key, None, total
+            yield "_count", key, None, count
+
+
+class MetricsRegistry:
+    """Набор метрик процесса и их сериализация в текстовый формат Prometheus."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+    def write_textfile(self, path):
+        """Атомарно записывает метрики в файл (textfile collector node_exporter для процессов без HTTP)."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+WEBHOOK_LATENCY = REGISTRY.histogram(
+    "ai2biz_webhook_seconds", "Время обработки запроса webhook()"
+)
+TELEGRAM_LATENCY = REGISTRY.histogram(
+    "ai2biz_telegram_request_seconds", "Время вызова метода Telegram Bot API", ("method", "status")
+)
+OUTBOUND_QUEUE_DELAY = REGISTRY.histogram(
+    "ai2biz_outbound_queue_seconds", "Ожидание отправки в очереди исходящих по полосам", ("lane",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+OUTBOUND_WAITING = REGISTRY.gauge(
+    "ai2biz_outbound_waiting", "Отправки, ждущие в очереди исходящих, по полосам", ("lane",)
+)
+SHEETS_LATENCY = REGISTRY.histogram(
+    "ai2biz_sheets_operation_seconds", "Время операции gspread", ("operation", "status")
+)
+DISPATCH_SCAN_LATENCY = REGISTRY.histogram(
+    "ai2biz_dispatch_scan_seconds", "Время одного прохода диспетчера по таблице Users"
+)
+UPDATES_TOTAL = REGISTRY.counter(
+    "ai2biz_updates_total", "Апдейты, обработанные хендлерами", ("handler",)
+)
+FUNNEL_SENDS_TOTAL = REGISTRY.counter(
+    "ai2biz_funnel_sends_total", "Отправки сообщений воронки", ("message_key", "status")
+)
+FILE_CACHE_TOTAL = REGISTRY.counter(
+    "ai2biz_file_cache_lookups_total", "Обращения к кэшу file_id (FILE_CACHE)", ("result",)
+)
+FUNNEL_SEND_LAG = REGISTRY.histogram(
+    "ai2biz_funnel_send_lag_seconds", "Опоздание отправки дожима относительно планового времени",
+    ("message_key",), buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200),
+)
+SEND_LAG_P95 = REGISTRY.gauge(
+    "ai2biz_funnel_send_lag_p95_seconds", "p95 опоздания по последним отправкам дожимов"
+)
+DISPATCH_CYCLE_ROWS = REGISTRY.histogram(
+    "ai2biz_dispatch_cycle_rows", "Строки листа Users за цикл диспетчера: прочитано, просрочено, отправлено",
+    ("dispatcher", "stage"), buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000),
+)
+WEBHOOK_IN_FLIGHT = REGISTRY.gauge(
+    "ai2biz_webhook_in_flight", "Async-сервер: апдейты в обработке, пик и отклоненные (503)", ("stat",)
+)
+HTTP_CONNECT_LATENCY = REGISTRY.histogram(
+    "ai2biz_http_connect_seconds", "Установка нового HTTP-соединения (TCP + TLS) по API", ("api",)
+)
+HTTP_POOL = REGISTRY.gauge(
+    "ai2biz_http_pool", "Пул HTTP-соединений: запросы, новые и переиспользованные соединения, сэкономленное время",
+    ("api", "stat"),
+)
+UPDATE_DEDUP = REGISTRY.gauge(
+    "ai2biz_update_dedup", "Отсев повторных апдейтов: записи, проверки, повторы, освобожденные", ("stat",)
+)
+POLLING_BATCH_SIZE = REGISTRY.histogram(
+    "ai2biz_polling_batch_size", "Апдейтов в пачке getUpdates (режим polling)",
+    buckets=(1, 5, 10, 25, 50, 75, 100),
+)
+POLLING_BATCH_SECONDS = REGISTRY.histogram(
+    "ai2biz_polling_batch_seconds", "Обработка пачки getUpdates (режим polling)"
+)
+POLLING = REGISTRY.gauge(
+    "ai2biz_polling", "Режим polling: пачки, апдейты, последний update_id и скорость обработки", ("stat",)
+)
+SCHEDULER_JOBS = REGISTRY.gauge(
+    "ai2biz_scheduler_jobs", "Задачи FollowUpScheduler по типам", ("kind",)
+)
+SCHEDULER_EXECUTOR = REGISTRY.gauge(
+    "ai2biz_scheduler_executor", "Исполнитель FollowUpScheduler: потоки, выполняющиеся и ждущие задачи", ("state",)
+)
+SCHEDULER_MISFIRES = REGISTRY.counter(
+    "ai2biz_scheduler_misfires_total", "Задачи FollowUpScheduler, пропущенные из-за опоздания", ("kind",)
+)
+SCHEDULER_DEFERRED = REGISTRY.counter(
+    "ai2biz_scheduler_deferred_total", "Задачи FollowUpScheduler, перенесенные из-за заполненной очереди", ("kind",)
+)
+SEND_LEDGER = REGISTRY.gauge(
+    "ai2biz_send_ledger", "Журнал отправок: записи, проверки, отсеченные дубли и их доля", ("stat",)
+)
+USERS_MIRROR = REGISTRY.gauge(
+    "ai2biz_users_mirror", "Зеркало Users: строки, несинхронизированные строки, отправки, правки из таблицы, конфликты",
+    ("stat",),
+)
+SHEETS_SKIPPED_WRITES = REGISTRY.counter(
+    "ai2biz_sheets_skipped_writes_total", "Записи в Google Sheets, не отправленные, потому что ничего не меняют",
+    ("worksheet", "operation"),
+)
+USERS_MIRROR_READ_LATENCY = REGISTRY.histogram(
+    "ai2biz_users_mirror_read_seconds", "Чтение пользователя из зеркала Users (SQLite)",
+    buckets=(0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.01, 0.05),
+)
+
+
+# ===== TELEGRAM =====
+def instrument_telegram():
+    """Оборачивает apihelper._make_request: через него идут все вызовы Bot API."""
+    from telebot import apihelper
+
+    original = apihelper._make_request
+    if getattr(original, "_ai2biz_instrumented", False):
+        return
+
+    @wraps(original)
+    def timed_make_request(token, method_name, *args, **kwargs):
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            with tracing.span(f"telegram.{method_name}"):
+                return original(token, method_name, *args, **kwargs)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, method=method_name, status=status)
+
+    timed_make_request._ai2biz_instrumented = True
+    apihelper._make_request = timed_make_request
+
+
+# ===== GOOGLE SHEETS =====
+def _timed_call(function, operation):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            with tracing.span(f"sheets.{operation}"):
+                return function(*args, **kwargs)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            SHEETS_LATENCY.observe(time.perf_counter() - started, operation=operation, status=status)
+    return wrapper
+
+
+class InstrumentedWorksheet:
+    """Прокси над gspread.Worksheet, замеряющий каждый вызов метода."""
+
+    def __init__(self, worksheet):
+        self._worksheet = worksheet
+
+    def __getattr__(self, name):
+        attr = getattr(self._worksheet, name)
+        if callable(attr) and not name.startswith("_"):
+            return _timed_call(attr, name)
+        return attr
+
+
+class InstrumentedSpreadsheet:
+    """Прокси над gspread.Spreadsheet: листы тоже возвращаются инструментированными."""
+
+    def __init__(self, spreadsheet):
+        self._spreadsheet = spreadsheet
+
+    def worksheet(self, title):
+        return InstrumentedWorksheet(_timed_call(self._spreadsheet.worksheet, "worksheet")(title))
+
+    def add_worksheet(self, *args, **kwargs):
+        return InstrumentedWorksheet(_timed_call(self._spreadsheet.add_worksheet, "add_worksheet")(*args, **kwargs))
+
+    def __getattr__(self, name):
+        attr = getattr(self._spreadsheet, name)
+        if callable(attr) and not name.startswith("_"):
+            return _timed_call(attr, name)
+        return attr
+
+
+def instrument_spreadsheet(spreadsheet):
+    if spreadsheet is None or isinstance(spreadsheet, InstrumentedSpreadsheet):
+        return spreadsheet
+    return InstrumentedSpreadsheet(spreadsheet)
+
+
+# ===== ХЕНДЛЕРЫ =====
+def instrument_handlers(bot):
+    """Считает апдейты по хендлерам telebot (message и callback_query) и открывает их спаны."""
+    for handler in list(bot.message_handlers) + list(bot.callback_query_handlers):
+        function = handler["function"]
+        if getattr(function, "_ai2biz_instrumented", False):
+            continue
+
+        def make_wrapper(func):
+            @wraps(func)
+            def counted(*args, **kwargs):
+                UPDATES_TOTAL.inc(handler=func.__name__)
+                with tracing.span(f"handler.{func.__name__}"):
+                    return func(*args, **kwargs)
+            counted._ai2biz_instrumented = True
+            return counted
+
+        handler["function"] = make_wrapper(function)
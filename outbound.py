@@ -0,0 +1,248 @@
+"""
+Приоритетные полосы исходящих сообщений бота.
+
+Все отправки (sendMessage, sendPhoto, ...) проходят через ограничитель
+частоты OUTBOUND_RATE_PER_SECOND. Когда токенов не хватает, ждущие
+отправки процесса обслуживаются строго по приоритету полосы:
+
+    interactive > consult_reminder > funnel > broadcast
+
+- interactive      - ответы на текущий апдейт пользователя (webhook);
+- consult_reminder - напоминания по анкете консультации;
+- funnel           - запланированные шаги воронки (send_message_job);
+- broadcast        - рассылка /broadcast_all.
+
+Из общей частоты OUTBOUND_INTERACTIVE_RESERVED сообщений в секунду
+доступны только полосе interactive, поэтому даже длинная рассылка или
+разбор очереди дожимов не забирают весь бюджет. Время ожидания в
+очереди по полосам пишется в гистограмму ai2biz_outbound_queue_seconds.
+
+Лимит Telegram - на бота, а не на процесс, поэтому токены лежат в общем
+файле SQLite OUTBOUND_BUDGET_PATH: все воркеры gunicorn и check_pending.py
+берут их под BEGIN IMMEDIATE из одного бюджета (как funnel_stats.py и
+users_mirror.py). Пустой OUTBOUND_BUDGET_PATH оставляет бюджет в памяти
+процесса; тогда на N процессов лимит надо делить вручную.
+
+Полоса задается контекстом: with outbound.lane("broadcast"): ...
+Потоки без явной полосы (задачи APScheduler) считаются funnel.
+"""
+
+import os
+import time
+import heapq
+import sqlite3
+import logging
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LANES = ("interactive", "consult_reminder", "funnel", "broadcast")
+# Методы Bot API, на которые действует лимит Telegram на отправку сообщений
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument", "sendVideo", "copyMessage"}
+
+OUTBOUND_RATE_PER_SECOND = float(os.getenv("OUTBOUND_RATE_PER_SECOND", "25"))
+OUTBOUND_INTERACTIVE_RESERVED = float(os.getenv("OUTBOUND_INTERACTIVE_RESERVED", "5"))
+OUTBOUND_BUDGET_PATH = os.getenv("OUTBOUND_BUDGET_PATH", "outbound_budget.sqlite3")
+
+_current_lane = contextvars.ContextVar("ai2biz_outbound_lane", default="funnel")
+
+
+def current_lane():
+    return _current_lane.get()
+
+
+@contextmanager
+def lane(name):
+    """Назначает полосу всем отправкам внутри блока."""
+    if name not in LANES:
+        raise ValueError(f"Неизвестная полоса: {name}")
+    token = _current_lane.set(name)
+    try:
+        yield
+    finally:
+        _current_lane.reset(token)
+
+
+def lane_for_message(message_key):
+    """Полоса запланированного сообщения по его ключу в MESSAGES."""
+    if message_key.startswith("consult_followup_"):
+        return "consult_reminder"
+    return "funnel"
+
+
+class _TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class _LocalBudget:
+    """Бюджет в памяти процесса: бакет total и бакет остальных полос (total минус резерв interactive)."""
+
+    def __init__(self, rate, background_rate):
+        self.buckets = {"total": _TokenBucket(rate), "background": _TokenBucket(background_rate)}
+
+    def take(self, names):
+        """Берет по токену из бакетов names. Возвращает 0 или сколько ждать до токена."""
+        now = time.monotonic()
+        buckets = [self.buckets[name] for name in names]
+        for bucket in buckets:
+            bucket.refill(now)
+        wait = max(bucket.wait_time() for bucket in buckets)
+        if wait <= 0:
+            for bucket in buckets:
+                bucket.tokens -= 1
+        return wait
+
+
+class SharedBudget:
+    """Те же бакеты в файле SQLite, общем для всех процессов бота.
+
+    Время пополнения - wall clock (monotonic у процессов разный). Файл
+    открывается при первой отправке, а не при импорте.
+    """
+
+    def __init__(self, path, rate, background_rate):
+        self.path = path
+        self.rates = {"total": rate, "background": background_rate}
+        self.conn = None
+        self.fallback = _LocalBudget(rate, background_rate)
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def take(self, names):
+        # Вызывается под условием PriorityRateLimiter - отдельная блокировка не нужна
+        try:
+            if self.conn is None:
+                self._connect()
+            return self._take(names)
+        except sqlite3.Error as e:
+            if self.conn is not None and self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            # Файл недоступен - не останавливаем отправки, а держим лимит хотя бы в процессе
+            logger.warning(f"⚠️ Общий бюджет отправок {self.path} недоступен, лимит в памяти процесса: {e}")
+            return self.fallback.take(names)
+
+    def _take(self, names):
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            stored = {
+                name: (tokens, updated)
+                for name, tokens, updated in self.conn.execute(
+                    f"SELECT name, tokens, updated FROM buckets WHERE name IN ({','.join('?' * len(names))})", names
+                )
+            }
+            tokens = {}
+            for name in names:
+                rate = self.rates[name]
+                capacity = max(1.0, rate)
+                level, updated = stored.get(name, (capacity, now))
+                tokens[name] = min(capacity, level + max(0.0, now - updated) * rate)
+            wait = max(0.0 if tokens[name] >= 1 else (1 - tokens[name]) / self.rates[name] for name in names)
+            if wait <= 0:
+                for name in names:
+                    tokens[name] -= 1
+            self.conn.executemany(
+                "INSERT INTO buckets VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                [(name, tokens[name], now) for name in names],
+            )
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return wait
+
+
+class PriorityRateLimiter:
+    """Токен-бакет с очередью по приоритету полос и резервом для interactive."""
+
+    def __init__(self, rate=OUTBOUND_RATE_PER_SECOND, interactive_reserved=OUTBOUND_INTERACTIVE_RESERVED,
+                 budget_path=OUTBOUND_BUDGET_PATH):
+        self.enabled = rate > 0
+        total_rate = rate if self.enabled else 1.0
+        # Бюджет остальных полос: общий минус резерв interactive
+        background_rate = max(rate - interactive_reserved, 0.1) if self.enabled else 1.0
+        if budget_path:
+            self.budget = SharedBudget(budget_path, total_rate, background_rate)
+        else:
+            self.budget = _LocalBudget(total_rate, background_rate)
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.waiting_by_lane = {name: 0 for name in LANES}
+        self._seq = itertools.count()
+
+    def acquire(self, lane_name):
+        """Ждет своей очереди и токена. Возвращает время ожидания в секундах."""
+        started = time.monotonic()
+        if not self.enabled:
+            return 0.0
+        entry = (LANES.index(lane_name), next(self._seq))
+        names = ["total"] if lane_name == "interactive" else ["total", "background"]
+        with self.cond:
+            heapq.heappush(self.waiting, entry)
+            self.waiting_by_lane[lane_name] += 1
+            try:
+                while True:
+                    if self.waiting[0] == entry:
+                        wait = self.budget.take(names)
+                        if wait <= 0:
+                            heapq.heappop(self.waiting)
+                            self.cond.notify_all()
+                            return time.monotonic() - started
+                        # Токены могли забрать другие процессы - после ожидания проверяем заново
+                        self.cond.wait(wait)
+                    else:
+                        # Ждем, пока отправки с более высоким приоритетом не уйдут
+                        self.cond.wait(0.05)
+            finally:
+                self.waiting_by_lane[lane_name] -= 1
+
+    def waiting_counts(self):
+        with self.cond:
+            return dict(self.waiting_by_lane)
+
+
+LIMITER = PriorityRateLimiter()
+metrics.OUTBOUND_WAITING.set_function(LIMITER.waiting_counts)
+
+
+def install(limiter=LIMITER):
+    """Ставит ограничитель перед apihelper._make_request (снаружи инструментирования метрик)."""
+    from telebot import apihelper
+
+    original = apihelper._make_request
+    if getattr(original, "_ai2biz_outbound", False):
+        return
+
+    @wraps(original)
+    def queued_make_request(token, method_name, *args, **kwargs):
+        if method_name in SEND_METHODS:
+            lane_name = current_lane()
+            metrics.OUTBOUND_QUEUE_DELAY.observe(limiter.acquire(lane_name), lane=lane_name)
+        return original(token, method_name, *args, **kwargs)
+
+    queued_make_request._ai2biz_outbound = True
+    apihelper._make_request = queued_make_request
@@ -0,0 +1,183 @@
+"""
+Режим long polling: апдейты забираются пачками через getUpdates.
+
+Нужен для staging и на случай, когда webhook-хост деградировал. Апдейты
+идут в тот же конвейер, что и webhook (main.handle_webhook_update):
+трассировка, метрики хендлеров. Первый getUpdates делается только после
+готовности подсистем: в webhook-режиме апдейт до готовности ждет в
+памяти, а здесь его offset был бы уже сохранен, и рестарт потерял бы
+апдейт. После каждого обработанного апдейта (статус 200) его update_id
+сохраняется в POLLING_OFFSET_PATH, поэтому после рестарта опрос
+продолжается со следующего апдейта - без потерь и без повторной
+обработки. Апдейт с ошибкой offset не сдвигает и запрашивается снова; после
+POLLING_MAX_ATTEMPTS неудач подряд он пропускается с ошибкой в логе.
+
+    UPDATE_MODE=polling python main.py
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+POLLING_BATCH_SIZE = int(os.getenv("POLLING_BATCH_SIZE", "100"))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "25"))
+POLLING_OFFSET_PATH = os.getenv("POLLING_OFFSET_PATH", ".polling_offset.json")
+POLLING_RETRY_SECONDS = float(os.getenv("POLLING_RETRY_SECONDS", "5"))
+POLLING_REPORT_INTERVAL = float(os.getenv("POLLING_REPORT_INTERVAL", "60"))
+POLLING_MAX_ATTEMPTS = int(os.getenv("POLLING_MAX_ATTEMPTS", "3"))
+POLLING_READY_CHECK_SECONDS = 0.5
+
+
+def load_offset(path=POLLING_OFFSET_PATH):
+    """Последний обработанный update_id или None, если опрос еще не запускался."""
+    try:
+        with open(path, "r") as f:
+            return int(json.load(f)["last_update_id"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_offset(update_id, path=POLLING_OFFSET_PATH):
+    """Атомарно записывает последний обработанный update_id."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".polling-", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"last_update_id": update_id}, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class PollingRunner:
+    """Цикл getUpdates -> handle_update(json) с сохранением offset после каждого апдейта."""
+
+    def __init__(self, token, handle_update, batch_size=POLLING_BATCH_SIZE, timeout=POLLING_TIMEOUT,
+                 offset_path=POLLING_OFFSET_PATH, allowed_updates=None, ready=None, max_attempts=POLLING_MAX_ATTEMPTS):
+        self.token = token
+        self.handle_update = handle_update
+        # ready() -> True, когда подсистемы бота готовы обрабатывать апдейты
+        self.ready = ready
+        self.max_attempts = max_attempts
+        # update_id -> число неудачных попыток обработки
+        self.failures = {}
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.offset_path = offset_path
+        self.allowed_updates = allowed_updates
+        self.last_update_id = load_offset(offset_path)
+        self.batches = 0
+        self.updates = 0
+        self.busy_seconds = 0.0
+        self._window = {"batches": 0, "updates": 0, "busy": 0.0, "started": time.monotonic()}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def fetch(self):
+        """Одна пачка апдейтов (JSON) после последнего обработанного."""
+        from telebot import apihelper
+
+        offset = self.last_update_id + 1 if self.last_update_id is not None else None
+        return apihelper.get_updates(self.token, offset=offset, limit=self.batch_size,
+                                     allowed_updates=self.allowed_updates,
+                                     long_polling_timeout=self.timeout)
+
+    def process_batch(self, updates):
+        """Обрабатывает пачку по порядку. Возвращает False, если апдейт не обработан и пачку нужно повторить."""
+        started = time.perf_counter()
+        processed = 0
+        completed = True
+        for json_data in updates:
+            update_id = json_data.get("update_id")
+            if self.last_update_id is not None and update_id <= self.last_update_id:
+                continue
+            _, status = self.handle_update(json_data)
+            if status != 200:
+                attempts = self.failures.get(update_id, 0) + 1
+                if status == 503 or attempts < self.max_attempts:
+                    # offset не сдвигаем: этот апдейт заберем следующим запросом
+                    if status != 503:
+                        self.failures[update_id] = attempts
+                        logger.warning(f"⚠️ polling: апдейт {update_id} обработан с ошибкой ({status}), "
+                                       f"попытка {attempts} из {self.max_attempts}")
+                    completed = False
+                    break
+                logger.error(f"❌ polling: апдейт {update_id} не обработан за {attempts} попыток ({status}), пропускаем")
+            self.failures.pop(update_id, None)
+            self.last_update_id = update_id
+            save_offset(update_id, self.offset_path)
+            processed += 1
+        elapsed = time.perf_counter() - started
+
+        self.batches += 1
+        self.updates += processed
+        self.busy_seconds += elapsed
+        self._window["batches"] += 1
+        self._window["updates"] += processed
+        self._window["busy"] += elapsed
+        metrics.POLLING_BATCH_SIZE.observe(len(updates))
+        metrics.POLLING_BATCH_SECONDS.observe(elapsed)
+        return completed
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "updates": self.updates,
+            "last_update_id": self.last_update_id or 0,
+            "updates_per_second": round(self.updates / self.busy_seconds, 1) if self.busy_seconds else 0.0,
+        }
+
+    def report(self, force=False):
+        """Раз в POLLING_REPORT_INTERVAL секунд пишет в лог размеры пачек и скорость обработки."""
+        window = self._window
+        now = time.monotonic()
+        if not window["batches"] or (not force and now - window["started"] < POLLING_REPORT_INTERVAL):
+            return
+        rate = window["updates"] / window["busy"] if window["busy"] else 0.0
+        logger.info(
+            f"📥 polling: {window['batches']} пачек, в среднем {window['updates'] / window['batches']:.1f} "
+            f"апдейтов, обработка {rate:.1f} upd/s, последний update_id {self.last_update_id}"
+        )
+        self._window = {"batches": 0, "updates": 0, "busy": 0.0, "started": now}
+
+    def run(self):
+        from telebot import apihelper
+
+        # getUpdates не работает, пока у бота установлен webhook
+        apihelper.delete_webhook(self.token)
+        if self.ready is not None and not self.ready():
+            logger.info("⏳ polling: жду готовности подсистем")
+            while not self._stop.is_set() and not self.ready():
+                self._stop.wait(POLLING_READY_CHECK_SECONDS)
+        logger.info(f"✅ polling: пачки до {self.batch_size} апдейтов, offset {self.last_update_id}")
+        while not self._stop.is_set():
+            try:
+                updates = self.fetch()
+            except Exception as e:
+                logger.error(f"❌ polling: ошибка getUpdates: {e}")
+                self._stop.wait(POLLING_RETRY_SECONDS)
+                continue
+            if updates and not self.process_batch(updates):
+                self._stop.wait(POLLING_RETRY_SECONDS)
+            self.report()
+        self.report(force=True)
+
+    def start(self):
+        """Запускает run() в фоновом потоке."""
+        self._thread = threading.Thread(target=self.run, name="polling", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
@@ -1,27 +1,104 @@
 
+import os
+import time
+import random
 import logging
+import threading
+from collections import Counter
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.events import EVENT_JOB_MISSED
 from apscheduler.triggers.date import DateTrigger
 from datetime import datetime, timedelta
 import telebot
 import pytz
 from messages import MESSAGES, FOLLOW_UP_PLAN
+import leases
+import job_executor
+import metrics
+import dispatch_slo
+import outbound
+import send_ledger
+import tracing
+import funnel_stats
 
 logger = logging.getLogger(__name__)
 
+# Сглаживание волн дожимов: джиттер до FOLLOW_UP_JITTER_FRACTION от задержки
+# (но не больше FOLLOW_UP_JITTER_MAX_MINUTES) и потолок отправок в минуту
+FOLLOW_UP_JITTER_FRACTION = float(os.getenv("FOLLOW_UP_JITTER_FRACTION", "0.1"))
+FOLLOW_UP_JITTER_MAX_MINUTES = float(os.getenv("FOLLOW_UP_JITTER_MAX_MINUTES", "30"))
+FUNNEL_SENDS_PER_MINUTE = int(os.getenv("FUNNEL_SENDS_PER_MINUTE", "300"))
+# Дальше этого заполненные минуты не сдвигают отправку: перегрузка принимается
+FUNNEL_MAX_SHIFT_MINUTES = int(os.getenv("FUNNEL_MAX_SHIFT_MINUTES", "15"))
+
+# Префиксы job_id (порядок важен: funnel_recovery раньше funnel)
+JOB_KINDS = ("funnel_recovery", "funnel", "file_followup", "case_followup", "consult_followup", "sheet_dispatch")
+
+# Сколько секунд задача может опоздать (ожидая в очереди исполнителя) и все еще выполниться.
+# Напоминание по анкете через 5 минут теряет смысл уже через несколько минут опоздания,
+# шаг воронки уместен и через час; пропущенный шаг остается в листе Users для диспетчера.
+CONSULT_MISFIRE_GRACE_SECONDS = int(os.getenv("SCHEDULER_MISFIRE_GRACE_CONSULT", "300"))
+FUNNEL_MISFIRE_GRACE_SECONDS = int(os.getenv("SCHEDULER_MISFIRE_GRACE_FUNNEL", "3600"))
+MISFIRE_GRACE_SECONDS = {
+    "consult_followup": CONSULT_MISFIRE_GRACE_SECONDS,
+    "funnel_recovery": CONSULT_MISFIRE_GRACE_SECONDS,
+    "funnel": FUNNEL_MISFIRE_GRACE_SECONDS,
+    "file_followup": FUNNEL_MISFIRE_GRACE_SECONDS,
+    "case_followup": FUNNEL_MISFIRE_GRACE_SECONDS,
+    "sheet_dispatch": 30,
+}
+
+
+def job_kind(job_id):
+    """Тип задачи по префиксу job_id."""
+    return next((prefix for prefix in JOB_KINDS if job_id.startswith(prefix)), "other")
+
+
+def job_policy(job_id):
+    """Параметры add_job для задачи: допустимое опоздание и схлопывание пропущенных запусков."""
+    return {"misfire_grace_time": MISFIRE_GRACE_SECONDS.get(job_kind(job_id), 60), "coalesce": True}
+
 class FollowUpScheduler:
-    def __init__(self, bot, user_data, google_sheets=None, scheduler_storage=None):
+    def __init__(self, bot, user_data, google_sheets=None, scheduler_storage=None, clock=None, lease_store=None,
+                 scheduler=None):
         self.bot = bot
+        # clock() -> aware datetime; подменяется в нагрузочных прогонах виртуальными часами
+        self.clock = clock
         self.user_data = user_data
         self.google_sheets = google_sheets
-        self.scheduler = BackgroundScheduler()
+        if scheduler is None:
+            self.executor = job_executor.BoundedThreadPoolExecutor(
+                on_defer=lambda job: metrics.SCHEDULER_DEFERRED.inc(kind=job_kind(job.id))
+            )
+            scheduler = BackgroundScheduler(executors={"default": self.executor})
+        else:
+            # Подмененный планировщик (симулятор воронки на виртуальных часах) со своим исполнением задач
+            self.executor = None
+        self.scheduler = scheduler
+        self.scheduler.add_listener(self._on_job_missed, EVENT_JOB_MISSED)
         # Если нужно, можно добавить RedisJobStore или SQLAlchemyJobStore
         # self.scheduler.add_jobstore('sqlalchemy', url='sqlite:///jobs.sqlite')
         self.scheduler.start()
         self.user_stop_flags = {} # user_id -> True/False
         self.tz = pytz.timezone("Europe/Moscow")
         self.use_sheet_queue = bool(self.google_sheets)
+        # Аренда шардов листа Users, чтобы бот и check_pending.py не отправляли одну строку дважды
+        self.lease_store = lease_store or leases.from_env(self.google_sheets)
+        self.lease_owner = leases.make_owner("bot")
         self.recovery_callback = None # Коллбэк для восстановления воронки
+        self.rng = random.Random()
+        # Сколько отправок воронки этот процесс уже запланировал на каждую минуту
+        # и минута запланированного шага каждого пользователя (освобождается при отмене и замене)
+        self.planned_per_minute = Counter()
+        self.planned_slots = {}
+        self.slots_lock = threading.Lock()
+        self.sends_per_minute_limit = FUNNEL_SENDS_PER_MINUTE
+        self.max_shift_minutes = FUNNEL_MAX_SHIFT_MINUTES
+        # Отправки сверх потолка с последнего предупреждения в лог (не чаще раза в минуту)
+        self._overloaded = 0
+        self._overload_logged_at = 0.0
+        # План дожимов; симулятор подставляет сюда измененный план для сравнения
+        self.follow_up_plan = FOLLOW_UP_PLAN
         self.custom_follow_up = {
             "message_file_followup": ("message_5", 23 * 60 + 50),
             "message_3_1": ("message_4", 23 * 60 + 50),
@@ -36,13 +113,91 @@ class FollowUpScheduler:
                 id="sheet_dispatch",
                 replace_existing=True,
                 max_instances=1,
-                coalesce=True,
+                **job_policy("sheet_dispatch"),
             )
 
+    def now(self):
+        """Текущее время по часам планировщика (Europe/Moscow)."""
+        if self.clock:
+            return self.clock().astimezone(self.tz)
+        return datetime.now(self.tz)
+
+    def spread_run_date(self, delay_minutes, user_id=None):
+        """Плановое время шага воронки с джиттером и потолком отправок в минуту.
+
+        Старты из одного поста в канале иначе превращаются в синхронные
+        волны отправок через 5 мин, 1 ч, 24 ч. Джиттер только сдвигает
+        отправку позже, и не больше чем на долю задержки. Если минута уже
+        заполнена до FUNNEL_SENDS_PER_MINUTE, отправка переносится на
+        следующую свободную, но не дальше FUNNEL_MAX_SHIFT_MINUTES: если
+        свободной нет, отправка остается в своей минуте сверх потолка.
+        С user_id прежний шаг пользователя освобождает свою минуту.
+        """
+        now = self.now()
+        max_jitter = min(delay_minutes * FOLLOW_UP_JITTER_FRACTION, FOLLOW_UP_JITTER_MAX_MINUTES) * 60
+        run_date = now + timedelta(minutes=delay_minutes, seconds=self.rng.uniform(0, max_jitter))
+        if self.sends_per_minute_limit <= 0:
+            return run_date
+        minute = int(run_date.timestamp() // 60)
+        with self.slots_lock:
+            if user_id is not None:
+                self._release_slot_locked(user_id)
+            shifted = minute
+            while self.planned_per_minute[shifted] >= self.sends_per_minute_limit:
+                shifted += 1
+                if shifted - minute > self.max_shift_minutes:
+                    shifted = minute
+                    self._overloaded += 1
+                    if time.monotonic() - self._overload_logged_at >= 60:
+                        self._overload_logged_at = time.monotonic()
+                        logger.warning(f"⚠️ Следующие {self.max_shift_minutes} мин после {run_date:%H:%M} заполнены "
+                                       f"({self.sends_per_minute_limit}/мин): {self._overloaded} отправок "
+                                       f"поставлены сверх потолка")
+                        self._overloaded = 0
+                    break
+            self.planned_per_minute[shifted] += 1
+            if user_id is not None:
+                self.planned_slots[user_id] = shifted
+            # Прошедшие минуты больше не нужны
+            if len(self.planned_per_minute) > 10_000:
+                current = int(now.timestamp() // 60)
+                for key in [key for key in self.planned_per_minute if key < current]:
+                    del self.planned_per_minute[key]
+                for key in [key for key, slot in self.planned_slots.items() if slot < current]:
+                    del self.planned_slots[key]
+        if shifted != minute:
+            run_date += timedelta(minutes=shifted - minute)
+        return run_date
+
+    def _release_slot_locked(self, user_id):
+        minute = self.planned_slots.pop(user_id, None)
+        if minute is not None and self.planned_per_minute.get(minute, 0) > 0:
+            self.planned_per_minute[minute] -= 1
+
+    def release_slot(self, user_id):
+        """Освобождает минуту запланированного шага пользователя (шаг отменен)."""
+        with self.slots_lock:
+            self._release_slot_locked(user_id)
+
+    def record_send_lag(self, message_key, scheduled_at):
+        """Опоздание фактической отправки относительно планового времени (Run Date)."""
+        try:
+            planned = datetime.fromisoformat(scheduled_at)
+        except ValueError:
+            return
+        # Сравниваем по московскому времени без tzinfo: без перехода на летнее время
+        # это точно, а localize() заметно тормозит симулятор на миллионе отправок
+        dispatch_slo.record_send(message_key, (self.now().replace(tzinfo=None) - planned).total_seconds())
+
+    def format_run_date(self, run_date):
+        """Run Date в формате листа Users (он же scheduled_at в журнале отправок)."""
+        return run_date.astimezone(self.tz).strftime("%Y-%m-%d %H:%M:%S")
+
     def start(self):
         if not self.scheduler.running:
             self.scheduler.start()
 
+    @tracing.traced("scheduler.schedule_next_message")
     def schedule_next_message(self, user_id, chat_id, last_message_key):
         """Планирует следующее сообщение на основе текущего."""
         if self.is_stopped(user_id):
@@ -54,7 +209,7 @@ class FollowUpScheduler:
             return
 
         next_msg_key, delay_minutes = plan
-        run_date = datetime.now(self.tz) + timedelta(minutes=delay_minutes)
+        run_date = self.spread_run_date(delay_minutes, user_id)
         
         job_id = f"funnel_{user_id}_{next_msg_key}"
         
@@ -71,11 +226,14 @@ class FollowUpScheduler:
             self.send_message_job,
             trigger=DateTrigger(run_date=run_date),
             args=[user_id, chat_id, next_msg_key],
+            kwargs={"scheduled_at": self.format_run_date(run_date)},
             id=job_id,
-            replace_existing=True
+            replace_existing=True,
+            **job_policy(job_id),
         )
         self.update_sheet_schedule(user_id, next_msg_key, run_date, chat_id=chat_id)
 
+    @tracing.traced("scheduler.cancel_all_user_jobs")
     def cancel_all_user_jobs(self, user_id):
         """Отменяет все запланированные задачи для конкретного пользователя."""
         for job in list(self.scheduler.get_jobs()):
@@ -85,6 +243,7 @@ class FollowUpScheduler:
                     logger.info(f"Удалена задача {job.id}")
                 except Exception:
                     pass
+        self.release_slot(user_id)
         if self.use_sheet_queue:
             self.clear_sheet_schedule(user_id)
 
@@ -100,14 +259,34 @@ class FollowUpScheduler:
         
         self.send_message_job(user_id, chat_id, message_key, schedule_next=schedule_next)
 
-    def send_message_job(self, user_id, chat_id, message_key, schedule_next=True):
-        """Задача отправки сообщения."""
+    @tracing.traced("scheduler.send_message_job")
+    def send_message_job(self, user_id, chat_id, message_key, schedule_next=True, scheduled_at=None):
+        """Задача отправки сообщения.
+
+        scheduled_at - плановое время для запланированных отправок: по ключу
+        (user_id, message_key, scheduled_at) журнал отправок отсекает дубли.
+        Запланированные отправки идут в полосе funnel/consult_reminder, прямой
+        вызов из обработчика апдейта остается в полосе вызывающего (interactive).
+        """
+        if scheduled_at:
+            with outbound.lane(outbound.lane_for_message(message_key)):
+                return self._send_message(user_id, chat_id, message_key, schedule_next, scheduled_at)
+        return self._send_message(user_id, chat_id, message_key, schedule_next, scheduled_at)
+
+    def _send_message(self, user_id, chat_id, message_key, schedule_next, scheduled_at):
+        ledger = send_ledger.get_ledger() if scheduled_at else None
+        delivered = False
         try:
             logger.info(f"Отправка воронки {message_key} для {user_id}")
             msg_data = MESSAGES.get(message_key)
             if not msg_data:
                 return False
 
+            if ledger and not ledger.begin(user_id, message_key, scheduled_at):
+                logger.info(f"Пропуск дубля {message_key} для {user_id} (запланировано на {scheduled_at})")
+                metrics.FUNNEL_SENDS_TOTAL.inc(message_key=message_key, status="duplicate")
+                return False
+
             text = msg_data.get("text")
             buttons = msg_data.get("buttons")
             
@@ -165,7 +344,14 @@ class FollowUpScheduler:
             else:
                 self.bot.send_message(chat_id, text, reply_markup=markup, parse_mode="HTML")
 
+            delivered = True
+            if ledger:
+                ledger.finish(user_id, message_key, scheduled_at)
+            if scheduled_at:
+                self.record_send_lag(message_key, scheduled_at)
             self.update_send_log(user_id, message_key, "OK")
+            metrics.FUNNEL_SENDS_TOTAL.inc(message_key=message_key, status="ok")
+            funnel_stats.record_sent(message_key)
             # После отправки, планируем следующее
             if schedule_next:
                 self.schedule_next_message(user_id, chat_id, message_key)
@@ -180,7 +366,10 @@ class FollowUpScheduler:
             return True
         except Exception as e:
             logger.error(f"Ошибка отправки сообщения воронки {user_id}: {e}")
+            if ledger and not delivered:
+                ledger.finish(user_id, message_key, scheduled_at, error=e)
             self.update_send_log(user_id, message_key, "ERROR")
+            metrics.FUNNEL_SENDS_TOTAL.inc(message_key=message_key, status="error")
             return False
 
     def stop_funnel(self, user_id):
@@ -229,7 +418,7 @@ class FollowUpScheduler:
         self.cancel_job(f"funnel_{user_id}_message_5")
 
         # 1. Через 10 минут "Что дальше?" (message_file_followup)
-        run_date_1 = datetime.now(self.tz) + timedelta(minutes=10)
+        run_date_1 = self.spread_run_date(10, user_id)
         job_id_1 = f"file_followup_1_{user_id}"
         
         logger.info(f"Планирую message_file_followup для {user_id} через 10 мин")
@@ -241,8 +430,10 @@ class FollowUpScheduler:
             self.send_message_job,
             trigger=DateTrigger(run_date=run_date_1),
             args=[user_id, chat_id, "message_file_followup", True], # Используем автоматику
+            kwargs={"scheduled_at": self.format_run_date(run_date_1)},
             id=job_id_1,
-            replace_existing=True
+            replace_existing=True,
+            **job_policy(job_id_1),
         )
         self.update_sheet_schedule(user_id, "message_file_followup", run_date_1, chat_id=chat_id)
 
@@ -255,7 +446,7 @@ class FollowUpScheduler:
         self.cancel_job(f"funnel_{user_id}_message_4")
 
         # 1. Через 10 минут "Что дальше?" (message_3_1)
-        run_date_1 = datetime.now(self.tz) + timedelta(minutes=10)
+        run_date_1 = self.spread_run_date(10, user_id)
         job_id_1 = f"case_followup_1_{user_id}"
         
         logger.info(f"Планирую message_3_1 для {user_id} через 10 минут")
@@ -267,8 +458,10 @@ class FollowUpScheduler:
             self.send_message_job,
             trigger=DateTrigger(run_date=run_date_1),
             args=[user_id, chat_id, "message_3_1", True], # Пусть планирует следующее через get_next_plan
+            kwargs={"scheduled_at": self.format_run_date(run_date_1)},
             id=job_id_1,
-            replace_existing=True
+            replace_existing=True,
+            **job_policy(job_id_1),
         )
         self.update_sheet_schedule(user_id, "message_3_1", run_date_1, chat_id=chat_id)
 
@@ -276,9 +469,10 @@ class FollowUpScheduler:
         # так как send_message_job("message_3_1", schedule_next=True) теперь будет
         # использовать get_next_plan и запланирует его автоматически.
 
+    @tracing.traced("scheduler.schedule_consultation_followup")
     def schedule_consultation_followup(self, user_id, chat_id, step_key):
         """Планирует напоминание для анкеты консультации через 5 минут."""
-        run_date = datetime.now(self.tz) + timedelta(minutes=5)
+        run_date = self.now() + timedelta(minutes=5)
         job_id = f"consult_followup_{user_id}_{step_key}"
         
         # Удаляем предыдущие напоминания для чистоты
@@ -290,10 +484,13 @@ class FollowUpScheduler:
             self.send_message_job,
             trigger=DateTrigger(run_date=run_date),
             args=[user_id, chat_id, step_key, False], # schedule_next=False для напоминаний
+            kwargs={"scheduled_at": self.format_run_date(run_date)},
             id=job_id,
-            replace_existing=True
+            replace_existing=True,
+            **job_policy(job_id),
         )
 
+    @tracing.traced("scheduler.cancel_consultation_followups")
     def cancel_consultation_followups(self, user_id):
         """Отменяет все текущие задачи-напоминания для анкеты консультации."""
         for job in list(self.scheduler.get_jobs()):
@@ -308,7 +505,7 @@ class FollowUpScheduler:
 
     def schedule_funnel_recovery(self, user_id, chat_id):
         """Планирует отправку Message 0 через 10 минут для лидов из диплинка."""
-        run_date = datetime.now(self.tz) + timedelta(minutes=10)
+        run_date = self.now() + timedelta(minutes=10)
         job_id = f"funnel_recovery_{user_id}"
         
         self.cancel_funnel_recovery(user_id)
@@ -322,16 +519,19 @@ class FollowUpScheduler:
                 trigger=DateTrigger(run_date=run_date),
                 args=[user_id, chat_id],
                 id=job_id,
-                replace_existing=True
+                replace_existing=True,
+                **job_policy(job_id),
             )
         else:
             # Иначе просто отправляем сообщение (старый способ)
             self.scheduler.add_job(
                 self.send_message_job,
                 trigger=DateTrigger(run_date=run_date),
-                args=[user_id, chat_id, "message_0", True], 
+                args=[user_id, chat_id, "message_0", True],
+                kwargs={"scheduled_at": self.format_run_date(run_date)},
                 id=job_id,
-                replace_existing=True
+                replace_existing=True,
+                **job_policy(job_id),
             )
 
     def cancel_funnel_recovery(self, user_id):
@@ -343,19 +543,54 @@ class FollowUpScheduler:
         except Exception:
             pass
 
+    def job_counts(self):
+        """Количество задач APScheduler по типу (префикс job_id без user_id)."""
+        counts = {}
+        for job in self.scheduler.get_jobs():
+            kind = job_kind(job.id)
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    def executor_stats(self):
+        """Выполняющиеся и ждущие задачи исполнителя, лимиты и число переносов."""
+        return self.executor.stats() if self.executor else {}
+
+    def executor_jobs(self):
+        """Выполняющиеся и ждущие задачи исполнителя по job_id с временем выполнения/ожидания."""
+        return self.executor.jobs() if self.executor else {}
+
+    def _on_job_missed(self, event):
+        kind = job_kind(event.job_id)
+        metrics.SCHEDULER_MISFIRES.inc(kind=kind)
+        if kind == "consult_followup":
+            logger.warning(f"⚠️ Напоминание {event.job_id} опоздало больше чем на {CONSULT_MISFIRE_GRACE_SECONDS} с и пропущено")
+        else:
+            logger.warning(f"⚠️ Задача {event.job_id} опоздала и пропущена")
+
     def cancel_job(self, job_id):
         try:
             self.scheduler.remove_job(job_id)
         except Exception:
             pass
 
+    def users_worksheet(self):
+        """Лист Users для расписания и журнала отправок (J:O) - прямо в таблице, мимо очереди зеркала.
+
+        Эти столбцы пишут и check_pending.py, и диспетчеры других хостов:
+        запись, отложенная в зеркале, проиграла бы их записям при синхронизации
+        (например, новый /start не перезапустил бы цепочку).
+        """
+        direct = getattr(self.google_sheets, "direct_users_worksheet", None)
+        return direct if direct is not None else self.google_sheets.worksheet("Users")
+
+    @tracing.traced("scheduler.update_sheet_schedule")
     def update_sheet_schedule(self, user_id, next_msg, run_date, chat_id=None):
         """Обновляет информацию о запланированных сообщениях в Google Sheets."""
         if not self.google_sheets:
             return
 
         try:
-            worksheet = self.google_sheets.worksheet("Users")
+            worksheet = self.users_worksheet()
             cell = worksheet.find(str(user_id), in_column=1)
             if cell:
                 row = cell.row
@@ -370,11 +605,12 @@ class FollowUpScheduler:
         except Exception as e:
             logger.error(f"❌ Failed to update Google Sheets schedule for {user_id}: {e}")
 
+    @tracing.traced("scheduler.clear_sheet_schedule")
     def clear_sheet_schedule(self, user_id):
         if not self.google_sheets:
             return
         try:
-            worksheet = self.google_sheets.worksheet("Users")
+            worksheet = self.users_worksheet()
             cell = worksheet.find(str(user_id), in_column=1)
             if cell:
                 row = cell.row
@@ -382,23 +618,24 @@ class FollowUpScheduler:
         except Exception as e:
             logger.error(f"❌ Failed to clear sheet schedule for {user_id}: {e}")
 
+    @tracing.traced("scheduler.update_send_log")
     def update_send_log(self, user_id, message_key, status):
         if not self.google_sheets:
             return
         try:
-            worksheet = self.google_sheets.worksheet("Users")
+            worksheet = self.users_worksheet()
             cell = worksheet.find(str(user_id), in_column=1)
             if cell:
                 row = cell.row
                 worksheet.update_cell(row, 13, message_key)
-                worksheet.update_cell(row, 14, datetime.now(self.tz).strftime("%Y-%m-%d %H:%M:%S"))
+                worksheet.update_cell(row, 14, self.now().strftime("%Y-%m-%d %H:%M:%S"))
                 worksheet.update_cell(row, 15, status)
         except Exception as e:
             logger.error(f"❌ Failed to update send log for {user_id}: {e}")
 
     def get_next_plan(self, message_key):
-        if message_key in FOLLOW_UP_PLAN:
-            return FOLLOW_UP_PLAN[message_key]
+        if message_key in self.follow_up_plan:
+            return self.follow_up_plan[message_key]
         return self.custom_follow_up.get(message_key)
 
     def dispatch_due_messages_from_sheet(self):
@@ -406,10 +643,18 @@ class FollowUpScheduler:
         if not self.google_sheets:
             return
 
+        # Чтение, захват строк (очистка J:K) и журнал M:O идут прямо в таблицу (users_worksheet):
+        # те же строки захватывают check_pending.py и диспетчеры других хостов
+        with metrics.DISPATCH_SCAN_LATENCY.time(), tracing.start_trace("dispatch_scan"):
+            self._dispatch_due_messages_from_sheet()
+
+    def _dispatch_due_messages_from_sheet(self):
         try:
-            worksheet = self.google_sheets.worksheet("Users")
+            worksheet = self.users_worksheet()
+            # Момент чтения листа: шарды, измененные позже, этот проход не берет
+            snapshot_at = time.time()
             all_records = worksheet.get_all_records()
-            now = datetime.now(self.tz)
+            now = self.now()
 
             def record_get(record, *keys):
                 for key in keys:
@@ -418,6 +663,7 @@ class FollowUpScheduler:
                         return val
                 return ""
 
+            due_rows = []
             for idx, record in enumerate(all_records):
                 user_id_val = record.get("User ID")
                 if not user_id_val:
@@ -438,31 +684,68 @@ class FollowUpScheduler:
                     continue
 
                 if run_date <= now:
-                    row_num = idx + 2
-                    # Очищаем ячейки ДО отправки, чтобы избежать повторов
-                    worksheet.update(values=[["", ""]], range_name=f'J{row_num}:K{row_num}')
-
-                    try:
-                        user_id = int(user_id_val)
-                    except Exception:
-                        user_id = user_id_val
-
-                    try:
-                        chat_id = int(chat_id_val)
-                    except Exception:
-                        chat_id = chat_id_val
-
-                    if self.is_stopped(user_id):
-                        continue
-
-                    sent = self.send_message_job(user_id, chat_id, next_msg, schedule_next=False)
-                    if not sent:
-                        continue
-
-                    plan = self.get_next_plan(next_msg)
-                    if plan:
-                        next_key, delay_minutes = plan
-                        next_run = now + timedelta(minutes=delay_minutes)
-                        self.update_sheet_schedule(user_id, next_key, next_run, chat_id=chat_id)
+                    due_rows.append((idx + 2, user_id_val, chat_id_val, next_msg, self.format_run_date(run_date)))
+
+            due_count = len(due_rows)
+            if not due_rows:
+                dispatch_slo.record_cycle("scheduler", len(all_records), 0, 0)
+                return
+            # Потолок отправок за проход (проход раз в минуту): самые старые первыми,
+            # остальные строки остаются в таблице до следующего прохода
+            due_rows.sort(key=lambda row: row[4])
+            if FUNNEL_SENDS_PER_MINUTE > 0 and len(due_rows) > FUNNEL_SENDS_PER_MINUTE:
+                logger.info(f"Просрочено {len(due_rows)} строк, отправляю {FUNNEL_SENDS_PER_MINUTE} "
+                            f"(FUNNEL_SENDS_PER_MINUTE), остальные - в следующих проходах")
+                due_rows = due_rows[:FUNNEL_SENDS_PER_MINUTE]
+            if self.lease_store:
+                sent = []
+                leases.run_sharded(
+                    self.lease_store, self.lease_owner, due_rows, lambda row: row[1],
+                    lambda batch, deadline: sent.append(self._send_due_rows(worksheet, batch, now, deadline)),
+                    snapshot_at,
+                )
+                sent_count = sum(sent)
+            else:
+                sent_count = self._send_due_rows(worksheet, due_rows, now)
+            dispatch_slo.record_cycle("scheduler", len(all_records), due_count, sent_count)
         except Exception as e:
             logger.error(f"Ошибка диспетчера таблицы: {e}")
+
+    def _send_due_rows(self, worksheet, due_rows, now, deadline=None):
+        """Отправляет просроченные строки; deadline (time.monotonic) - граница аренды шардов.
+
+        Возвращает число отправленных сообщений.
+        """
+        sent_count = 0
+        for row_num, user_id_val, chat_id_val, next_msg, scheduled_at in due_rows:
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning("Аренда шардов истекает, оставшиеся строки переходят на следующий проход")
+                return sent_count
+
+            # Очищаем ячейки ДО отправки, чтобы избежать повторов
+            worksheet.update(values=[["", ""]], range_name=f'J{row_num}:K{row_num}')
+
+            try:
+                user_id = int(user_id_val)
+            except Exception:
+                user_id = user_id_val
+
+            try:
+                chat_id = int(chat_id_val)
+            except Exception:
+                chat_id = chat_id_val
+
+            if self.is_stopped(user_id):
+                continue
+
+            sent = self.send_message_job(user_id, chat_id, next_msg, schedule_next=False, scheduled_at=scheduled_at)
+            if not sent:
+                continue
+            sent_count += 1
+
+            plan = self.get_next_plan(next_msg)
+            if plan:
+                next_key, delay_minutes = plan
+                next_run = self.spread_run_date(delay_minutes, user_id)
+                self.update_sheet_schedule(user_id, next_key, next_run, chat_id=chat_id)
+        return sent_count
@@ -0,0 +1,144 @@
+"""
+Журнал отправок: защита от повторной доставки одного и того же сообщения.
+
+Каждое намерение отправить записывается с ключом
+(user_id, message_key, scheduled_at) ДО отправки и получает итог после:
+- sent    - доставлено;
+- unknown - ошибка, после которой сообщение могло дойти (таймаут чтения,
+            обрыв соединения) - повторно не отправляем;
+ошибки, при которых сообщение точно не ушло (Telegram ответил ошибкой,
+не удалось подключиться), удаляют запись, и отправку можно повторить.
+
+Запись делается одним INSERT OR IGNORE в SQLite: он же и проверка, поэтому
+два процесса на одной машине (бот и check_pending.py) не отправят одно и
+то же дважды.
+
+Старые записи удаляются раз в час (SEND_LEDGER_RETENTION_DAYS).
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import Counter
+
+import requests
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+SEND_LEDGER_ENABLED = os.getenv("SEND_LEDGER_ENABLED", "1") not in ("0", "false", "False")
+SEND_LEDGER_PATH = os.getenv("SEND_LEDGER_PATH", "send_ledger.sqlite3")
+SEND_LEDGER_RETENTION_DAYS = float(os.getenv("SEND_LEDGER_RETENTION_DAYS", "14"))
+PRUNE_INTERVAL_SECONDS = 3600
+
+def definitely_not_delivered(error):
+    """Ошибка, после которой сообщение точно не дошло и отправку можно повторить."""
+    if isinstance(error, ApiTelegramException):
+        return True
+    return isinstance(error, requests.exceptions.ConnectTimeout)
+
+
+class SendLedger:
+    def __init__(self, path=SEND_LEDGER_PATH, retention_days=SEND_LEDGER_RETENTION_DAYS):
+        self.path = path
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self.checks = Counter()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS deliveries ("
+            " user_id TEXT NOT NULL, message_key TEXT NOT NULL, scheduled_at TEXT NOT NULL,"
+            " status TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL,"
+            " PRIMARY KEY (user_id, message_key, scheduled_at))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS deliveries_created_at ON deliveries (created_at)")
+        self.prune()
+
+    @staticmethod
+    def _key(user_id, message_key, scheduled_at):
+        return (str(user_id), str(message_key), str(scheduled_at))
+
+    def begin(self, user_id, message_key, scheduled_at):
+        """Записывает намерение отправить. False - уже отправлялось (дубль)."""
+        key = self._key(user_id, message_key, scheduled_at)
+        now = time.time()
+        with self.lock:
+            if now - self.pruned_at > PRUNE_INTERVAL_SECONDS:
+                self._prune_locked()
+            # Первичный ключ делает вставку проверкой: существующая запись - дубль
+            inserted = self.conn.execute(
+                "INSERT OR IGNORE INTO deliveries VALUES (?, ?, ?, 'sending', ?, ?)", key + (now, now)
+            ).rowcount
+            self.checks["new" if inserted else "duplicate"] += 1
+            return bool(inserted)
+
+    def finish(self, user_id, message_key, scheduled_at, error=None):
+        """Фиксирует итог отправки (error=None - успешно)."""
+        key = self._key(user_id, message_key, scheduled_at)
+        with self.lock:
+            if error is not None and definitely_not_delivered(error):
+                self.conn.execute(
+                    "DELETE FROM deliveries WHERE user_id=? AND message_key=? AND scheduled_at=?", key
+                )
+                return
+            status = "sent" if error is None else "unknown"
+            self.conn.execute(
+                "UPDATE deliveries SET status=?, updated_at=? WHERE user_id=? AND message_key=? AND scheduled_at=?",
+                (status, time.time()) + key,
+            )
+
+    def last_status(self, user_id, message_key, since=0):
+        """Статус последней записи по сообщению пользователю, созданной не раньше since (None - записи нет)."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT status FROM deliveries WHERE user_id=? AND message_key=? AND created_at>=? "
+                "ORDER BY created_at DESC LIMIT 1",
+                (str(user_id), str(message_key), since),
+            ).fetchone()
+        return row[0] if row else None
+
+    def prune(self):
+        with self.lock:
+            self._prune_locked()
+
+    def _prune_locked(self):
+        cutoff = time.time() - self.retention_days * 86400
+        removed = self.conn.execute("DELETE FROM deliveries WHERE created_at < ?", (cutoff,)).rowcount
+        self.pruned_at = time.time()
+        if removed:
+            logger.info(f"🧹 Журнал отправок: удалено {removed} записей старше {self.retention_days:g} дн.")
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM deliveries").fetchone()[0]
+            checks = self.checks["new"] + self.checks["duplicate"]
+            return {
+                "entries": entries,
+                "checks": checks,
+                "duplicates": self.checks["duplicate"],
+                "hit_rate": round(self.checks["duplicate"] / checks, 4) if checks else 0.0,
+            }
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    """Общий журнал процесса (None, если SEND_LEDGER_ENABLED=0)."""
+    global _ledger
+    if not SEND_LEDGER_ENABLED:
+        return None
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = SendLedger()
+        return _ledger
+
+
+def stats():
+    """Статистика общего журнала ({} если журнал отключен)."""
+    ledger = get_ledger()
+    return ledger.stats() if ledger else {}
@@ -0,0 +1,302 @@
+"""
+Отсев записей в Google Sheets, которые ничего не меняют.
+
+create_or_update_user на каждый /start заново пишет Username и Name,
+update_user_action на каждый callback - Last Action, хотя значения чаще
+всего те же. Для листов SHEET_WRITE_GUARD_WORKSHEETS (по умолчанию Users)
+здесь хранятся последние известные значения каждой строки и хэш от них.
+Значения берутся из собственных записей и чтений листа (get_all_values,
+row_values). Запись, после которой хэш строки не изменился бы, в Sheets не
+отправляется. Из batch_update выбрасываются такие диапазоны, а если не
+осталось ни одного, не отправляется весь вызов (записью здесь считается
+один вызов update_cell/update или один диапазон batch_update).
+
+Правки руками бот не видит, поэтому строка считается известной только
+SHEET_WRITE_CACHE_SECONDS секунд после последней записи или чтения. Если
+find по User ID нашел в строке другого пользователя (строки сдвинули), ее
+значения забываются. После вставки, удаления или сортировки строк
+забывается весь лист. Столбцы SHARED_COLUMNS (расписание и журнал
+отправок J:O) пишут и check_pending.py, и диспетчеры других хостов: их
+значениям в кэше верить нельзя, поэтому записи в них отправляются всегда.
+
+Лист Users под зеркалом (users_mirror.py) здесь не оборачивается: бот пишет
+в зеркало, и пустые записи отсеивает оно само, точно, по текущим значениям.
+Иначе отсев стоял бы под зеркалом и видел только его push.
+
+Отправленные и пропущенные записи считаются в одних единицах - вызовах
+записи бота (update_cell, update, диапазон batch_update) - и здесь, и в
+зеркале: метрика ai2biz_sheets_skipped_writes_total и блок sheet_writes в
+/ready.
+"""
+
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import Counter
+
+import metrics
+
+SHEET_WRITE_GUARD_ENABLED = os.getenv("SHEET_WRITE_GUARD_ENABLED", "1") not in ("0", "false", "False")
+SHEET_WRITE_GUARD_WORKSHEETS = {
+    title.strip() for title in os.getenv("SHEET_WRITE_GUARD_WORKSHEETS", "Users").split(",") if title.strip()
+}
+SHEET_WRITE_CACHE_SECONDS = float(os.getenv("SHEET_WRITE_CACHE_SECONDS", "300"))
+# Методы, которые сдвигают или стирают строки: после них номера строк в кэше неверны
+_SHIFTING_METHODS = {
+    "insert_row", "insert_rows", "delete_row", "delete_rows", "delete_dimension",
+    "sort", "clear", "batch_clear", "resize",
+}
+
+# J:O: эти столбцы меняют и другие процессы, кэшу их значений верить нельзя
+SHARED_COLUMNS = frozenset(range(10, 16))
+
+_RANGE_RE = re.compile(r"^(?:.*!)?([A-Z]+)(\d+)(?::([A-Z]+)(\d*))?$")
+
+
+def column_number(letters):
+    number = 0
+    for char in letters:
+        number = number * 26 + ord(char) - ord("A") + 1
+    return number
+
+
+def range_start(range_name):
+    """(строка, столбец) левой верхней ячейки диапазона вида "J5:K5" или "Users!G7" (None - не разобрать)."""
+    match = _RANGE_RE.match(range_name or "")
+    if not match:
+        return None
+    return int(match.group(2)), column_number(match.group(1))
+
+
+def _cells_by_row(first_row, first_col, values):
+    """{строка: {столбец: значение}} для прямоугольника values, начиная с (first_row, first_col)."""
+    return {
+        first_row + row_offset: {
+            first_col + col_offset: "" if value is None else str(value)
+            for col_offset, value in enumerate(row_values)
+        }
+        for row_offset, row_values in enumerate(values)
+    }
+
+
+class SkipStats:
+    """Записи, отправленные в Sheets и отброшенные как не меняющие лист, по листам и операциям."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = Counter()
+        self.skipped = Counter()
+
+    def record_sent(self, worksheet, operation, amount=1):
+        with self.lock:
+            self.sent[(worksheet, operation)] += amount
+
+    def record_skip(self, worksheet, operation, amount=1):
+        metrics.SHEETS_SKIPPED_WRITES.inc(amount, worksheet=worksheet, operation=operation)
+        with self.lock:
+            self.skipped[(worksheet, operation)] += amount
+
+    def snapshot(self):
+        with self.lock:
+            sent = sum(self.sent.values())
+            skipped = sum(self.skipped.values())
+            return {
+                "sent": sent,
+                "skipped": skipped,
+                "skipped_share": round(skipped / (sent + skipped), 4) if sent + skipped else 0.0,
+                "skipped_by_operation": {f"{worksheet}.{operation}": count
+                                         for (worksheet, operation), count in sorted(self.skipped.items())},
+            }
+
+
+STATS = SkipStats()
+
+
+def record_sent(worksheet, operation, amount=1):
+    STATS.record_sent(worksheet, operation, amount)
+
+
+def record_skip(worksheet, operation, amount=1):
+    STATS.record_skip(worksheet, operation, amount)
+
+
+def stats():
+    return STATS.snapshot()
+
+
+class RowHashes:
+    """Последние известные значения строк листа и хэш каждой строки."""
+
+    def __init__(self, ttl=SHEET_WRITE_CACHE_SECONDS, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        # строка -> (значения {столбец: значение}, хэш, момент записи или чтения)
+        self.rows = {}
+
+    @staticmethod
+    def digest(cells):
+        payload = "\x1e".join(f"{col}\x1f{cells[col]}" for col in sorted(cells))
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).digest()
+
+    def _known(self, row):
+        entry = self.rows.get(row)
+        if entry is None or self.clock() - entry[2] > self.ttl:
+            return None
+        return entry
+
+    def unchanged(self, row, cells):
+        """True, если запись cells не изменит известную строку row."""
+        if not SHARED_COLUMNS.isdisjoint(cells):
+            return False
+        with self.lock:
+            entry = self._known(row)
+            if entry is None:
+                return False
+            return self.digest({**entry[0], **cells}) == entry[1]
+
+    def remember(self, row, cells, replace=False):
+        with self.lock:
+            entry = self._known(row)
+            merged = dict(cells) if replace or entry is None else {**entry[0], **cells}
+            self.rows[row] = (merged, self.digest(merged), self.clock())
+
+    def check_key(self, row, key):
+        """find нашел пользователя key в строке row.
+
+        Если там помнился другой пользователь (или неизвестно какой - столбец 1
+        не запомнен), значения строки забываются, а запоминается key: иначе
+        сдвиг строк не заметить на следующем find.
+        """
+        with self.lock:
+            entry = self._known(row)
+            if entry is None or entry[0].get(1) != key:
+                cells = {1: key}
+                self.rows[row] = (cells, self.digest(cells), self.clock())
+
+    def forget(self, row=None):
+        with self.lock:
+            if row is None:
+                self.rows.clear()
+            else:
+                self.rows.pop(row, None)
+
+
+class GuardedWorksheet:
+    """Прокси над листом: не отправляет в Sheets записи, которые ничего не меняют."""
+
+    def __init__(self, worksheet, title, hashes):
+        self._worksheet = worksheet
+        self._title = title
+        self._hashes = hashes
+
+    def find(self, query, *args, **kwargs):
+        cell = self._worksheet.find(query, *args, **kwargs)
+        if cell is not None and cell.col == 1:
+            self._hashes.check_key(cell.row, str(query))
+        return cell
+
+    def row_values(self, row, **kwargs):
+        values = self._worksheet.row_values(row, **kwargs)
+        self._hashes.remember(row, _cells_by_row(row, 1, [values])[row])
+        return values
+
+    def get_all_values(self, **kwargs):
+        rows = self._worksheet.get_all_values(**kwargs)
+        width = max((len(cells) for cells in rows), default=0)
+        for row, cells in enumerate(rows, start=1):
+            # gspread не дополняет строки пустыми ячейками до ширины листа
+            padded = list(cells) + [""] * (width - len(cells))
+            self._hashes.remember(row, _cells_by_row(row, 1, [padded])[row], replace=True)
+        return rows
+
+    def update_cell(self, row, col, value):
+        cells = {col: "" if value is None else str(value)}
+        if self._hashes.unchanged(row, cells):
+            record_skip(self._title, "update_cell")
+            return None
+        result = self._worksheet.update_cell(row, col, value)
+        STATS.record_sent(self._title, "update_cell")
+        self._hashes.remember(row, cells)
+        return result
+
+    def update(self, range_name=None, values=None, **kwargs):
+        # gspread 6 принимает update(values, range_name), gspread 5 - update(range_name, values)
+        if isinstance(range_name, list):
+            range_name, values = values, range_name
+        start = range_start(range_name) if isinstance(range_name, str) else None
+        rows = _cells_by_row(*start, values) if start and values else None
+        if rows and all(self._hashes.unchanged(row, cells) for row, cells in rows.items()):
+            record_skip(self._title, "update")
+            return None
+        result = self._worksheet.update(range_name=range_name, values=values, **kwargs)
+        STATS.record_sent(self._title, "update")
+        if rows:
+            for row, cells in rows.items():
+                self._hashes.remember(row, cells)
+        return result
+
+    def batch_update(self, data, **kwargs):
+        pending = []
+        for item in data:
+            start = range_start(item["range"])
+            rows = _cells_by_row(*start, item["values"]) if start else None
+            if rows and all(self._hashes.unchanged(row, cells) for row, cells in rows.items()):
+                continue
+            pending.append((item, rows))
+        # batch_update считается по диапазонам: каждый - отдельная запись
+        if len(pending) < len(data):
+            record_skip(self._title, "batch_update", len(data) - len(pending))
+        if not pending:
+            return None
+        result = self._worksheet.batch_update([item for item, _ in pending], **kwargs)
+        STATS.record_sent(self._title, "batch_update", len(pending))
+        for _, rows in pending:
+            for row, cells in (rows or {}).items():
+                self._hashes.remember(row, cells)
+        return result
+
+    def __getattr__(self, name):
+        attr = getattr(self._worksheet, name)
+        if name in _SHIFTING_METHODS and callable(attr):
+            def shifting(*args, **kwargs):
+                self._hashes.forget()
+                return attr(*args, **kwargs)
+            return shifting
+        return attr
+
+
+class GuardedSpreadsheet:
+    """Таблица, листы SHEET_WRITE_GUARD_WORKSHEETS которой отдаются через GuardedWorksheet."""
+
+    def __init__(self, spreadsheet, titles=SHEET_WRITE_GUARD_WORKSHEETS):
+        self._spreadsheet = spreadsheet
+        self._titles = set(titles)
+        # Кэш строк общий для всех объектов одного листа
+        self._hashes = {title: RowHashes() for title in self._titles}
+
+    def worksheet(self, title):
+        worksheet = self._spreadsheet.worksheet(title)
+        if title in self._hashes:
+            return GuardedWorksheet(worksheet, title, self._hashes[title])
+        return worksheet
+
+    def __getattr__(self, name):
+        return getattr(self._spreadsheet, name)
+
+
+def attach(spreadsheet):
+    """Оборачивает таблицу отсевом пустых записей (без SHEET_WRITE_GUARD_ENABLED - таблица как есть).
+
+    Подключается поверх зеркала Users: лист под зеркалом не оборачивается.
+    """
+    if spreadsheet is None or not SHEET_WRITE_GUARD_ENABLED or isinstance(spreadsheet, GuardedSpreadsheet):
+        return spreadsheet
+    titles = set(SHEET_WRITE_GUARD_WORKSHEETS)
+    if getattr(spreadsheet, "mirror", None) is not None:
+        titles.discard("Users")
+    if not titles:
+        return spreadsheet
+    return GuardedSpreadsheet(spreadsheet, titles)
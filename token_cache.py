@@ -0,0 +1,155 @@
+"""
+Кэш OAuth-токена сервисного аккаунта Google между перезапусками.
+
+gspread.service_account_from_dict при каждом старте ходит в token endpoint
+за новым токеном. Здесь токен и его срок жизни хранятся в файле с правами
+0600 и переиспользуются, пока до истечения остается больше
+GOOGLE_TOKEN_REFRESH_MARGIN секунд. Долгоживущий процесс (бот, демон
+check_pending) обновляет токен в фоне заранее, чтобы запросы к Sheets
+не ждали обновления.
+
+Выигрыш на старте оценивается по длительности последнего реального
+обновления токена, которая хранится в том же файле.
+"""
+
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+
+import gspread
+from gspread.auth import DEFAULT_SCOPES
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+
+import http_transport
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CACHE_PATH = os.getenv("GOOGLE_TOKEN_CACHE_PATH", ".google_token_cache.json")
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN", "300"))
+# Пауза перед повтором, если фоновое обновление не удалось
+REFRESH_RETRY_SECONDS = 60
+
+# Как был получен токен при последнем authorize() (для /ready и логов)
+last_start = {"source": None, "auth_ms": None, "saved_ms": None, "expires_at": None}
+
+_refresh_lock = threading.Lock()
+
+
+def _utcnow():
+    # google-auth хранит expiry как naive UTC
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _read_cache(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_cache(path, data):
+    """Атомарно записывает кэш с правами 0600."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".token-", dir=directory)
+    try:
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _cache_key(info, scopes):
+    return {"client_email": info.get("client_email"), "scopes": sorted(scopes)}
+
+
+def refresh_credentials(credentials, info, scopes=DEFAULT_SCOPES, path=TOKEN_CACHE_PATH):
+    """Получает новый токен и сохраняет его в кэш. Возвращает длительность в мс."""
+    with _refresh_lock:
+        t0 = time.perf_counter()
+        credentials.refresh(Request())
+        refresh_ms = round((time.perf_counter() - t0) * 1000, 1)
+        cached = _read_cache(path)
+        data = dict(_cache_key(info, scopes))
+        data.update({
+            "token": credentials.token,
+            "expiry": credentials.expiry.isoformat(),
+            "refresh_ms": refresh_ms,
+            "starts_from_cache": cached.get("starts_from_cache", 0),
+            "saved_ms_total": cached.get("saved_ms_total", 0.0),
+        })
+        try:
+            _write_cache(path, data)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить кэш OAuth-токена {path}: {e}")
+    return refresh_ms
+
+
+def authorize(info, scopes=DEFAULT_SCOPES, path=TOKEN_CACHE_PATH):
+    """Аналог gspread.service_account_from_dict с кэшем токена на диске."""
+    t0 = time.perf_counter()
+    credentials = Credentials.from_service_account_info(info=info, scopes=scopes)
+    cached = _read_cache(path)
+    expiry = None
+    if cached.get("token") and {k: cached.get(k) for k in ("client_email", "scopes")} == _cache_key(info, scopes):
+        try:
+            expiry = datetime.fromisoformat(cached["expiry"])
+        except (KeyError, TypeError, ValueError):
+            expiry = None
+
+    if expiry and expiry - _utcnow() > timedelta(seconds=TOKEN_REFRESH_MARGIN_SECONDS):
+        credentials.token = cached["token"]
+        credentials.expiry = expiry
+        saved_ms = cached.get("refresh_ms") or 0.0
+        cached["starts_from_cache"] = cached.get("starts_from_cache", 0) + 1
+        cached["saved_ms_total"] = round(cached.get("saved_ms_total", 0.0) + saved_ms, 1)
+        try:
+            _write_cache(path, cached)
+        except OSError:
+            pass
+        last_start.update(source="cache", saved_ms=saved_ms)
+        logger.info(
+            f"🔑 OAuth-токен взят из кэша (действует до {expiry:%H:%M:%S} UTC), "
+            f"сэкономлено ~{saved_ms:.0f} мс; всего за {cached['starts_from_cache']} "
+            f"запусков ~{cached['saved_ms_total'] / 1000:.1f} с"
+        )
+    else:
+        refresh_ms = refresh_credentials(credentials, info, scopes, path)
+        last_start.update(source="refresh", saved_ms=0.0)
+        logger.info(f"🔑 Получен новый OAuth-токен за {refresh_ms:.0f} мс")
+
+    last_start["auth_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    last_start["expires_at"] = credentials.expiry.isoformat() if credentials.expiry else None
+    return gspread.Client(auth=credentials, session=http_transport.sheets_session(credentials))
+
+
+def start_background_refresh(client, info, scopes=DEFAULT_SCOPES, path=TOKEN_CACHE_PATH):
+    """Фоновый поток, обновляющий токен за TOKEN_REFRESH_MARGIN секунд до истечения."""
+    credentials = client.auth
+
+    def loop():
+        while True:
+            expiry = credentials.expiry or _utcnow()
+            wait = (expiry - _utcnow()).total_seconds() - TOKEN_REFRESH_MARGIN_SECONDS
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                refresh_ms = refresh_credentials(credentials, info, scopes, path)
+                last_start["expires_at"] = credentials.expiry.isoformat()
+                logger.info(f"🔑 OAuth-токен обновлен в фоне за {refresh_ms:.0f} мс")
+            except Exception as e:
+                logger.warning(f"⚠️ Фоновое обновление OAuth-токена не удалось: {e}")
+                time.sleep(REFRESH_RETRY_SECONDS)
+
+    thread = threading.Thread(target=loop, name="oauth-token-refresh", daemon=True)
+    thread.start()
+    return thread
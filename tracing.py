@@ -0,0 +1,186 @@
+"""
+Легковесная трассировка апдейтов AI2BIZ бота.
+На каждый апдейт в webhook() открывается корневой спан, внутри него - спаны
+хендлеров, вызовов Google Sheets и Telegram. Медленные апдейты логируются
+с деревом спанов; выборка трейсов может выгружаться в файл в формате OTLP JSON.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") not in ("0", "false", "False")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "2000"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+SERVICE_NAME = "ai2biz-bot"
+
+_current_span = contextvars.ContextVar("ai2biz_current_span", default=None)
+_export_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent", "attributes",
+                 "children", "start_ns", "end_ns", "status")
+
+    def __init__(self, name, trace_id, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent = parent
+        self.attributes = dict(attributes or {})
+        self.children = []
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = "ok"
+        if parent is not None:
+            parent.children.append(self)
+
+    @property
+    def duration_ms(self):
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def finish(self):
+        self.end_ns = time.time_ns()
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+def format_span_tree(span, depth=0):
+    """Текстовое дерево спанов с длительностями."""
+    attrs = " ".join(f"{key}={value}" for key, value in span.attributes.items())
+    status = "" if span.status == "ok" else f" [{span.status}]"
+    lines = [f"{'  ' * depth}{span.name} {span.duration_ms:.1f} мс{status}{(' ' + attrs) if attrs else ''}"]
+    for child in span.children:
+        lines.extend(format_span_tree(child, depth + 1))
+    return lines
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def to_otlp(root):
+    """Сериализует трейс в структуру OTLP/JSON (ExportTraceServiceRequest)."""
+    spans = []
+    for span in root.walk():
+        item = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 2 if span.parent is None else 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns or span.start_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+            "status": {"code": 2 if span.status == "error" else 1},
+        }
+        if span.parent is not None:
+            item["parentSpanId"] = span.parent.span_id
+        spans.append(item)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": "ai2biz.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+def _export(root):
+    if not TRACE_EXPORT_PATH:
+        return
+    try:
+        line = json.dumps(to_otlp(root), ensure_ascii=False)
+        with _export_lock:
+            with open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except Exception as e:
+        logger.error(f"❌ Ошибка экспорта трейса: {e}")
+
+
+def _finish_trace(root, sampled):
+    if root.duration_ms >= TRACE_SLOW_MS:
+        logger.warning(
+            "🐢 Медленный апдейт (%.0f мс):\n%s", root.duration_ms, "\n".join(format_span_tree(root))
+        )
+    if sampled:
+        _export(root)
+
+
+@contextmanager
+def start_trace(name, **attributes):
+    """Открывает корневой спан (один на апдейт или проход диспетчера)."""
+    if not TRACING_ENABLED or _current_span.get() is not None:
+        with span(name, **attributes) as current:
+            yield current
+        return
+    root = Span(name, "%032x" % random.getrandbits(128), attributes=attributes)
+    sampled = random.random() < TRACE_SAMPLE_RATE
+    token = _current_span.set(root)
+    try:
+        yield root
+    except Exception:
+        root.status = "error"
+        raise
+    finally:
+        root.finish()
+        _current_span.reset(token)
+        _finish_trace(root, sampled)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Дочерний спан текущего трейса; без активного трейса ничего не делает."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, parent.trace_id, parent=parent, attributes=attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except Exception:
+        child.status = "error"
+        raise
+    finally:
+        child.finish()
+        _current_span.reset(token)
+
+
+def set_attribute(key, value):
+    """Добавляет атрибут к текущему спану (если трейс активен)."""
+    current = _current_span.get()
+    if current is not None:
+        current.attributes[key] = value
+
+
+def traced(name=None):
+    """Декоратор: оборачивает вызов функции в спан."""
+    def decorator(function):
+        span_name = name or function.__name__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return function(*args, **kwargs)
+            with span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
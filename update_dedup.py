@@ -0,0 +1,152 @@
+"""
+Защита от повторной доставки апдейтов Telegram.
+
+Если хендлер отвечает дольше таймаута Telegram, тот же апдейт приходит
+снова, и send_welcome_internal / finish_form_consultation отрабатывают
+дважды: двойные записи в Sheets, уведомления админу и отправки. Перед
+обработкой update_id захватывается в ограниченном LRU последних
+UPDATE_DEDUP_SIZE апдейтов; повтор подтверждается без обработки.
+
+UPDATE_DEDUP_PATH включает общий для воркеров gunicorn журнал в SQLite
+(INSERT OR IGNORE, как в send_ledger.py): повтор, пришедший в другой
+воркер, тоже отсекается. Записи старше UPDATE_DEDUP_RETENTION_HOURS
+удаляются - Telegram хранит неподтвержденные апдейты не дольше суток.
+
+Если обработка не удалась (ошибка или очередь до готовности переполнена),
+update_id освобождается, и повторная доставка обработает апдейт заново.
+Захват, который не завершился за UPDATE_DEDUP_CLAIM_TTL секунд (воркер
+убили посреди апдейта), истекает: повторная доставка захватывает апдейт
+заново и обрабатывает его.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import Counter, OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+UPDATE_DEDUP_PATH = os.getenv("UPDATE_DEDUP_PATH", "")
+UPDATE_DEDUP_RETENTION_HOURS = float(os.getenv("UPDATE_DEDUP_RETENTION_HOURS", "24"))
+# Дольше любого нормального апдейта, но меньше интервала повторных доставок Telegram
+UPDATE_DEDUP_CLAIM_TTL = float(os.getenv("UPDATE_DEDUP_CLAIM_TTL", "120"))
+PRUNE_INTERVAL_SECONDS = 600
+
+
+class RecentUpdates:
+    """LRU последних update_id процесса; при необходимости с общим журналом в SQLite."""
+
+    def __init__(self, capacity=UPDATE_DEDUP_SIZE, path=UPDATE_DEDUP_PATH,
+                 retention_hours=UPDATE_DEDUP_RETENTION_HOURS, claim_ttl=UPDATE_DEDUP_CLAIM_TTL):
+        self.capacity = capacity
+        self.retention_seconds = retention_hours * 3600
+        self.claim_ttl = claim_ttl
+        self.lock = threading.Lock()
+        # update_id -> время захвата, пока апдейт обрабатывается; None - обработан
+        self.recent = OrderedDict()
+        self.checks = Counter()
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS updates ("
+                " update_id INTEGER PRIMARY KEY, seen_at REAL NOT NULL, done INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS updates_seen_at ON updates (seen_at)")
+        self.pruned_at = 0.0
+
+    def claim(self, update_id):
+        """Захватывает update_id. False - апдейт уже обработан или обрабатывается (повтор)."""
+        with self.lock:
+            now = time.time()
+            if update_id in self.recent:
+                claimed_at = self.recent[update_id]
+                if claimed_at is None or now - claimed_at < self.claim_ttl:
+                    self.recent.move_to_end(update_id)
+                    self.checks["duplicate"] += 1
+                    return False
+            if self.conn is not None:
+                if now - self.pruned_at > PRUNE_INTERVAL_SECONDS:
+                    self._prune_locked(now)
+                inserted = self.conn.execute(
+                    "INSERT OR IGNORE INTO updates (update_id, seen_at, done) VALUES (?, ?, 0)", (update_id, now)
+                ).rowcount
+                if not inserted:
+                    # Незавершенный захват старше claim_ttl перехватываем: его воркер, скорее всего, убит
+                    inserted = self.conn.execute(
+                        "UPDATE updates SET seen_at=? WHERE update_id=? AND done=0 AND seen_at<?",
+                        (now, update_id, now - self.claim_ttl),
+                    ).rowcount
+                    if not inserted:
+                        self.checks["duplicate_shared"] += 1
+                        return False
+                    self.checks["expired"] += 1
+            elif update_id in self.recent:
+                self.checks["expired"] += 1
+            self.recent[update_id] = now
+            self.recent.move_to_end(update_id)
+            if len(self.recent) > self.capacity:
+                self.recent.popitem(last=False)
+            self.checks["new"] += 1
+            return True
+
+    def finish(self, update_id):
+        """Апдейт обработан: дальше его повторы отсекаются без срока."""
+        with self.lock:
+            if update_id in self.recent:
+                self.recent[update_id] = None
+            if self.conn is not None:
+                self.conn.execute("UPDATE updates SET done=1 WHERE update_id=?", (update_id,))
+
+    def release(self, update_id):
+        """Снимает захват: апдейт не обработан, его повторная доставка должна пройти."""
+        with self.lock:
+            self.recent.pop(update_id, None)
+            if self.conn is not None:
+                self.conn.execute("DELETE FROM updates WHERE update_id=?", (update_id,))
+            self.checks["released"] += 1
+
+    def _prune_locked(self, now):
+        removed = self.conn.execute(
+            "DELETE FROM updates WHERE seen_at < ?", (now - self.retention_seconds,)
+        ).rowcount
+        self.pruned_at = now
+        if removed:
+            logger.info(f"🧹 Журнал апдейтов: удалено {removed} записей")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.recent),
+                "checks": self.checks["new"] + self.checks["duplicate"] + self.checks["duplicate_shared"],
+                "duplicates": self.checks["duplicate"] + self.checks["duplicate_shared"],
+                "duplicates_shared": self.checks["duplicate_shared"],
+                "released": self.checks["released"],
+                "expired": self.checks["expired"],
+            }
+
+
+recent_updates = RecentUpdates()
+metrics.UPDATE_DEDUP.set_function(lambda: recent_updates.stats())
+
+
+def claim(update_id):
+    return recent_updates.claim(update_id)
+
+
+def finish(update_id):
+    recent_updates.finish(update_id)
+
+
+def release(update_id):
+    recent_updates.release(update_id)
+
+
+def stats():
+    return recent_updates.stats()
@@ -0,0 +1,573 @@
+"""
+Локальное зеркало листа Users в SQLite.
+
+Каждый find/update_cell по листу Users - это сотни миллисекунд до Google
+Sheets. Бот читает и пишет Users через зеркало: SQLite-файл
+USERS_MIRROR_PATH со всеми 15 столбцами листа. google_sheets.worksheet("Users")
+возвращает MirroredUsersWorksheet с тем же подмножеством API gspread (find,
+update_cell, update, append_row, row_values, get_all_records), поэтому
+вызывающий код не меняется, а поиск пользователя занимает микросекунды.
+
+Номера строк, которые видит бот, - локальные (row_id зеркала + 1), а не
+номера строк таблицы. Фоновый синхронизатор:
+- раз в USERS_SYNC_PUSH_SECONDS, если в зеркале есть изменения, читает
+  лист, забирает правки из таблицы и отправляет в Sheets только измененные
+  ячейки (batch_update пачками по USERS_SYNC_BATCH_RANGES диапазонов,
+  новые пользователи - одним append_rows). Номера строк таблицы берутся
+  из только что прочитанного листа, поэтому вставка или сортировка строк
+  руками записи не сбивает;
+- без изменений в зеркале лист читается раз в USERS_SYNC_PULL_SECONDS,
+  чтобы забрать правки, сделанные руками или check_pending.py.
+
+Пустые записи отсеиваются здесь же (sheet_writes.py лист под зеркалом не
+оборачивает): запись, не меняющая ячейку зеркала, не делает ее измененной,
+а ячейка, вернувшаяся к значению в таблице до push, не отправляется.
+
+Для каждой ячейки хранится значение, последнее синхронизированное с
+таблицей. Если с тех пор изменились и таблица, и зеркало, это конфликт:
+столбцы SHEET_WINS_COLUMNS берутся из таблицы, остальные (состояние и
+действия ведет только бот) - из зеркала. В SHEET_WINS_COLUMNS кроме имени
+и квалификации лида (их ведут руками) входит расписание и журнал отправок
+J:O: их меняют и check_pending.py, и диспетчеры других хостов, и зеркало
+не должно откатывать их захваты и продвижение по цепочке.
+
+Расписание и журнал отправок FollowUpScheduler (диспетчер просроченных
+строк, update_sheet_schedule, update_send_log) через очередь зеркала не
+пишет: строки, которые уже захватили check_pending.py или другой хост, в
+зеркале выглядели бы просроченными до следующего pull, а отложенная запись
+J:K (например, перезапуск цепочки по /start) проиграла бы при конфликте.
+Эти чтения и записи идут в саму таблицу через direct_users_worksheet
+(WriteThroughUsersWorksheet) и сразу отражаются в зеркале как
+синхронизированные.
+
+Файл зеркала общий для всех воркеров gunicorn: каждое чтение-изменение-
+запись строки (dirty, version, base) выполняется в транзакции BEGIN
+IMMEDIATE, поэтому правки двух воркеров в одной строке не теряются.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+import metrics
+import sheet_writes
+
+logger = logging.getLogger(__name__)
+
+USERS_MIRROR_ENABLED = os.getenv("USERS_MIRROR_ENABLED", "1") not in ("0", "false", "False")
+USERS_MIRROR_PATH = os.getenv("USERS_MIRROR_PATH", "users_mirror.sqlite3")
+USERS_SYNC_PUSH_SECONDS = float(os.getenv("USERS_SYNC_PUSH_SECONDS", "5"))
+USERS_SYNC_PULL_SECONDS = float(os.getenv("USERS_SYNC_PULL_SECONDS", "60"))
+USERS_SYNC_BATCH_RANGES = int(os.getenv("USERS_SYNC_BATCH_RANGES", "500"))
+
+HEADERS = [
+    "User ID", "Username", "Name", "Started",
+    "Last Action", "State", "Lead Quality", "Answers", "Messages Sent",
+    "Next Scheduled Message", "Run Date", "Chat ID",
+    "Last Sent Message", "Last Sent At", "Last Send Status",
+]
+COLUMNS = [
+    "user_id", "username", "name", "started",
+    "last_action", "state", "lead_quality", "answers", "messages_sent",
+    "next_message", "run_date", "chat_id",
+    "last_sent_message", "last_sent_at", "last_send_status",
+]
+COLUMN_LETTERS = "ABCDEFGHIJKLMNO"
+# При конфликте эти столбцы берутся из таблицы, остальные - из зеркала.
+# J:O (расписание и журнал отправок) пишут и другие процессы
+SCHEDULE_COLUMNS = {"next_message", "run_date", "chat_id", "last_sent_message", "last_sent_at", "last_send_status"}
+SHEET_WINS_COLUMNS = {"name", "lead_quality", "answers"} | SCHEDULE_COLUMNS
+
+Cell = namedtuple("Cell", "row col value")
+
+
+def _padded(values):
+    cells = ["" if v is None else str(v) for v in list(values)[:len(COLUMNS)]]
+    return cells + [""] * (len(COLUMNS) - len(cells))
+
+
+def _dirty_runs(mask):
+    """Непрерывные отрезки измененных столбцов: [(первый, последний), ...] с нумерацией с 0."""
+    runs = []
+    col = 0
+    while col < len(COLUMNS):
+        if mask & (1 << col):
+            start = col
+            while col + 1 < len(COLUMNS) and mask & (1 << (col + 1)):
+                col += 1
+            runs.append((start, col))
+        col += 1
+    return runs
+
+
+class UsersMirror:
+    def __init__(self, path=USERS_MIRROR_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " row_id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            + "".join(f" {name} TEXT NOT NULL DEFAULT ''," for name in COLUMNS)
+            + " base TEXT,"  # JSON: значения, последние синхронизированные с таблицей (NULL - строки там еще нет)
+            " dirty INTEGER NOT NULL DEFAULT 0,"  # битовая маска столбцов, измененных в зеркале
+            " version INTEGER NOT NULL DEFAULT 0,"
+            " UNIQUE (user_id))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS users_dirty ON users (dirty) WHERE dirty != 0")
+        self._select = f"SELECT row_id, {', '.join(COLUMNS)}, base, dirty, version FROM users"
+        self._stop = threading.Event()
+        self._thread = None
+
+    @contextmanager
+    def _transaction(self):
+        """Чтение-изменение-запись строк под BEGIN IMMEDIATE: файл зеркала делят воркеры gunicorn."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    # ===== ЧТЕНИЕ =====
+    def local_row(self, user_id):
+        row = self.conn.execute("SELECT row_id FROM users WHERE user_id=?", (str(user_id),)).fetchone()
+        return row[0] + 1 if row else None
+
+    def values(self, local_row):
+        row = self.conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM users WHERE row_id=?", (local_row - 1,)
+        ).fetchone()
+        return list(row) if row else None
+
+    def get(self, user_id):
+        row = self.conn.execute(
+            f"SELECT {', '.join(COLUMNS)} FROM users WHERE user_id=?", (str(user_id),)
+        ).fetchone()
+        return dict(zip(HEADERS, row)) if row else None
+
+    def rows(self):
+        """[(локальная строка, значения)] по порядку строк."""
+        with self.lock:
+            return [(row[0] + 1, list(row[1:])) for row in
+                    self.conn.execute(f"SELECT row_id, {', '.join(COLUMNS)} FROM users ORDER BY row_id")]
+
+    # ===== ЗАПИСЬ =====
+    def set_cells(self, local_row, changes):
+        """changes: {номер столбца с 1: значение}. Меняет только отличающиеся ячейки.
+
+        Возвращает число измененных ячеек (None - строки нет).
+        """
+        with self._transaction():
+            row = self.conn.execute(f"{self._select} WHERE row_id=?", (local_row - 1,)).fetchone()
+            if row is None:
+                return None
+            current = list(row[1:1 + len(COLUMNS)])
+            dirty = row[-2]
+            assignments = []
+            params = []
+            for col, value in changes.items():
+                index = col - 1
+                value = "" if value is None else str(value)
+                # User ID - ключ синхронизации, его не меняем
+                if index <= 0 or index >= len(COLUMNS) or current[index] == value:
+                    continue
+                assignments.append(f"{COLUMNS[index]}=?")
+                params.append(value)
+                dirty |= 1 << index
+            if not assignments:
+                return 0
+            self.conn.execute(
+                f"UPDATE users SET {', '.join(assignments)}, dirty=?, version=version+1 WHERE row_id=?",
+                params + [dirty, local_row - 1],
+            )
+            self.counters["local_writes"] += 1
+            return len(assignments)
+
+    def insert(self, values):
+        """Новая строка (append_row). Возвращает локальный номер строки."""
+        cells = _padded(values)
+        with self.lock:
+            cursor = self.conn.execute(
+                f"INSERT OR IGNORE INTO users ({', '.join(COLUMNS)}, base, dirty) "
+                f"VALUES ({', '.join('?' * len(COLUMNS))}, NULL, ?)",
+                cells + [(1 << len(COLUMNS)) - 1],
+            )
+            if cursor.rowcount:
+                self.counters["local_inserts"] += 1
+                return cursor.lastrowid + 1
+        # Пользователь уже есть: append_row превращается в обновление его строки
+        existing = self.local_row(cells[0])
+        self.set_cells(existing, {col: value for col, value in enumerate(cells, start=1) if col > 1})
+        return existing
+
+    def set_synced(self, user_id, changes):
+        """Отражает запись, уже сделанную прямо в таблице: changes {номер столбца с 1: значение}.
+
+        Ячейки становятся синхронизированными (значение и base), их несохраненные правки отбрасываются.
+        """
+        with self._transaction():
+            row = self.conn.execute(f"{self._select} WHERE user_id=?", (str(user_id),)).fetchone()
+            if row is None:
+                return
+            values = list(row[1:1 + len(COLUMNS)])
+            base = json.loads(row[-3]) if row[-3] else None
+            dirty = row[-2]
+            for col, value in changes.items():
+                index = col - 1
+                if index <= 0 or index >= len(COLUMNS):
+                    continue
+                values[index] = "" if value is None else str(value)
+                if base is not None:
+                    base[index] = values[index]
+                    dirty &= ~(1 << index)
+            self.conn.execute(
+                f"UPDATE users SET {', '.join(f'{name}=?' for name in COLUMNS[1:])}, base=?, dirty=?, "
+                f"version=version+1 WHERE row_id=?",
+                values[1:] + [json.dumps(base, ensure_ascii=False) if base is not None else None, dirty, row[0]],
+            )
+            self.counters["direct_writes"] += 1
+
+    # ===== СИНХРОНИЗАЦИЯ =====
+    def has_dirty(self):
+        return self.conn.execute("SELECT 1 FROM users WHERE dirty != 0 LIMIT 1").fetchone() is not None
+
+    def push(self, worksheet, positions=None):
+        """Отправляет измененные ячейки в таблицу. Возвращает число строк.
+
+        positions - {User ID: номер строки таблицы}; без него читается столбец A.
+        """
+        with self.lock:
+            pending = self.conn.execute(f"{self._select} WHERE dirty != 0 ORDER BY row_id").fetchall()
+        if not pending:
+            return 0
+        if positions is None:
+            positions = {}
+            for index, cells in enumerate(worksheet.get_values("A2:A"), start=2):
+                if cells and cells[0]:
+                    positions.setdefault(str(cells[0]), index)
+
+        updates = []
+        appends = []
+        reverted = 0
+        for row in pending:
+            values = list(row[1:1 + len(COLUMNS)])
+            sheet_row = positions.get(values[0])
+            if sheet_row is None:
+                appends.append(values)
+                continue
+            mask = row[-2]
+            if row[-3]:
+                # Ячейки, которые с прошлой синхронизации вернулись к значению в таблице, не отправляем
+                base = json.loads(row[-3])
+                for index in range(len(COLUMNS)):
+                    if mask & (1 << index) and values[index] == base[index]:
+                        mask &= ~(1 << index)
+                        reverted += 1
+            for first, last in _dirty_runs(mask):
+                updates.append({
+                    "range": f"{COLUMN_LETTERS[first]}{sheet_row}:{COLUMN_LETTERS[last]}{sheet_row}",
+                    "values": [values[first:last + 1]],
+                })
+        for start in range(0, len(updates), USERS_SYNC_BATCH_RANGES):
+            worksheet.batch_update(updates[start:start + USERS_SYNC_BATCH_RANGES])
+        if appends:
+            worksheet.append_rows(appends, value_input_option="RAW")
+
+        with self._transaction():
+            for row in pending:
+                values = list(row[1:1 + len(COLUMNS)])
+                # Если строку успели изменить во время отправки - она остается грязной
+                self.conn.execute(
+                    "UPDATE users SET base=?, dirty=CASE WHEN version=? THEN 0 ELSE dirty END WHERE row_id=?",
+                    (json.dumps(values, ensure_ascii=False), row[-1], row[0]),
+                )
+        self.counters["pushed_rows"] += len(pending)
+        self.counters["pushed_ranges"] += len(updates)
+        self.counters["appended_rows"] += len(appends)
+        self.counters["reverted_cells"] += reverted
+        return len(pending)
+
+    def pull(self, worksheet):
+        """Забирает правки из таблицы с разрешением конфликтов по столбцам.
+
+        Возвращает {User ID: номер строки таблицы} для следующего push.
+        """
+        positions = {}
+        remote_rows = {}
+        for index, cells in enumerate(worksheet.get_all_values()[1:], start=2):
+            if cells and cells[0] and str(cells[0]) not in remote_rows:
+                positions[str(cells[0])] = index
+                remote_rows[str(cells[0])] = _padded(cells)
+
+        changed = conflicts = 0
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                local_ids = set()
+                for row in self.conn.execute(self._select).fetchall():
+                    row_id, values, base, dirty = row[0], list(row[1:1 + len(COLUMNS)]), row[-3], row[-2]
+                    local_ids.add(values[0])
+                    remote = remote_rows.get(values[0])
+                    if remote is None:
+                        # Строку удалили в таблице руками: удаляем и здесь, если в зеркале нет несохраненных правок
+                        if base is not None and not dirty:
+                            self.conn.execute("DELETE FROM users WHERE row_id=?", (row_id,))
+                            self.counters["pulled_deletes"] += 1
+                        continue
+                    base = json.loads(base) if base else list(remote)
+                    new_base = list(base)
+                    updated = False
+                    for index in range(1, len(COLUMNS)):
+                        if remote[index] == base[index]:
+                            continue
+                        new_base[index] = remote[index]
+                        updated = True
+                        bit = 1 << index
+                        if dirty & bit:
+                            conflicts += 1
+                            if COLUMNS[index] not in SHEET_WINS_COLUMNS:
+                                continue
+                            dirty &= ~bit
+                        values[index] = remote[index]
+                        changed += 1
+                    if updated or row[-3] is None:
+                        self.conn.execute(
+                            f"UPDATE users SET {', '.join(f'{name}=?' for name in COLUMNS[1:])}, base=?, dirty=? "
+                            f"WHERE row_id=?",
+                            values[1:] + [json.dumps(new_base, ensure_ascii=False), dirty, row_id],
+                        )
+                for user_id, remote in remote_rows.items():
+                    if user_id not in local_ids:
+                        self.conn.execute(
+                            f"INSERT INTO users ({', '.join(COLUMNS)}, base, dirty) "
+                            f"VALUES ({', '.join('?' * len(COLUMNS))}, ?, 0)",
+                            remote + [json.dumps(remote, ensure_ascii=False)],
+                        )
+                        self.counters["pulled_rows"] += 1
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        self.counters["pulled_cells"] += changed
+        self.counters["conflicts"] += conflicts
+        if changed or conflicts:
+            logger.info(f"🔄 Users: из таблицы получено {changed} изменений, конфликтов {conflicts}")
+        return positions
+
+    def sync(self, worksheet):
+        """Полный цикл: правки из таблицы, затем свои (конфликты видны до записи). Возвращает число строк."""
+        return self.push(worksheet, self.pull(worksheet))
+
+    def start_sync(self, worksheet, push_interval=USERS_SYNC_PUSH_SECONDS, pull_interval=USERS_SYNC_PULL_SECONDS):
+        """Первичная синхронизация и фоновый поток push/pull."""
+        started = time.perf_counter()
+        self.sync(worksheet)
+        logger.info(f"✅ Зеркало Users: {self.stats()['rows']} строк за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+        def loop():
+            pulled_at = time.monotonic()
+            while not self._stop.wait(push_interval):
+                try:
+                    if self.has_dirty():
+                        pulled_at = time.monotonic()
+                        self.sync(worksheet)
+                    elif time.monotonic() - pulled_at >= pull_interval:
+                        pulled_at = time.monotonic()
+                        self.pull(worksheet)
+                except Exception as e:
+                    self.counters["sync_errors"] += 1
+                    logger.error(f"❌ Синхронизация зеркала Users: {e}")
+
+        self._thread = threading.Thread(target=loop, name="users-mirror-sync", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, worksheet=None):
+        """Останавливает фоновый поток и (если передан лист) отправляет оставшиеся правки."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if worksheet is not None and self.has_dirty():
+            self.sync(worksheet)
+
+    def stats(self):
+        with self.lock:
+            rows, dirty = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(dirty != 0), 0) FROM users"
+            ).fetchone()
+            result = {"rows": rows, "dirty_rows": dirty}
+            result.update(self.counters)
+            return result
+
+
+class MirroredUsersWorksheet:
+    """Лист Users поверх зеркала: подмножество API gspread.Worksheet, которое использует бот."""
+
+    title = "Users"
+
+    def __init__(self, mirror, worksheet):
+        self._mirror = mirror
+        self._worksheet = worksheet
+
+    def find(self, query, in_row=None, in_column=None, case_sensitive=True):
+        with metrics.USERS_MIRROR_READ_LATENCY.time():
+            # Бот ищет пользователей по User ID; поиск по другим столбцам зеркало не индексирует
+            if in_row is None and in_column in (None, 1):
+                row = self._mirror.local_row(query)
+                return Cell(row, 1, str(query)) if row else None
+        return None
+
+    def row_values(self, row, **kwargs):
+        if row == 1:
+            return list(HEADERS)
+        with metrics.USERS_MIRROR_READ_LATENCY.time():
+            values = self._mirror.values(row) or []
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def update_cell(self, row, col, value):
+        changed = self._mirror.set_cells(row, {col: value})
+        if changed == 0:
+            sheet_writes.record_skip(self.title, "update_cell")
+        elif changed:
+            sheet_writes.record_sent(self.title, "update_cell")
+
+    def update(self, range_name=None, values=None, **kwargs):
+        if isinstance(range_name, list):
+            range_name, values = values, range_name
+        start = sheet_writes.range_start(range_name)
+        if not start:
+            raise ValueError(f"Неподдерживаемый диапазон листа Users: {range_name}")
+        first_row, first_col = start
+        changed = [
+            self._mirror.set_cells(first_row + row_offset,
+                                   {first_col + offset: value for offset, value in enumerate(row_values)})
+            for row_offset, row_values in enumerate(values or [])
+        ]
+        if changed and not any(changed):
+            sheet_writes.record_skip(self.title, "update")
+        elif any(changed):
+            sheet_writes.record_sent(self.title, "update")
+
+    def append_row(self, values, **kwargs):
+        self._mirror.insert(values)
+
+    def get_all_values(self, **kwargs):
+        result = [list(HEADERS)]
+        for local_row, values in self._mirror.rows():
+            # Удаленные строки зеркала остаются пустыми, чтобы номер строки = индекс + 1
+            while len(result) < local_row - 1:
+                result.append([""] * len(HEADERS))
+            result.append(values)
+        return result
+
+    def get_all_records(self, **kwargs):
+        return [dict(zip(HEADERS, values)) for values in self.get_all_values()[1:]]
+
+    def __getattr__(self, name):
+        # Остальные методы идут напрямую в таблицу
+        return getattr(self._worksheet, name)
+
+
+class WriteThroughUsersWorksheet:
+    """Лист Users напрямую в таблицу; записи в нем сразу отражаются в зеркале.
+
+    Номера строк здесь - строки таблицы. Пользователь строки запоминается
+    по find и get_all_records, чтобы запись по номеру строки попала в его
+    строку зеркала.
+    """
+
+    title = "Users"
+
+    def __init__(self, mirror, worksheet):
+        self._mirror = mirror
+        self._worksheet = worksheet
+        self._lock = threading.Lock()
+        self._user_by_row = {}
+
+    def find(self, query, *args, **kwargs):
+        cell = self._worksheet.find(query, *args, **kwargs)
+        if cell is not None and cell.col == 1:
+            with self._lock:
+                self._user_by_row[cell.row] = str(query)
+        return cell
+
+    def get_all_records(self, **kwargs):
+        records = self._worksheet.get_all_records(**kwargs)
+        with self._lock:
+            self._user_by_row = {
+                row: str(record.get("User ID")) for row, record in enumerate(records, start=2) if record.get("User ID")
+            }
+        return records
+
+    def _reflect(self, row, changes):
+        with self._lock:
+            user_id = self._user_by_row.get(row)
+        if user_id:
+            self._mirror.set_synced(user_id, changes)
+
+    def update_cell(self, row, col, value):
+        result = self._worksheet.update_cell(row, col, value)
+        self._reflect(row, {col: value})
+        return result
+
+    def update(self, range_name=None, values=None, **kwargs):
+        if isinstance(range_name, list):
+            range_name, values = values, range_name
+        result = self._worksheet.update(range_name=range_name, values=values, **kwargs)
+        start = sheet_writes.range_start(range_name) if isinstance(range_name, str) else None
+        if start:
+            first_row, first_col = start
+            for row_offset, row_values in enumerate(values or []):
+                self._reflect(first_row + row_offset,
+                              {first_col + offset: value for offset, value in enumerate(row_values)})
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._worksheet, name)
+
+
+class MirroredSpreadsheet:
+    """Таблица, у которой лист Users обслуживается зеркалом, а остальные - как обычно."""
+
+    def __init__(self, spreadsheet, mirror):
+        self._spreadsheet = spreadsheet
+        self.mirror = mirror
+        self.users_worksheet = spreadsheet.worksheet("Users")
+        self._mirrored = MirroredUsersWorksheet(mirror, self.users_worksheet)
+        self.direct_users_worksheet = WriteThroughUsersWorksheet(mirror, self.users_worksheet)
+
+    def worksheet(self, title):
+        if title == "Users":
+            return self._mirrored
+        return self._spreadsheet.worksheet(title)
+
+    def __getattr__(self, name):
+        return getattr(self._spreadsheet, name)
+
+
+def attach(spreadsheet, path=USERS_MIRROR_PATH):
+    """Подключает зеркало к таблице и запускает синхронизацию (без USERS_MIRROR_ENABLED - таблица как есть)."""
+    if spreadsheet is None or not USERS_MIRROR_ENABLED:
+        return spreadsheet
+    try:
+        mirror = UsersMirror(path)
+        mirrored = MirroredSpreadsheet(spreadsheet, mirror)
+        mirror.start_sync(mirrored.users_worksheet)
+    except Exception as e:
+        # Без первичной синхронизации зеркало пустое: бот создал бы заново всех пользователей
+        logger.error(f"❌ Зеркало Users не поднялось, работаю напрямую с таблицей: {e}")
+        return spreadsheet
+    metrics.USERS_MIRROR.set_function(mirror.stats)
+    return mirrored